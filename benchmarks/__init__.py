@@ -0,0 +1,3 @@
+"""
+Route level benchmarks, see `python -m benchmarks.run --help`.
+"""
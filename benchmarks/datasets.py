@@ -0,0 +1,69 @@
+import os
+import tempfile
+from datetime import datetime, timezone
+
+from hjblog import create
+from hjblog.datagen import generate
+from hjblog.db import init_db
+
+
+# Sizes benchmarked by default, the size of a dataset is the number of
+# its comments, posts and users are derived from it
+SIZES = ("10k", "100k", "1M")
+MULTIPLIERS = {"k": 1_000, "M": 1_000_000}
+COMMENTS_PER_POST = 10
+COMMENTS_PER_USER = 100
+CITIES = 50
+# Fixed, so the same seed gives the same timestamps on every run
+END = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_size(size: str) -> int:
+    """`"10k"` -> 10000, `"1M"` -> 1000000, `"500"` -> 500"""
+    multiplier = MULTIPLIERS.get(size[-1:], None)
+    if multiplier is None:
+        return int(size)
+    return int(size[:-1]) * multiplier
+
+
+def get_dataset_path(directory: str, size: str, seed: int) -> str:
+    return os.path.join(directory, f"{size}-{seed}.sqlite")
+
+
+def build_dataset(directory: str, size: str, seed: int) -> str:
+    """Returns the path of the dataset `size`, it is built from `schema.sql`
+    and the migrations the first time and reused afterwards.
+    """
+    path = get_dataset_path(directory, size, seed)
+    if os.path.exists(path):
+        return path
+    os.makedirs(directory, exist_ok=True)
+    partial = path + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create(
+            test_config={
+                "DATABASE": partial,
+                "UPLOAD_DIR": tmp,
+                "METRICS": False,
+                "DATABASE_POOL_SIZE": 0,
+            }
+        )
+        with app.app_context():
+            res = init_db()
+            if isinstance(res, Exception):
+                raise res
+            comments = parse_size(size)
+            generate(
+                users=max(2, comments // COMMENTS_PER_USER),
+                posts=max(1, comments // COMMENTS_PER_POST),
+                comments=comments,
+                cities=CITIES,
+                seed=seed,
+                end=END,
+            )
+    # WAL files are checkpointed when the last connection is closed
+    os.replace(partial, path)
+    return path
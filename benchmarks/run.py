@@ -0,0 +1,349 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator
+
+import requests
+from flask import Flask
+from werkzeug.serving import make_server
+
+from benchmarks.datasets import SIZES, build_dataset
+from hjblog import create
+from hjblog.db import close_pool
+from hjblog.metrics import close_store
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DRIVERS = ("client", "wsgi")
+
+
+def get_routes(app: Flask, database: str) -> dict[str, str]:
+    """Returns the routes of `app` benchmarked on `database` by name, pages
+    that depend on a post use the post with the most comments, the worst case.
+    """
+    db = sqlite3.connect(database)
+    try:
+        post_id, comments = db.execute(
+            "SELECT id, comments_count FROM posts ORDER BY comments_count DESC, id LIMIT 1"
+        ).fetchone()
+    finally:
+        db.close()
+    # `o` selects a chunk of comments, the last one is the deepest offset
+    last_chunk = max(0, comments - 1) // app.config["COMMENTS_CHUNK_SIZE"]
+    return {
+        "index": "/index",
+        "blog": "/blog",
+        "visit_post": f"/user/visit_post/{post_id}",
+        "all_comments": f"/user/all_comments/{post_id}",
+        "all_comments_last": f"/user/all_comments/{post_id}?o={last_chunk}",
+        "search": "/search?q=weather",
+        "api_posts": "/api/v1/posts",
+        "feed": "/feed.atom",
+    }
+
+
+def make_app(database: str, tmp: str) -> Flask:
+    """The application as it is deployed, writing only inside `tmp`."""
+    return create(
+        test_config={
+            "DATABASE": database,
+            "UPLOAD_DIR": os.path.join(tmp, "uploads"),
+            "PROFILES_DIR": os.path.join(tmp, "profiles"),
+            "METRICS_DIR": os.path.join(tmp, "metrics"),
+            "FRAGMENT_CACHE_PATH": os.path.join(tmp, "fragments.sqlite"),
+            "IMAGE_JOBS_WORKERS": 0,
+        }
+    )
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    """Nearest rank percentile of the sorted `ordered`."""
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list[float], elapsed: float, errors: int) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+def bench(get: Callable[[], int], amount: int, concurrency: int) -> dict:
+    """Calls `get` `amount` times from `concurrency` threads, `get`
+    returns the status code of the response.
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(calls: int):
+        nonlocal errors
+        for _ in range(calls):
+            started = time.perf_counter()
+            status = get()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors += 1
+
+    shares = [
+        amount // concurrency + (i < amount % concurrency) for i in range(concurrency)
+    ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker, share) for share in shares]:
+            future.result()
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+@contextmanager
+def serve(app: Flask) -> Iterator[str]:
+    """Serves `app` from a threaded WSGI server on a free port,
+    yields its base URL.
+    """
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def run_client(app: Flask, routes: dict[str, str], args) -> dict:
+    """Drives the application through the test client, measures the
+    application alone, one request at a time.
+    """
+    results = {}
+    client = app.test_client()
+    for name, path in routes.items():
+
+        def get() -> int:
+            return client.get(path).status_code
+
+        bench(get, args.warmup, 1)
+        results[name] = bench(get, args.requests, 1)
+    return results
+
+
+def run_wsgi(app: Flask, routes: dict[str, str], args) -> dict:
+    """Drives the application through a real HTTP server with
+    `--concurrency` clients, measures the throughput too.
+    """
+    results = {}
+    local = threading.local()
+    with serve(app) as base_url:
+        for name, path in routes.items():
+
+            def get() -> int:
+                if not hasattr(local, "session"):
+                    local.session = requests.Session()
+                response = local.session.get(base_url + path)
+                response.content
+                return response.status_code
+
+            bench(get, args.warmup, args.concurrency)
+            results[name] = bench(get, args.requests, args.concurrency)
+    return results
+
+
+RUNNERS = {"client": run_client, "wsgi": run_wsgi}
+
+
+def run(args) -> dict:
+    """Returns the results by driver, size and route."""
+    results: dict[str, dict] = {driver: {} for driver in args.drivers}
+    for size in args.sizes:
+        print(f"Preparing the {size} dataset...", file=sys.stderr)
+        database = build_dataset(args.data_dir, size, args.seed)
+        for driver in args.drivers:
+            with tempfile.TemporaryDirectory() as tmp:
+                app = make_app(database, tmp)
+                routes = get_routes(app, database)
+                if args.routes:
+                    routes = {k: v for k, v in routes.items() if k in args.routes}
+                try:
+                    results[driver][size] = RUNNERS[driver](app, routes, args)
+                finally:
+                    close_pool(app)
+                    close_store(app)
+            for name, stats in results[driver][size].items():
+                print(
+                    f"{driver:6} {size:>5} {name:18} p50 {stats['p50_ms']:9.2f} ms  p95 {stats['p95_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms  {stats['rps']:8.1f} req/s  {stats['errors']} errors",
+                    file=sys.stderr,
+                )
+    return results
+
+
+def compare(
+    baseline: dict, results: dict, threshold: float, min_delta_ms: float
+) -> list[str]:
+    """Returns the regressions of `results` against `baseline`: a p95
+    latency higher by more than `threshold`(and by at least `min_delta_ms`,
+    sub-millisecond routes are noisy) or a throughput lower by more than
+    `threshold`. Routes missing from the baseline aren't compared.
+    """
+    regressions = []
+    for driver, sizes in results.items():
+        for size, routes in sizes.items():
+            for name, stats in routes.items():
+                old = baseline.get(driver, {}).get(size, {}).get(name, None)
+                if old is None:
+                    continue
+                where = f"{driver} {size} {name}"
+                if stats["errors"] > old["errors"]:
+                    regressions.append(f"{where}: {stats['errors']} errors")
+                p95, old_p95 = stats["p95_ms"], old["p95_ms"]
+                if p95 > old_p95 * (1 + threshold) and p95 - old_p95 >= min_delta_ms:
+                    regressions.append(f"{where}: p95 {old_p95:.2f} ms -> {p95:.2f} ms")
+                if stats["rps"] < old["rps"] * (1 - threshold):
+                    regressions.append(
+                        f"{where}: {old['rps']:.1f} req/s -> {stats['rps']:.1f} req/s"
+                    )
+    return regressions
+
+
+def load_baseline(path: str) -> dict | None:
+    """Returns the baseline recorded at `path`, `None` if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def not_compared(baseline: dict, results: dict) -> list[str]:
+    """Returns the routes of `results` missing from `baseline`."""
+    return [
+        f"{driver} {size} {name}"
+        for driver, sizes in results.items()
+        for size, routes in sizes.items()
+        for name in routes
+        if name not in baseline.get(driver, {}).get(size, {})
+    ]
+
+
+def save_baseline(path: str, baseline: dict, results: dict, args):
+    """Merges `results` into the baseline, entries that weren't
+    measured this time are kept.
+    """
+    for driver, sizes in results.items():
+        for size, routes in sizes.items():
+            baseline["results"].setdefault(driver, {}).setdefault(size, {}).update(
+                routes
+            )
+    baseline["meta"] = {
+        "updated": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+
+def parse_args(argv: list[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Benchmarks the routes of the blog on synthetic datasets and compares them with a baseline.",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=list(SIZES),
+        help="Dataset sizes, in comments: 10k, 100k, 1M...",
+    )
+    parser.add_argument("--drivers", nargs="+", default=list(DRIVERS), choices=DRIVERS)
+    parser.add_argument("--routes", nargs="+", default=None, help="Only these routes.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route.")
+    parser.add_argument(
+        "--warmup", type=int, default=20, help="Requests per route before measuring."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Clients of the WSGI server."
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(BENCHMARKS_DIR, "data"),
+        help="Where the datasets are cached.",
+    )
+    parser.add_argument(
+        "--baseline", default=os.path.join(BENCHMARKS_DIR, "baseline.json")
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="Record the results as the new baseline."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Tolerated regression, 0.25 is 25%%.",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=1.0,
+        help="Smaller p95 regressions(ms) are ignored.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Returns 1 if a route regressed against the baseline, 2 if there
+    is no baseline to compare with.
+    """
+    args = parse_args(argv)
+    baseline = load_baseline(args.baseline)
+    if baseline is None and not args.save:
+        print(
+            f"Error: no baseline at {args.baseline}, record one with --save on this machine.",
+            file=sys.stderr,
+        )
+        return 2
+    # every request would be logged
+    logging.getLogger("hjblog.requests").setLevel(logging.ERROR)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    results = run(args)
+    if args.save:
+        save_baseline(args.baseline, baseline or {"results": {}}, results, args)
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+        return 0
+    missing = not_compared(baseline["results"], results)
+    if missing:
+        print("Warning, not in the baseline, so not compared:", file=sys.stderr)
+        for route in missing:
+            print(f"\t{route}", file=sys.stderr)
+    regressions = compare(baseline["results"], results, args.threshold, args.min_delta)
+    if regressions:
+        print("Regressions:", file=sys.stderr)
+        for regression in regressions:
+            print(f"\t{regression}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
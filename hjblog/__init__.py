@@ -15,6 +15,137 @@ def create(test_config: dict[str : str | bool] | None = None) -> Flask:
         APP_NAME="HJBlog",
         UPLOAD_DIR=os.path.join(app.instance_path, "uploads"),
         MAX_CONTENT_LENGTH=32 * 1000 * 1000,
+        # Seconds browsers can keep an uploaded file without revalidating it
+        UPLOADS_MAX_AGE=365 * 24 * 60 * 60,
+        # Internal nginx location uploads are served from through X-Accel-Redirect,
+        # `None` serves them from Python(or through X-Sendfile with `USE_X_SENDFILE`)
+        UPLOADS_ACCEL_REDIRECT=None,
+        # Measure every request, see `hjblog/instrumentation.py`
+        INSTRUMENTATION=True,
+        # Send the measures to the client through the `Server-Timing` header
+        SERVER_TIMING=True,
+        # Requests slower than this(in seconds) are logged as warnings
+        SLOW_REQUEST_THRESHOLD=1.0,
+        # Statements executed this many times by a request are reported(N+1)
+        REPEATED_QUERY_THRESHOLD=10,
+        # Serve `/metrics` in the Prometheus text format, see `hjblog/metrics.py`
+        METRICS=True,
+        # Where every process keeps its counters, `/metrics` sums them
+        METRICS_DIR=os.path.join(app.instance_path, "metrics"),
+        # Clients allowed to read `/metrics`, `None` allows everyone,
+        # behind a reverse proxy every client has the address of the proxy
+        METRICS_ALLOWED_ADDRESSES=None,
+        # Bearer token required to read `/metrics`, `None` doesn't serve it
+        METRICS_TOKEN=None,
+        # Seconds between two samples of the profiler, while sampling
+        # every request for a window of time or a single request
+        PROFILE_WINDOW_INTERVAL=0.01,
+        PROFILE_REQUEST_INTERVAL=0.001,
+        # Seconds a signed link that profiles a request is valid for
+        PROFILE_LINK_MAX_AGE=600,
+        # Where the profiles are written, only the newest ones are kept
+        PROFILES_DIR=os.path.join(app.instance_path, "profiles"),
+        PROFILES_MAX_FILES=100,
+        # Seconds browsers can keep a fingerprinted static file without revalidating it
+        ASSETS_MAX_AGE=365 * 24 * 60 * 60,
+        # Compress the responses with gzip, or brotli if it is installed
+        COMPRESS=True,
+        # Responses smaller than this(in bytes) are sent as they are
+        COMPRESS_MIN_SIZE=500,
+        # Levels used while serving requests, static files are precompressed
+        # at the highest level by `compress-static`
+        COMPRESS_LEVEL=6,
+        COMPRESS_BROTLI_QUALITY=4,
+        # Types worth compressing, images are already compressed
+        COMPRESS_MIMETYPES={
+            "text/html",
+            "text/css",
+            "text/plain",
+            "text/javascript",
+            "application/javascript",
+            "application/json",
+            "application/xml",
+            "application/atom+xml",
+            "application/rss+xml",
+            "image/svg+xml",
+        },
+        # Latest posts listed by the Atom and RSS feeds
+        FEED_SIZE=20,
+        # Seconds feed readers can keep a feed without revalidating it
+        FEED_MAX_AGE=300,
+        # Comments loaded at a time by the comments of a post, `o` selects the chunk
+        COMMENTS_CHUNK_SIZE=100,
+        # Logged in users cached per process, 0 disables the cache
+        USER_CACHE_SIZE=1024,
+        # Seconds a cached user is trusted, updates made by other sessions
+        # or processes are seen after at most this long
+        USER_CACHE_TTL=30,
+        # Seconds between two garbage collections of the uploads, 0 disables them
+        UPLOADS_GC_INTERVAL=0,
+        # Files examined at a time by the garbage collection
+        UPLOADS_GC_BATCH_SIZE=100,
+        # Files examined per second by the garbage collection
+        UPLOADS_GC_RATE=200,
+        # Unused files younger than this(in seconds) are kept
+        UPLOADS_GC_MIN_AGE=60 * 60,
+        # Uploaded pictures with more pixels than this are refused
+        PICTURE_MAX_PIXELS=40 * 1000 * 1000,
+        # Processes that resize the uploaded pictures, 0 processes them inside the request
+        IMAGE_JOBS_WORKERS=2,
+        # Pictures that can be waiting or processed at the same time, per process
+        IMAGE_JOBS_MAX_QUEUE=16,
+        # Idle connections kept open per process, 0 disables pooling
+        DATABASE_POOL_SIZE=8,
+        # Checks that a pooled connection still works before handing it out
+        DATABASE_POOL_HEALTH_CHECK=True,
+        # Applied once to every new connection
+        DATABASE_PRAGMAS={
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            # negative values are KiB
+            "cache_size": -16000,
+            "mmap_size": 64 * 1024 * 1024,
+            "temp_store": "MEMORY",
+        },
+        # Backend of the rendered fragments cache: "lru"(per process),
+        # "sqlite"(shared by the processes using `FRAGMENT_CACHE_PATH`) or `None`,
+        # invalidations are seen by every process whatever the backend
+        FRAGMENT_CACHE="lru",
+        FRAGMENT_CACHE_PATH=os.path.join(app.instance_path, "fragments.sqlite"),
+        FRAGMENT_CACHE_SIZE=256,
+        FRAGMENT_CACHE_TTL=3600,
+        # Seconds a process trusts the generations it read, an invalidation
+        # made by another process is seen after at most this long
+        FRAGMENT_CACHE_GENERATION_TTL=1,
+        # (connect, read) timeouts in seconds for the weather backend
+        WEATHER_HTTP_TIMEOUT=(3.05, 10),
+        WEATHER_HTTP_RETRIES=2,
+        # Connections to the weather backend kept alive per process
+        WEATHER_HTTP_POOL_SIZE=10,
+        # Parsed forecasts kept in memory per process
+        WEATHER_CACHE_SIZE=512,
+        # Seconds a forecast is fresh, after that it is refreshed in background
+        WEATHER_CACHE_TTL=15 * 60,
+        # Seconds after which a stale forecast isn't served anymore
+        WEATHER_CACHE_MAX_STALE=3 * 60 * 60,
+        # Decimals the coordinates are rounded to, 2 is about 1 km
+        WEATHER_CACHE_PRECISION=2,
+        # Coalesce identical backend calls across processes through the database
+        UPSTREAM_SHARED_SINGLE_FLIGHT=True,
+        # Seconds a process can hold the lock of a call
+        UPSTREAM_FLIGHT_LEASE=15,
+        # Seconds the result of a call is kept for processes still waiting
+        UPSTREAM_FLIGHT_RESULT_TTL=5,
+        UPSTREAM_FLIGHT_POLL_INTERVAL=0.05,
+        # Seconds the counters of `upstream-stats` are kept in memory before
+        # being written to the database
+        UPSTREAM_FLIGHT_STATS_FLUSH=10,
+        # Consecutive failures after which the breaker of a backend opens
+        UPSTREAM_BREAKER_FAILURES=5,
+        # Seconds an open breaker fails fast before letting a trial call through
+        UPSTREAM_BREAKER_RECOVERY=30,
+        # Seconds a single request can spend waiting for the weather backend
+        WEATHER_LATENCY_BUDGET=4.0,
     )
 
     if test_config is None:
@@ -26,10 +157,34 @@ def create(test_config: dict[str : str | bool] | None = None) -> Flask:
 
     create_instance_folder(app.instance_path)
 
+    from . import profiling
+
+    profiling.init_app(app)
+
+    from . import instrumentation
+
+    instrumentation.init_app(app)
+
+    from . import metrics
+
+    metrics.init_app(app)
+
     from . import db
 
     db.init_app(app)
 
+    from . import uploads
+
+    uploads.init_app(app)
+
+    from . import compression
+
+    compression.init_app(app)
+
+    from . import assets
+
+    assets.init_app(app)
+
     from . import admin_management
 
     admin_management.init_app(app)
@@ -51,6 +206,14 @@ def create(test_config: dict[str : str | bool] | None = None) -> Flask:
 
     app.register_blueprint(bp)
 
+    from .bps.admin.routes import bp
+
+    app.register_blueprint(bp)
+
+    from .bps.api.routes import bp
+
+    app.register_blueprint(bp)
+
     from .bps.errors.handlers import bp
 
     app.register_blueprint(bp)
@@ -1,11 +1,15 @@
-import os
 import sqlite3
 import sys
 import click
+from datetime import datetime, timezone
 from flask import Flask, current_app
 
-from .auxiliaries import get_admin_credencials
-from .db import get_db
+from .auxiliaries import forget_user, get_admin_credencials
+from .bps.user_profile.auxiliaries import remove_picture
+from .cache import POSTS, invalidate
+from .datagen import generate
+from .db import get_db, rebuild_fts, recount
+from .uploads import collect_garbage
 
 import logging
 
@@ -14,9 +18,16 @@ LS = """COMMANDS:
 new-admin -> Adds a new admin account.
 clear-admins -> Removes all the admin accounts from the database.
 remove-one-admin -> Allows the user to select an admin to remove.
-gen-posts -> Generates a random amount of posts to insert into the database for testing purpose.
-gen-comments -> Generates a random amount of comments to insert into the database for testing purpose.
+gen-data -> Generates users, posts, comments and cities for load testing, see `gen-data --help`.
 init-db -> Initializes the database, deleting all the data saved so far.
+migrate -> Upgrades the database to the latest schema version, keeping the data.
+upstream-stats -> Displays how many calls to the weather backend were executed and coalesced.
+breaker-status -> Displays the state of the circuit breakers guarding the weather backend.
+gc-uploads -> Removes the uploaded files that aren't used anymore, see `gc-uploads --help`.
+recount -> Recomputes the number of posts and comments kept by the database triggers.
+fts-rebuild -> Rebuilds the full text search indexes of posts and comments.
+compress-static -> Precompresses the static files, run it after every change to `static/`.
+build-assets -> Writes the manifest of the fingerprinted static files, run it after every change to `static/`.
 """
 
 
@@ -61,7 +72,7 @@ def clear_admins():
 
     try:
         admins = db.execute(
-            "SELECT username, email, profile_pic FROM users WHERE (is_admin = TRUE)"
+            "SELECT id, username, email, profile_pic FROM users WHERE (is_admin = TRUE)"
         ).fetchall()
     except sqlite3.Error as e:
         # sqlite3 related Exceptions
@@ -85,6 +96,8 @@ def clear_admins():
         return
 
     try:
+        # like every change to a user, see `forget_user`
+        db.execute("UPDATE users SET version = version + 1 WHERE (is_admin = TRUE)")
         db.execute("DELETE FROM users WHERE (is_admin = TRUE)")
         db.commit()
     except sqlite3.Error as e:
@@ -95,21 +108,14 @@ def clear_admins():
         # Unexpected behaviour
         click.echo(message=f"Unexpected Exception:\n{e}", err=True)
         return
+    invalidate(POSTS)
+    for admin in admins:
+        forget_user(admin["id"])
 
     # removing profile pics
-    profile_pics_dir = current_app.config["UPLOAD_DIR"]
     for admin in admins:
         if admin["profile_pic"]:
-            try:
-                file = os.path.join(profile_pics_dir, admin["profile_pic"])
-                os.remove(file)
-            except (FileNotFoundError, PermissionError) as e:
-                click.echo(message=f"Failed to remove: {file}\nBecouse: {e}", err=True)
-            except Exception as e:
-                click.echo(
-                    message=f"Unexpected Exception occurred.\nFailed to remove: {file}\nBecouse: {e}",
-                    err=True,
-                )
+            remove_picture(admin["profile_pic"])
 
     print("\nThese admin accounts have been removed:")
     for admin in admins:
@@ -168,8 +174,15 @@ def remove_one_admin():
         if i[0] == choice:
 
             try:
+                # like every change to a user, see `forget_user`
+                db.execute(
+                    "UPDATE users SET version = version + 1 WHERE (id = ?)",
+                    (i[1]["id"],),
+                )
                 db.execute("DELETE FROM users WHERE (id = ?)", (i[1]["id"],))
                 db.commit()
+                forget_user(i[1]["id"])
+                invalidate(POSTS)
                 print(f'Admin "{i[1]["username"]}" has been removed.')
             except sqlite3.Error as e:
                 # sqlite3 related Exceptions
@@ -180,128 +193,196 @@ def remove_one_admin():
                 click.echo(message=f"Unexpected Exception:\n{e}", err=True)
                 return
             if i[1]["profile_pic"]:
-                try:
-                    file = os.path.join(
-                        current_app.config["UPLOAD_DIR"],
-                        i[1]["profile_pic"],
-                    )
-                    os.remove(file)
-                except (FileNotFoundError, PermissionError) as e:
-                    click.echo(
-                        message=f"Failed to remove: {file}\nBecouse: {e}", err=True
-                    )
-                except Exception as e:
-                    click.echo(
-                        message=f"Unexpected Exception occurred.\nFailed to remove: {file}\nBecouse: {e}",
-                        err=True,
-                    )
+                remove_picture(i[1]["profile_pic"])
             break
 
 
-@click.command("gen-posts")
-def generate_random_posts():
-    """Generates a random amount of posts to insert into
-    the database for testing purpose.
+@click.command("gen-data")
+@click.option("--users", type=int, default=1000, show_default=True)
+@click.option("--posts", type=int, default=1000, show_default=True)
+@click.option("--comments", type=int, default=10000, show_default=True)
+@click.option("--cities", type=int, default=100, show_default=True)
+@click.option(
+    "--seed", type=int, default=0, show_default=True, help="Same seed, same rows."
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=50000,
+    show_default=True,
+    help="Rows per transaction.",
+)
+def generate_data(
+    users: int, posts: int, comments: int, cities: int, seed: int, batch_size: int
+):
+    """Generates random users, posts, comments and cities for load testing,
+    next to the data already in the database, and reports the throughput.
+    Generated users can log in with the password `password`.
     """
-    # we need an admin
-    db = get_db()
-    admin = db.execute("SELECT id FROM users WHERE (is_admin = true)").fetchone()
-    if admin is None:
-        print(
-            'At least one admin is to be registered in order to execute this command, use the "new-admin" command.',
-            file=sys.stderr,
+    if min(users, posts, comments, cities) < 0 or batch_size < 1:
+        click.echo(
+            message="Error: the amounts can't be negative and the batch size has to be positive.",
+            err=True,
         )
         return
-
-    amount = ask_for_int(
-        "How many post do you want me to generate?(max 100):\n>> ", 100
-    )
-    if amount is None:
-        print(
-            "Error: an invalid value has been typed. Procedure aborted.",
-            file=sys.stderr,
+    try:
+        report = generate(
+            users,
+            posts,
+            comments,
+            cities,
+            seed,
+            datetime.now(timezone.utc),
+            batch_size,
         )
+    except ValueError as e:
+        click.echo(message=f"Error: {e}", err=True)
+        return
+    except sqlite3.Error as e:
+        # sqlite3 related Exceptions
+        click.echo(message=e.__str__(), err=True)
+        return
+    except Exception as e:
+        # Unexpected behaviour
+        click.echo(message=f"Unexpected Exception:\n{e}", err=True)
         return
 
-    for i in range(0, amount):
-        title = f"test-title-{i}"
-        content = f"this is a test, content {i}."
-        db.execute(
-            "INSERT INTO posts (title, content, author_id) VALUES (?, ?, ?)",
-            (title, content, admin["id"]),
-        )
-
-    db.commit()
-
-    print(f"Procedure completed. {amount} posts were generated.")
+    invalidate(POSTS)
+    for line in report.lines():
+        click.echo(line)
 
 
-@click.command("gen-comments")
-def generate_random_comments():
-    """Generates a random amount of comments to insert into
-    the database for testing purpose.
+@click.command("upstream-stats")
+def upstream_stats():
+    """Displays how many calls to the weather backend were executed
+    and how many were coalesced with a call already in flight,
+    the counters sum the activity of every process.
     """
     db = get_db()
-
-    admin = db.execute("SELECT id FROM users WHERE (is_admin = true)").fetchone()
-    if admin is None:
-        print(
-            'At least one admin is to be registered in order to execute this command, user "new-admin" command.',
-            file=sys.stderr,
+    try:
+        stats = dict(
+            db.execute("SELECT name, value FROM upstream_flight_stats").fetchall()
         )
+    except sqlite3.Error as e:
+        # sqlite3 related Exceptions
+        click.echo(message=e.__str__(), err=True)
         return
 
-    amount = ask_for_int(
-        "How many comments do you want me to generate?(max 100):\n>> ", 100
-    )
-    if amount is None:
-        print(
-            "Error: an invalid value has been typed. Procedure aborted.",
-            file=sys.stderr,
-        )
+    executed = stats.get("executed", 0)
+    coalesced = stats.get("coalesced", 0)
+    shared_coalesced = stats.get("shared_coalesced", 0)
+    total = executed + coalesced + shared_coalesced
+    click.echo(f"Upstream calls executed: {executed}")
+    click.echo(f"Coalesced inside a process: {coalesced}")
+    click.echo(f"Coalesced across processes: {shared_coalesced}")
+    if total > 0:
+        click.echo(f"Calls saved: {(coalesced + shared_coalesced) / total:.1%}")
+
+
+@click.command("breaker-status")
+def breaker_status():
+    """Displays the last known state of the circuit breakers guarding
+    the weather backend, one line for every backend and process.
+    """
+    db = get_db()
+    try:
+        breakers = db.execute(
+            "SELECT name, pid, state, failures, changed FROM upstream_breakers ORDER BY name, pid"
+        ).fetchall()
+    except sqlite3.Error as e:
+        # sqlite3 related Exceptions
+        click.echo(message=e.__str__(), err=True)
         return
 
-    some_posts_id = db.execute("SELECT id FROM posts LIMIT 10").fetchall()
-    if not some_posts_id:
-        print(
-            'Currently there are no posts, you need to add a posts before commenting it, consider using the command "gen-posts".',
-            file=sys.stderr,
-        )
+    if len(breakers) == 0:
+        click.echo("Every circuit breaker is closed.")
         return
+    for breaker in breakers:
+        changed = datetime.fromtimestamp(breaker["changed"]).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        click.echo(
+            f"{breaker['name']} (pid {breaker['pid']}): {breaker['state']}, {breaker['failures']} consecutive failures, since {changed}"
+        )
+
 
-    prompt = "Type the id of the post you want to add comments to, some valid id: "
-    for post in some_posts_id:
-        prompt = prompt + f' {post["id"]}'
-    prompt = prompt + "\n>> "
-    post_id = ask_for_int(prompt)
-    if post_id is None:
-        print("Invalid id, aborting.", file=sys.stderr)
+@click.command("gc-uploads")
+@click.option("--dry-run", is_flag=True, help="Only report what would be removed.")
+@click.option("--batch-size", type=int, default=None, help="Files examined at a time.")
+@click.option("--rate", type=float, default=None, help="Files examined per second.")
+@click.option(
+    "--min-age", type=float, default=None, help="Unused files younger than this(in seconds) are kept."
+)
+def gc_uploads(
+    dry_run: bool, batch_size: int | None, rate: float | None, min_age: float | None
+):
+    """Removes the uploaded files that no user references anymore,
+    the defaults come from the `UPLOADS_GC_*` configuration.
+    """
+    config = current_app.config
+    try:
+        report = collect_garbage(
+            batch_size or config["UPLOADS_GC_BATCH_SIZE"],
+            rate if rate is not None else config["UPLOADS_GC_RATE"],
+            min_age if min_age is not None else config["UPLOADS_GC_MIN_AGE"],
+            dry_run,
+        )
+    except sqlite3.Error as e:
+        # sqlite3 related Exceptions
+        click.echo(message=e.__str__(), err=True)
         return
+    except Exception as e:
+        # Unexpected behaviour
+        click.echo(message=f"Unexpected Exception:\n{e}", err=True)
+        return
+
+    if dry_run:
+        click.echo("Dry run, nothing has been removed.")
+    for line in report.lines():
+        click.echo(line)
+
 
-    post = db.execute(
-        "SELECT id, title FROM posts WHERE (id = ?)", (post_id,)
-    ).fetchone()
-    if not post:
-        print("Invalid id, aborting.", file=sys.stderr)
+@click.command("recount")
+def recount_command():
+    """Recomputes the counters of posts and comments maintained
+    by the database triggers, use it if they ever drift, for instance
+    after editing the tables with the triggers disabled.
+    """
+    try:
+        corrected = recount()
+    except sqlite3.Error as e:
+        # sqlite3 related Exceptions
+        click.echo(message=e.__str__(), err=True)
+        return
+    except Exception as e:
+        # Unexpected behaviour
+        click.echo(message=f"Unexpected Exception:\n{e}", err=True)
         return
 
-    for i in range(0, amount):
-        content = f"Dummie comment number {i}"
-        try:
-            db.execute(
-                "INSERT INTO comments (post_id, content, author_id) VALUES (?, ?, ?)",
-                (post["id"], content, admin["id"]),
-            )
-        except Exception as e:
-            logging.exception(e)
-            raise e
+    invalidate(POSTS)
+    for counter, wrong in corrected.items():
+        click.echo(f"{counter}: {wrong} corrected")
+
+
+@click.command("fts-rebuild")
+def fts_rebuild():
+    """Rebuilds the full text search indexes of posts and comments,
+    use it on databases where the tables have been edited with
+    the triggers disabled.
+    """
     try:
-        db.commit()
+        indexed = rebuild_fts()
+    except sqlite3.Error as e:
+        # sqlite3 related Exceptions
+        click.echo(message=e.__str__(), err=True)
+        return
     except Exception as e:
-        logging.exception(e)
-        raise e
+        # Unexpected behaviour
+        click.echo(message=f"Unexpected Exception:\n{e}", err=True)
+        return
 
-    print(f'Success! Added {amount} comments to the post "{post["title"]}".')
+    for index, rows in indexed.items():
+        click.echo(f"{index}: {rows} rows indexed")
 
 
 def init_app(app: Flask):
@@ -311,9 +392,13 @@ def init_app(app: Flask):
     app.cli.add_command(new_admin)
     app.cli.add_command(clear_admins)
     app.cli.add_command(remove_one_admin)
-    app.cli.add_command(generate_random_posts)
-    app.cli.add_command(generate_random_comments)
+    app.cli.add_command(generate_data)
     app.cli.add_command(display_commands)
+    app.cli.add_command(upstream_stats)
+    app.cli.add_command(breaker_status)
+    app.cli.add_command(gc_uploads)
+    app.cli.add_command(recount_command)
+    app.cli.add_command(fts_rebuild)
 
 
 def ask_for_int(prompt: str, limit: int | None = None) -> int | None:
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+import click
+from flask import Flask, current_app
+
+from hjblog.compression import VARIANTS
+
+
+ASSETS_EXTENSION = "hjblog.assets"
+MANIFEST = "manifest.json"
+# `name.<fingerprint>.ext`, the fingerprint is part of the hash of the content
+FINGERPRINTED = re.compile(r"^(.*)\.([0-9a-f]{10})(\.[^./]+)$")
+_assets_lock = threading.Lock()
+
+
+def fingerprint(path: str, file_name: str) -> str:
+    """Returns `file_name` with the fingerprint of the content of `path`
+    inserted before the extension.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    root, ext = os.path.splitext(file_name)
+    return f"{root}.{digest.hexdigest()[:10]}{ext}"
+
+
+def static_files(static_folder: str) -> dict[str, str]:
+    """Maps every file of `static_folder`(relative path) to its path,
+    precompressed variants are left out since they are served in place
+    of their file.
+    """
+    files = {}
+    for directory, _, file_names in os.walk(static_folder):
+        for file_name in file_names:
+            if file_name == MANIFEST or file_name.endswith(tuple(VARIANTS.values())):
+                continue
+            path = os.path.join(directory, file_name)
+            files[os.path.relpath(path, static_folder).replace(os.sep, "/")] = path
+    return files
+
+
+def build_manifest(static_folder: str) -> dict[str, str]:
+    """Maps every file of `static_folder`(relative path) to its
+    fingerprinted name.
+    """
+    return {
+        name: fingerprint(path, name)
+        for name, path in static_files(static_folder).items()
+    }
+
+
+def load_manifest(static_folder: str) -> dict[str, str] | None:
+    """Returns the fingerprints stored in the manifest by `build-assets`,
+    `None` if there is no manifest or if it is outdated: a file was added,
+    removed or modified after it was written(its modification time
+    changed), so a forgotten run never serves a new content under
+    an old fingerprint.
+    """
+    try:
+        with open(os.path.join(static_folder, MANIFEST)) as f:
+            manifest = json.load(f)
+        fingerprints, mtimes = manifest["files"], manifest["mtimes"]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Ignoring the unreadable manifest of the static files: {e}")
+        return None
+
+    files = static_files(static_folder)
+    if files.keys() != fingerprints.keys():
+        logging.warning("Ignoring the outdated manifest of the static files")
+        return None
+    for name, path in files.items():
+        if os.path.getmtime(path) != mtimes.get(name, None):
+            logging.warning("Ignoring the outdated manifest of the static files")
+            return None
+    return fingerprints
+
+
+class Assets:
+    """Fingerprinted names of the static files, loaded from the manifest
+    written by `build-assets` or, if there isn't an up to date one,
+    computed once. In debug mode the fingerprint of a file is computed
+    again when the file changes, so an edited stylesheet is picked up
+    right away.
+    """
+
+    def __init__(self, static_folder: str, debug: bool):
+        self.static_folder = static_folder
+        self.debug = debug
+        manifest = None if debug else load_manifest(static_folder)
+        if manifest is None:
+            manifest = build_manifest(static_folder)
+        self.manifest = manifest
+        self.files = {v: k for k, v in self.manifest.items()}
+        self._mtimes: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def url_name(self, name: str) -> str:
+        """Returns the fingerprinted name of `name`, or `name` itself
+        if it isn't a static file.
+        """
+        if self.debug:
+            self._refresh(name)
+        return self.manifest.get(name, name)
+
+    def resolve(self, url_name: str) -> tuple[str, bool]:
+        """Returns the file a fingerprinted name points to and whether
+        the fingerprint is the current one. A name that isn't
+        fingerprinted, or whose fingerprint is outdated(a page rendered
+        before a deploy), is resolved to the file it names.
+        """
+        name = self.files.get(url_name, None)
+        if name is not None:
+            return name, True
+        match = FINGERPRINTED.match(url_name)
+        if match is not None:
+            return match.group(1) + match.group(3), False
+        return url_name, False
+
+    def _refresh(self, name: str):
+        path = os.path.join(self.static_folder, name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return
+        if self._mtimes.get(name, None) == mtime:
+            return
+        with self._lock:
+            old = self.manifest.get(name, None)
+            if old is not None:
+                self.files.pop(old, None)
+            self.manifest[name] = fingerprint(path, name)
+            self.files[self.manifest[name]] = name
+            self._mtimes[name] = mtime
+
+
+def get_assets(app: Flask) -> Assets:
+    assets = app.extensions.get(ASSETS_EXTENSION, None)
+    if assets is None:
+        with _assets_lock:
+            assets = app.extensions.get(ASSETS_EXTENSION, None)
+            if assets is None:
+                assets = Assets(app.static_folder, app.debug)
+                app.extensions[ASSETS_EXTENSION] = assets
+    return assets
+
+
+@click.command("build-assets")
+def build_assets_command():
+    """Writes the manifest of the fingerprinted static files, run it
+    after every change to `static/`(it is part of the build) so the
+    fingerprints aren't computed when the application starts,
+    an outdated manifest is ignored.
+    """
+    static_folder = current_app.static_folder
+    try:
+        files = static_files(static_folder)
+        manifest = {name: fingerprint(path, name) for name, path in files.items()}
+        mtimes = {name: os.path.getmtime(path) for name, path in files.items()}
+        with open(os.path.join(static_folder, MANIFEST), "w") as f:
+            json.dump(
+                {"files": manifest, "mtimes": mtimes}, f, indent=4, sort_keys=True
+            )
+    except (FileNotFoundError, PermissionError) as e:
+        # File related Exceptions
+        click.echo(message=e.__str__(), err=True)
+        return
+    except Exception as e:
+        # Unexpected behaviour
+        click.echo(message=f"Unexpected Exception:\n{e}", err=True)
+        return
+
+    current_app.extensions.pop(ASSETS_EXTENSION, None)
+    for name, url_name in sorted(manifest.items()):
+        click.echo(f"{name} -> {url_name}")
+
+
+def init_app(app: Flask):
+    """`url_for("static", filename=...)` emits the fingerprinted name of the
+    file, which is served with `ASSETS_MAX_AGE` and `immutable`, a new
+    content gets a new URL, so browsers never revalidate an asset.
+    The fingerprints are loaded, or computed, when the application starts.
+    """
+    serve_static = app.view_functions["static"]
+
+    def static(filename: str):
+        name, current = get_assets(app).resolve(filename)
+        response = serve_static(name)
+        if current and response.status_code == 200:
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config["ASSETS_MAX_AGE"]
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return response
+
+    def fingerprint_url(endpoint: str, values: dict):
+        if endpoint == "static" and "filename" in values:
+            values["filename"] = get_assets(app).url_name(values["filename"])
+
+    app.view_functions["static"] = static
+    app.url_defaults(fingerprint_url)
+    app.cli.add_command(build_assets_command)
+    get_assets(app)
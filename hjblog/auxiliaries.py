@@ -3,14 +3,33 @@ import re
 import getpass
 import functools
 import sys
-from typing import Callable, ParamSpec
-
-from flask import abort, flash, g, session, url_for, redirect
+import threading
+from types import MappingProxyType
+from typing import Callable, Mapping, ParamSpec
+
+from flask import (
+    abort,
+    current_app,
+    flash,
+    g,
+    has_request_context,
+    session,
+    url_for,
+    redirect,
+)
 
 from werkzeug.security import generate_password_hash
 
+from hjblog.cache import LRUCache
+from hjblog.db import get_db
+from hjblog.metrics import inc
+
 P = ParamSpec("P")
 
+USER_CACHE_EXTENSION = "hjblog.user_cache"
+_user_cache_lock = threading.Lock()
+USER_COLUMNS = "id, username, email, city_id, is_admin, is_two_factor_authentication_enabled, secret_token, profile_pic, hash_pass, version"
+
 
 def create_instance_folder(instance_path: str):
     try:
@@ -89,6 +108,78 @@ def logout_user():
     session.clear()
 
 
+def get_user_cache() -> LRUCache | None:
+    """Returns the cache of the users of the process, `None` if
+    `USER_CACHE_SIZE` is 0.
+    """
+    if current_app.config["USER_CACHE_SIZE"] <= 0:
+        return None
+    cache = current_app.extensions.get(USER_CACHE_EXTENSION, None)
+    if cache is None:
+        with _user_cache_lock:
+            cache = current_app.extensions.get(USER_CACHE_EXTENSION, None)
+            if cache is None:
+                cache = LRUCache(
+                    current_app.config["USER_CACHE_SIZE"],
+                    current_app.config["USER_CACHE_TTL"],
+                )
+                current_app.extensions[USER_CACHE_EXTENSION] = cache
+    return cache
+
+
+def load_user(user_id: int) -> Mapping | None:
+    """Returns an immutable snapshot of the user, `None` if there is no such user.
+    The session records the version of the user it has seen, the snapshot
+    cached by the process is used, without querying the database, only if
+    it has the same version and is younger than `USER_CACHE_TTL` seconds.
+    An update made by the session bumps the version, so every process sees
+    it right away, updates made elsewhere(another session, a background job,
+    an admin command) are seen once the snapshot expires.
+    """
+    cache = get_user_cache()
+    version = session.get("user_version", None)
+    if cache is not None and version is not None:
+        user = cache.get(user_id)
+        if user is not None and user["version"] == version:
+            inc("hjblog_cache_requests_total", cache="users", result="hit")
+            return user
+        inc("hjblog_cache_requests_total", cache="users", result="miss")
+
+    row = (
+        get_db()
+        .execute(f"SELECT {USER_COLUMNS} FROM users WHERE (id = ?)", (user_id,))
+        .fetchone()
+    )
+    if row is None:
+        return None
+    user = MappingProxyType(dict(row))
+    if cache is not None:
+        cache.set(user_id, user)
+    # the cookie is written only when the version changes
+    if version != user["version"]:
+        session["user_version"] = user["version"]
+    return user
+
+
+def forget_user(user_id: int):
+    """Drops the cached snapshot of the user, it has to be called after
+    every update of the user, that has to bump `users.version` too.
+    """
+    cache = get_user_cache()
+    if cache is not None:
+        cache.delete(user_id)
+    if has_request_context() and session.get("user_id", None) == user_id:
+        session.pop("user_version", None)
+
+
+def skip_user_load(view: Callable[P, str]) -> Callable[P, str]:
+    """Decorator for the views that don't need the logged in user,
+    the user isn't loaded and `g.user` is `None`.
+    """
+    view.skip_user_load = True
+    return view
+
+
 def login_required(view: Callable[P, str]) -> Callable[P, str]:
     """Decorator that forbids to reach a certain page
     if the user is not logged in.
@@ -0,0 +1,30 @@
+from flask_wtf import FlaskForm
+from wtforms import IntegerField, StringField, SubmitField
+from wtforms.validators import DataRequired, Length, NumberRange, Regexp
+
+
+class ProfileWindow(FlaskForm):
+
+    seconds = IntegerField(
+        label="Seconds",
+        validators=[
+            DataRequired(message="Seconds field is required."),
+            NumberRange(
+                min=1, max=600, message="The window has to last 1 to 600 seconds."
+            ),
+        ],
+    )
+    submit = SubmitField(label="Start sampling")
+
+
+class ProfileLink(FlaskForm):
+
+    path = StringField(
+        label="Path",
+        validators=[
+            DataRequired(message="Path field is required."),
+            Length(max=500, message="The path has to be less than 500 characters."),
+            Regexp(r"^/", message="The path has to start with /."),
+        ],
+    )
+    submit = SubmitField(label="Sign link")
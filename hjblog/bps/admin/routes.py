@@ -0,0 +1,85 @@
+from urllib.parse import urlsplit, urlencode
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    flash,
+    g,
+    render_template,
+    send_from_directory,
+)
+
+from hjblog.auxiliaries import admin_only
+from hjblog.bps.admin.forms import ProfileLink, ProfileWindow
+from hjblog.bps.user_profile.auxiliaries import get_profile_pic
+from hjblog.profiling import (
+    PROFILE_ARG,
+    PROFILE_NAME,
+    get_profiles_dir,
+    get_window,
+    list_profiles,
+    sign_path,
+    start_window,
+)
+
+bp = Blueprint("admin", __name__, url_prefix="/admin")
+
+
+@bp.route("/profiler", methods=["GET", "POST"])
+@admin_only
+def profiler():
+    """Profiler route, samples every request served by this process
+    for a window of time, or signs a link that profiles a single request.
+    The profiles are written inside the instance folder, in the collapsed
+    stack format read by flamegraph tools, and can be downloaded from here.
+    """
+    user = g.user
+    window_form = ProfileWindow(prefix="window")
+    link_form = ProfileLink(prefix="link")
+    link = None
+
+    if window_form.submit.data and window_form.validate_on_submit():
+        seconds = window_form.seconds.data
+        if start_window(current_app._get_current_object(), seconds):
+            flash(
+                f"Sampling the requests of this process for {seconds} seconds.",
+                category="alert-success",
+            )
+        else:
+            flash("A sampling window is already open.", category="alert-danger")
+    elif link_form.submit.data and link_form.validate_on_submit():
+        path = urlsplit(link_form.path.data)
+        args = urlencode({PROFILE_ARG: sign_path(path.path, user["id"])})
+        link = f"{path.path}?{args}"
+        if path.query:
+            link = f"{path.path}?{path.query}&{args}"
+
+    for form in (window_form, link_form):
+        for error in form.errors.values():
+            flash(f"{error[0]}", category="alert-danger")
+
+    return render_template(
+        "admin/profiler.html",
+        title="Profiler",
+        current_user=user,
+        profile_pic=get_profile_pic(user["profile_pic"]),
+        window_form=window_form,
+        link_form=link_form,
+        link=link,
+        window=get_window(current_app._get_current_object()),
+        profiles=list_profiles(current_app._get_current_object()),
+    )
+
+
+@bp.route("/profiles/<name>")
+@admin_only
+def download_profile(name: str):
+    """Sends a profile written by the profiler."""
+    if PROFILE_NAME.match(name) is None:
+        abort(404)
+    return send_from_directory(
+        get_profiles_dir(current_app._get_current_object()),
+        name,
+        mimetype="text/plain",
+        as_attachment=True,
+    )
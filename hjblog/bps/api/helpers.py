@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from typing import Iterator
+from sqlite3 import Cursor, Row
+
+from hjblog.bps.general_auxiliaries.auxiliaries import decode_cursor, encode_cursor
+
+
+# Fields a client can select, mapped to the column they are read from
+POST_FIELDS = {
+    "id": "posts.id",
+    "title": "posts.title",
+    "content": "posts.content",
+    "posted": "posts.posted",
+    "author": "users.username",
+    "author_id": "posts.author_id",
+    "comments_count": "posts.comments_count",
+}
+COMMENT_FIELDS = {
+    "id": "comments.id",
+    "post_id": "comments.post_id",
+    "content": "comments.content",
+    "written": "comments.written",
+    "author": "users.username",
+    "author_id": "comments.author_id",
+}
+# Fields returned when the client doesn't select them, listings of posts
+# leave the content out since it is by far the largest column
+DEFAULT_POST_FIELDS = ("id", "title", "posted", "author", "comments_count")
+DEFAULT_COMMENT_FIELDS = tuple(COMMENT_FIELDS)
+# Rows returned per page when the client doesn't ask for a limit, and at most
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def parse_fields(
+    requested: str | None, allowed: dict[str, str], default: tuple[str, ...]
+) -> list[str] | None:
+    """Parses the comma separated list of fields selected by a client,
+    returns `None` if it contains a field that doesn't exist.
+    """
+    if not requested:
+        return list(default)
+    fields = []
+    for field in requested.split(","):
+        field = field.strip()
+        if field not in allowed:
+            return None
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def parse_limit(requested: str | None) -> int | None:
+    """Parses the page size requested by a client, it is capped at
+    `MAX_LIMIT`, `None` is returned if it isn't a positive integer.
+    """
+    if requested is None:
+        return DEFAULT_LIMIT
+    try:
+        limit = int(requested)
+    except ValueError:
+        return None
+    if limit <= 0:
+        return None
+    return min(limit, MAX_LIMIT)
+
+
+def parse_since(requested: str | None) -> str | None | bool:
+    """Parses the ISO 8601 date of the last synchronization of a client,
+    returns it in the format stored by the database(UTC), `None` if it
+    wasn't provided and `False` if it isn't valid.
+    """
+    if not requested:
+        return None
+    try:
+        since = datetime.fromisoformat(requested.replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_cursor(cursor: str | None) -> list | None:
+    """Returns the `(date, id)` keys of the row a page starts after,
+    `None` if the cursor is missing or has been tampered with.
+    """
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        return None
+    _, keys = decoded
+    if len(keys) == 2 and isinstance(keys[0], str) and isinstance(keys[1], int):
+        return keys
+    return None
+
+
+def select(fields: list[str], allowed: dict[str, str], keys: tuple[str, str]) -> str:
+    """Builds the list of columns to select: the requested fields,
+    plus the columns of the keyset(`keys`) the cursor is built from,
+    aliased with a leading underscore.
+    """
+    columns = [f"{allowed[field]} AS {field}" for field in fields]
+    columns.extend(f"{column} AS _{i}" for i, column in enumerate(keys))
+    return ", ".join(columns)
+
+
+def serialize(value):
+    """Encodes the values the JSON encoder doesn't know about,
+    dates are stored in UTC.
+    """
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def encode(value) -> str:
+    return json.dumps(value, default=serialize, separators=(",", ":"))
+
+
+def to_item(row: Row, fields: list[str]) -> dict:
+    return {field: row[field] for field in fields}
+
+
+def cursor_after(row: Row) -> str:
+    """Returns the cursor to the page that starts right after `row`."""
+    return encode_cursor("next", str(row["_0"]), row["_1"])
+
+
+def stream_page(
+    first: Row | None, rows: Cursor, fields: list[str], limit: int
+) -> Iterator[str]:
+    """Encodes a page as `{"data": [...], "next": cursor}` one row at a time,
+    so a large page is never held in memory as a whole.
+    `first` is the first row, already fetched from `rows` before the
+    response started, `rows` has to hold the others, up to `limit + 1`
+    rows in total, the last one only tells if there is a next page.
+    If reading fails after the response started the page is closed with
+    `"error"` instead of `"next"`, so a client can tell it is incomplete.
+    """
+    yield '{"data":['
+    next_cursor = None
+    previous = None
+    row = first
+    sent = 0
+    try:
+        while row is not None:
+            if sent == limit:
+                next_cursor = cursor_after(previous)
+                break
+            yield ("," if sent else "") + encode(to_item(row, fields))
+            previous = row
+            sent += 1
+            row = rows.fetchone()
+    except sqlite3.Error as e:
+        logging.exception(e)
+        yield '],"error":"Internal Server Error"}'
+        return
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        yield '],"error":"Internal Server Error"}'
+        return
+    finally:
+        rows.close()
+    yield '],"next":' + encode(next_cursor) + "}"
+
+
+def make_etag(*parts) -> str:
+    """Builds an ETag out of the values that change along with a resource."""
+    raw = json.dumps(parts, default=str, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
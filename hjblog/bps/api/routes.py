@@ -0,0 +1,259 @@
+import logging
+import sqlite3
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    jsonify,
+    request,
+    stream_with_context,
+)
+
+from hjblog.auxiliaries import skip_user_load
+from hjblog.cache import POSTS
+from hjblog.bps.api.helpers import (
+    COMMENT_FIELDS,
+    DEFAULT_COMMENT_FIELDS,
+    DEFAULT_POST_FIELDS,
+    POST_FIELDS,
+    cursor_after,
+    encode,
+    make_etag,
+    parse_cursor,
+    parse_fields,
+    parse_limit,
+    parse_since,
+    select,
+    stream_page,
+    to_item,
+)
+from hjblog.db import get_db
+
+
+"""
+Read-only JSON API, every listing is paginated through the opaque
+cursor `cursor`, returns at most `limit` rows, only the fields selected
+through `fields` and, with `since`(ISO 8601), only the rows published
+after that date, so a client can synchronize incrementally.
+Every response carries an ETag, a conditional request is answered
+with 304 before the data is read.
+"""
+
+bp = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Columns the listings are ordered by, the cursors are built from them
+POST_KEYS = ("posts.posted", "posts.id")
+COMMENT_KEYS = ("comments.written", "comments.id")
+
+
+@bp.errorhandler(400)
+@bp.errorhandler(404)
+@bp.errorhandler(500)
+def error(e):
+    return jsonify(error=e.description), e.code
+
+
+def get_params(
+    allowed: dict[str, str], default: tuple[str, ...]
+) -> tuple[list[str], int, str | None, list | None]:
+    """Returns the fields, the limit, the `since` date and the keys of
+    the cursor requested by the client, aborts with 400 if they aren't valid.
+    """
+    fields = parse_fields(request.args.get("fields", None), allowed, default)
+    if fields is None:
+        abort(400, f"Unknown field, the fields are: {', '.join(allowed)}")
+    limit = parse_limit(request.args.get("limit", None))
+    if limit is None:
+        abort(400, "limit has to be a positive integer")
+    since = parse_since(request.args.get("since", None))
+    if since is False:
+        abort(400, "since has to be an ISO 8601 date")
+    return fields, limit, since, parse_cursor(request.args.get("cursor", None))
+
+
+def conditional(etag: str) -> Response | None:
+    """Returns the 304 response if the client already holds
+    the version `etag` of the resource.
+    """
+    # weak comparison, a compressed response carries the ETag as weak
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def stream(rows: sqlite3.Cursor, fields: list[str], limit: int, etag: str):
+    """Streams the page held by `rows`, the first row is read before the
+    response starts, so a query that fails is still answered with 500.
+    """
+    try:
+        first = rows.fetchone()
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        abort(500)
+    response = Response(
+        stream_with_context(stream_page(first, rows, fields, limit)),
+        mimetype="application/json",
+    )
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def get_post_etag(post_id: int) -> str:
+    """Returns the ETag of a post and of its comments, it depends on the id
+    of the post, the number of its comments, when the latest one was
+    written, read through the index on `(post_id, written)`, and on the
+    `POSTS` generation, bumped when an author changes username.
+    Aborts with 404 if there is no such post.
+    """
+    try:
+        version = (
+            get_db()
+            .execute(
+                "SELECT posts.id, posts.comments_count, (SELECT MAX(comments.written) FROM comments WHERE (comments.post_id = posts.id)), (SELECT value FROM cache_generations WHERE (name = ?)) FROM posts WHERE (posts.id = ?)",
+                (POSTS, post_id),
+            )
+            .fetchone()
+        )
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
+    if version is None:
+        abort(404, "No such post")
+    return make_etag(*version)
+
+
+@bp.route("/posts")
+@skip_user_load
+def posts():
+    """Posts, newest first, `content` is returned only if selected."""
+    fields, limit, since, keys = get_params(POST_FIELDS, DEFAULT_POST_FIELDS)
+    db = get_db()
+
+    try:
+        # the counters are kept by triggers, this doesn't scan any table,
+        # the `POSTS` generation is bumped when an author changes username
+        version = db.execute(
+            "SELECT (SELECT MAX(id) FROM posts), (SELECT MAX(id) FROM comments), posts_count, comments_count, (SELECT value FROM cache_generations WHERE (name = ?)) FROM site_stats",
+            (POSTS,),
+        ).fetchone()
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
+    etag = make_etag(*(version or ()))
+    not_modified = conditional(etag)
+    if not_modified is not None:
+        return not_modified
+
+    conditions = []
+    params = []
+    if since is not None:
+        conditions.append("(posts.posted > ?)")
+        params.append(since)
+    if keys is not None:
+        conditions.append("((posts.posted, posts.id) < (?, ?))")
+        params.extend(keys)
+    query = f"SELECT {select(fields, POST_FIELDS, POST_KEYS)} FROM posts JOIN users ON (users.id = posts.author_id)"
+    if conditions:
+        query = query + " WHERE " + " AND ".join(conditions)
+    query = query + " ORDER BY posts.posted DESC, posts.id DESC LIMIT (?)"
+    params.append(limit + 1)
+
+    try:
+        rows = db.execute(query, params)
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        abort(500)
+
+    return stream(rows, fields, limit, etag)
+
+
+@bp.route("/posts/<int:post_id>")
+@skip_user_load
+def post(post_id: int):
+    """A single post with every field, along with the first `limit`
+    comments(oldest first) and the cursor to the following ones.
+    """
+    fields, limit, _, _ = get_params(COMMENT_FIELDS, DEFAULT_COMMENT_FIELDS)
+    etag = get_post_etag(post_id)
+    not_modified = conditional(etag)
+    if not_modified is not None:
+        return not_modified
+
+    db = get_db()
+    try:
+        post = db.execute(
+            f"SELECT {select(list(POST_FIELDS), POST_FIELDS, ())} FROM posts JOIN users ON (users.id = posts.author_id) WHERE (posts.id = ?)",
+            (post_id,),
+        ).fetchone()
+        comments = db.execute(
+            f"SELECT {select(fields, COMMENT_FIELDS, COMMENT_KEYS)} FROM comments JOIN users ON (users.id = comments.author_id) WHERE (comments.post_id = ?) ORDER BY comments.written, comments.id LIMIT (?)",
+            (post_id, limit + 1),
+        ).fetchall()
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        abort(500)
+
+    body = to_item(post, list(POST_FIELDS))
+    body["comments"] = [to_item(row, fields) for row in comments[:limit]]
+    body["comments_next"] = None
+    if len(comments) > limit:
+        body["comments_next"] = cursor_after(comments[limit - 1])
+
+    response = Response(encode(body), mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.route("/posts/<int:post_id>/comments")
+@skip_user_load
+def comments(post_id: int):
+    """Comments of a post, oldest first, so a client can keep reading
+    from the last cursor(or the date of the last comment it holds)
+    to receive only the new ones.
+    """
+    fields, limit, since, keys = get_params(COMMENT_FIELDS, DEFAULT_COMMENT_FIELDS)
+    etag = get_post_etag(post_id)
+    not_modified = conditional(etag)
+    if not_modified is not None:
+        return not_modified
+
+    conditions = ["(comments.post_id = ?)"]
+    params: list = [post_id]
+    if since is not None:
+        conditions.append("(comments.written > ?)")
+        params.append(since)
+    if keys is not None:
+        conditions.append("((comments.written, comments.id) > (?, ?))")
+        params.extend(keys)
+    params.append(limit + 1)
+
+    try:
+        rows = get_db().execute(
+            f"SELECT {select(fields, COMMENT_FIELDS, COMMENT_KEYS)} FROM comments JOIN users ON (users.id = comments.author_id) WHERE {' AND '.join(conditions)} ORDER BY comments.written, comments.id LIMIT (?)",
+            params,
+        )
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        abort(500)
+
+    return stream(rows, fields, limit, etag)
@@ -9,6 +9,7 @@ from flask import (
     flash,
     redirect,
     render_template,
+    request,
     url_for,
     session,
     g,
@@ -17,7 +18,13 @@ from werkzeug.security import check_password_hash, generate_password_hash
 
 from hjblog.bps.user_actions.auxiliaries import Coordinates
 from hjblog.db import get_db
-from hjblog.auxiliaries import login_forbidden, login_required, login_user, logout_user
+from hjblog.auxiliaries import (
+    load_user,
+    login_forbidden,
+    login_required,
+    login_user,
+    logout_user,
+)
 from .forms import LogInForm, RegisterForm, VerifyForm, VerifyForm2FA
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
@@ -199,17 +206,16 @@ def load_logged_in_user():
     the view function, no matter what URL is requested, even
     on views that aren't in this specific blueprint
     """
+    # Static files and uploads don't need the user
+    view = current_app.view_functions.get(request.endpoint, None)
+    if request.endpoint == "static" or getattr(view, "skip_user_load", False):
+        g.user = None
+        return
+
     # TODO: error handling on the database query
     user_id = session.get("user_id")
 
     if user_id is None:
         g.user = None
     else:
-        g.user = (
-            get_db()
-            .execute(
-                "SELECT id, username, email, city_id, is_admin, is_two_factor_authentication_enabled, secret_token, profile_pic, hash_pass FROM users WHERE id = ?",
-                (user_id,),
-            )
-            .fetchone()
-        )
+        g.user = load_user(user_id)
@@ -1,6 +1,7 @@
 from flask import g, render_template, Blueprint
 
 from hjblog.bps.user_profile.auxiliaries import get_profile_pic
+from hjblog.metrics import inc
 
 """
 Error handlers
@@ -11,6 +12,7 @@ bp = Blueprint("errors", __name__)
 
 @bp.app_errorhandler(400)
 def error_400(__error__):
+    inc("hjblog_errors_total", status=400)
     user = g.get("user", None)
     profile_pic = None
     if user is not None:
@@ -22,6 +24,7 @@ def error_400(__error__):
 
 @bp.app_errorhandler(404)
 def error_404(__error__):
+    inc("hjblog_errors_total", status=404)
     user = g.get("user", None)
     profile_pic = None
     if user is not None:
@@ -34,6 +37,7 @@ def error_404(__error__):
 
 @bp.app_errorhandler(403)
 def error_403(__error__):
+    inc("hjblog_errors_total", status=403)
     user = g.get("user", None)
     profile_pic = None
     if user is not None:
@@ -46,6 +50,7 @@ def error_403(__error__):
 
 @bp.app_errorhandler(500)
 def error_500(__error__):
+    inc("hjblog_errors_total", status=500)
     user = g.get("user", None)
     profile_pic = None
     if user is not None:
@@ -1,3 +1,6 @@
+import base64
+import binascii
+import json
 import logging
 from flask import request
 
@@ -39,13 +42,13 @@ def get_indexes(page_span: int, max_page: int) -> tuple[int, int, int]:
     return index, prev_pages, next_pages
 
 
-def get_offset(o: str | None) -> tuple[int, int]:
+def get_offset(o: str | None, chunk_size: int) -> tuple[int, int]:
     """This function is used to create the values necessaries for
     creating the correct pagination. It checks if the `o` variable has been passed
     correctly to the caller function, `o` represent a chunk of the total amount of elements,
     `offset` are the elements that will be skipped for the display:
-    100 element are loaded per run, meaning that if we are at
-    chunk 2(the third one) we need to skip the first `offset` * 2
+    `chunk_size` element are loaded per run, meaning that if we are at
+    chunk 2(the third one) we need to skip the first `chunk_size` * 2
     (the value of `o`) elements.
     If `o` wasn't passed or the value has been provided incorrectly a default
     value of 0 (which is functional) is passed
@@ -62,5 +65,39 @@ def get_offset(o: str | None) -> tuple[int, int]:
         o = 0
     if o < 0:
         o = 0
-    offset = o * 100
+    offset = o * chunk_size
     return o, offset
+
+
+def encode_cursor(direction: str, *keys: str | int | float) -> str:
+    """Builds an opaque cursor used by keyset pagination: `direction` tells
+    in which direction the next page has to be read("next" or "prev"),
+    `keys` are the values of the ordering columns of the boundary row,
+    the following page starts right after that row.
+    """
+    raw = json.dumps([direction, *keys], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str | None) -> tuple[str, list] | None:
+    """Decodes a cursor built by `encode_cursor`, returns the direction and
+    the list of keys, `None` is returned if the cursor wasn't provided or if
+    it has been tampered with.
+    """
+    if not cursor:
+        return None
+    padding = "=" * (-len(cursor) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(cursor + padding).decode("utf-8")
+        decoded = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    except Exception as e:
+        logging.exception(e)
+        return None
+    if not isinstance(decoded, list) or len(decoded) < 2:
+        return None
+    direction = decoded[0]
+    if direction not in ("next", "prev"):
+        return None
+    return direction, decoded[1:]
@@ -1,5 +1,6 @@
 # Amount of posts that will be displayed per page
 MAX_PER_PAGE: int = 5
-# Number used to calculate the page indexes that will be
-# displayed on the pages
-PAGE_SPAN: int = 3
+# Amount of search results that will be displayed per page
+SEARCH_PER_PAGE: int = 10
+# Longest search query accepted, in characters
+SEARCH_MAX_LENGTH: int = 200
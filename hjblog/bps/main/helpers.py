@@ -1,47 +1,190 @@
-from datetime import datetime
-from sqlite3 import Connection, Cursor
+import re
+from sqlite3 import Connection, Row
+
+from markupsafe import Markup, escape
+
+from hjblog.bps.general_auxiliaries.auxiliaries import decode_cursor, encode_cursor
 from hjblog.db import get_db
 
 
+POSTS_QUERY = "SELECT users.username, posts.id, posts.title, posts.content, posts.path_to_file, posts.posted FROM posts JOIN users ON (users.id = posts.author_id)"
+
+
 def get_posts(
-    index: int,
     max_per_page: int,
+    cursor: str | None = None,
     author_id: int | None = None,
-    offset: int | None = None,
-) -> list[dict[str, str | str, datetime]]:
-    """Given specific parameters returns the correct posts that will be displayed
-    inside a page, if `author_id` is passed only posts relative to that specific
-    author will be taken into consideration, if `offset` is passed first `offset`
-    results will be skipped.
+) -> tuple[list[Row], str | None, str | None]:
+    """Given specific parameters returns the posts that will be displayed
+    inside a page, the cursor to the next(older) page and the cursor
+    to the previous(newer) page, a cursor is `None` if there isn't such a page.
+    Pagination is keyset based: posts are ordered by `(posted, id)` and
+    a page starts right after the row encoded in `cursor`, so the database
+    only seeks the boundary and reads `max_per_page` rows(plus one, used to
+    know if there are more), no matter how deep the page is.
+    If `author_id` is passed only posts relative to that specific
+    author will be taken into consideration.
     """
     db: Connection = get_db()
-    batch: Cursor = None
-    posts = None
+    direction = "next"
+    boundary = None
 
+    decoded = decode_cursor(cursor)
+    if decoded is not None:
+        direction, keys = decoded
+        if len(keys) == 2 and isinstance(keys[0], str) and isinstance(keys[1], int):
+            boundary = keys
+        else:
+            direction = "next"
+
+    conditions = []
+    params = []
     if author_id:
-        if offset:
-            batch = db.execute(
-                "SELECT users.username, posts.id, posts.title, posts.content, posts.path_to_file, posts.posted FROM posts JOIN users ON (users.id = posts.author_id) WHERE (posts.author_id = ?) ORDER BY posts.posted DESC, posts.id DESC LIMIT (100) OFFSET (?)",
-                (author_id, offset),
-            )
+        conditions.append("(posts.author_id = ?)")
+        params.append(author_id)
+    if boundary is not None:
+        if direction == "next":
+            conditions.append("((posts.posted, posts.id) < (?, ?))")
         else:
-            batch = db.execute(
-                "SELECT users.username, posts.id, posts.title, posts.content, posts.path_to_file, posts.posted FROM posts JOIN users ON (users.id = posts.author_id) WHERE (posts.author_id = ?) ORDER BY posts.posted DESC, posts.id DESC LIMIT 100",
-                (author_id,),
-            )
-    else:
-        if offset:
-            batch = db.execute(
-                "SELECT users.username, posts.id, posts.title, posts.content, posts.path_to_file, posts.posted FROM posts JOIN users ON (users.id = posts.author_id) ORDER BY posts.posted DESC, posts.id DESC LIMIT (100) OFFSET (?)",
-                (offset,),
-            )
+            conditions.append("((posts.posted, posts.id) > (?, ?))")
+        params.extend(boundary)
+
+    # reading backwards means reading the newer posts in ascending order,
+    # the rows are reversed afterwards
+    order = "DESC" if direction == "next" else "ASC"
+    query = POSTS_QUERY
+    if conditions:
+        query = query + " WHERE " + " AND ".join(conditions)
+    query = query + f" ORDER BY posts.posted {order}, posts.id {order} LIMIT (?)"
+    params.append(max_per_page + 1)
+
+    posts = db.execute(query, params).fetchall()
+    more = len(posts) > max_per_page
+    posts = posts[:max_per_page]
+    if direction == "prev":
+        posts.reverse()
+
+    next_cursor = None
+    prev_cursor = None
+    if posts:
+        first = posts[0]
+        last = posts[-1]
+        if direction == "next":
+            if more:
+                next_cursor = encode_cursor("next", str(last["posted"]), last["id"])
+            if boundary is not None:
+                prev_cursor = encode_cursor("prev", str(first["posted"]), first["id"])
         else:
-            batch = db.execute(
-                "SELECT users.username, posts.id, posts.title, posts.content, posts.path_to_file, posts.posted FROM posts JOIN users ON (users.id = posts.author_id) ORDER BY posts.posted DESC, posts.id DESC LIMIT 100"
-            )
-    for _ in range(0, index + 1):
-        posts = batch.fetchmany(max_per_page)
-        if len(posts) == 0:
-            break
-
-    return posts
+            if more:
+                prev_cursor = encode_cursor("prev", str(first["posted"]), first["id"])
+            next_cursor = encode_cursor("next", str(last["posted"]), last["id"])
+
+    return posts, next_cursor, prev_cursor
+
+
+def get_posts_count() -> int:
+    """Returns the number of posts, read from the counter kept
+    by the triggers on `posts` instead of scanning the table.
+    """
+    row = (
+        get_db()
+        .execute("SELECT posts_count FROM site_stats WHERE (id = 1)")
+        .fetchone()
+    )
+    if row is None:
+        return 0
+    return row["posts_count"]
+
+
+# Words of a search query, everything else is treated as a separator
+SEARCH_TERM = re.compile(r"\w+", re.UNICODE)
+# Shortest word matched as a prefix, the indexes store the prefixes of this length
+SEARCH_MIN_PREFIX = 3
+# Delimiters of the matches inside a snippet, they can't be typed by a user
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# The page of results is selected from the index alone(`{keyset}` narrows
+# it to the results after the cursor), only its rows are joined and snippeted:
+# CROSS JOIN keeps the page as the outer loop, so the index is then looked
+# up by rowid instead of being matched again
+SEARCH_QUERIES = {
+    "posts": "SELECT page.id, page.rank, posts.id AS post_id, posts.title, posts.posted, users.username, snippet(posts_fts, -1, char(2), char(3), '…', 16) AS snippet FROM (SELECT rowid AS id, rank FROM posts_fts WHERE (posts_fts MATCH ?){keyset} ORDER BY rank, rowid LIMIT (?)) AS page CROSS JOIN posts_fts ON (posts_fts.rowid = page.id) JOIN posts ON (posts.id = page.id) JOIN users ON (users.id = posts.author_id) WHERE (posts_fts MATCH ?) ORDER BY page.rank, page.id",
+    "comments": "SELECT page.id, page.rank, comments.post_id AS post_id, posts.title, comments.written AS posted, users.username, snippet(comments_fts, 0, char(2), char(3), '…', 16) AS snippet FROM (SELECT rowid AS id, rank FROM comments_fts WHERE (comments_fts MATCH ?){keyset} ORDER BY rank, rowid LIMIT (?)) AS page CROSS JOIN comments_fts ON (comments_fts.rowid = page.id) JOIN comments ON (comments.id = page.id) JOIN posts ON (posts.id = comments.post_id) JOIN users ON (users.id = comments.author_id) WHERE (comments_fts MATCH ?) ORDER BY page.rank, page.id",
+}
+
+
+def build_match_query(text: str) -> str | None:
+    """Turns the text typed by a user into an FTS5 query: every word is
+    quoted, so the FTS5 syntax can't be injected, the words are required
+    to appear all and the last one is matched as a prefix(if it is at least
+    `SEARCH_MIN_PREFIX` characters long, shorter prefixes match too many
+    terms), so results show up while a word is still being typed.
+    Returns `None` if `text` has no words.
+    """
+    terms = SEARCH_TERM.findall(text)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if len(terms[-1]) >= SEARCH_MIN_PREFIX:
+        quoted[-1] = quoted[-1] + "*"
+    return " ".join(quoted)
+
+
+def highlight(snippet: str) -> Markup:
+    """Escapes a snippet returned by FTS5 and wraps its matches in `<mark>`."""
+    return Markup(
+        str(escape(snippet))
+        .replace(MATCH_START, "<mark>")
+        .replace(MATCH_END, "</mark>")
+    )
+
+
+def search(
+    text: str,
+    scope: str,
+    max_per_page: int,
+    cursor: str | None = None,
+) -> tuple[list[dict], str | None]:
+    """Searches `text` inside the posts(title and content) or inside the
+    comments, depending on `scope`("posts" or "comments"), returns the
+    results of a page and the cursor to the next page, `None` if there
+    isn't such a page.
+    Results are ranked with bm25(best first), ties are broken by id;
+    pagination is keyset based on `(rank, id)`. The page is ranked and
+    limited on the index alone, only its rows are then joined with the
+    posts, comments and users and snippeted.
+    """
+    match = build_match_query(text)
+    if match is None:
+        return [], None
+
+    keyset = ""
+    params: list = [match]
+    decoded = decode_cursor(cursor)
+    if decoded is not None:
+        _, keys = decoded
+        if (
+            len(keys) == 2
+            and isinstance(keys[0], (int, float))
+            and isinstance(keys[1], int)
+        ):
+            keyset = " AND ((rank, rowid) > (?, ?))"
+            params.extend(keys)
+    params.extend((max_per_page + 1, match))
+    query = SEARCH_QUERIES[scope].format(keyset=keyset)
+
+    rows = get_db().execute(query, params).fetchall()
+    more = len(rows) > max_per_page
+    rows = rows[:max_per_page]
+
+    results = []
+    for row in rows:
+        result = dict(row)
+        result["snippet"] = highlight(row["snippet"])
+        results.append(result)
+
+    next_cursor = None
+    if more:
+        next_cursor = encode_cursor("next", rows[-1]["rank"], rows[-1]["id"])
+    return results, next_cursor
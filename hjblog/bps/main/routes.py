@@ -1,19 +1,29 @@
+import hashlib
+import mimetypes
+import sqlite3
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from urllib.parse import quote
 from flask import (
     Blueprint,
     abort,
     current_app,
-    flash,
     g,
-    redirect,
     render_template,
     request,
     send_from_directory,
     url_for,
 )
 from flask_wtf.csrf import logging
-from hjblog.bps.main.globals import MAX_PER_PAGE, PAGE_SPAN
-from hjblog.bps.main.helpers import get_posts
-from hjblog.bps.general_auxiliaries.auxiliaries import get_indexes, get_offset
+from werkzeug.security import safe_join
+from hjblog.auxiliaries import skip_user_load
+from hjblog.cache import POSTS, cached, cached_fragment
+from hjblog.bps.main.globals import (
+    MAX_PER_PAGE,
+    SEARCH_MAX_LENGTH,
+    SEARCH_PER_PAGE,
+)
+from hjblog.bps.main.helpers import get_posts, get_posts_count, search
 
 from hjblog.bps.user_profile.auxiliaries import get_profile_pic
 from hjblog.db import get_db
@@ -25,102 +35,237 @@ bp = Blueprint("index", __name__)
 @bp.route("/")
 @bp.route("/index")
 def index():
-    """Home route"""
-
-    db = get_db()
+    """Home route, the list of the latest posts is rendered once
+    and served from the fragment cache until a post changes.
+    """
     user = g.get("user", None)
     profile_pic = None
     if user is not None:
         profile_pic = get_profile_pic(user["profile_pic"])
 
-    posts = db.execute(
-        "SELECT users.username, posts.id, posts.title, posts.content, posts.path_to_file, posts.posted FROM posts JOIN users ON (users.id = posts.author_id) ORDER BY posts.posted DESC, posts.id DESC LIMIT 7"
-    ).fetchall()
+    latest_posts = cached_fragment("index.latest_posts", POSTS, render_latest_posts)
 
     return render_template(
         "main/index.html",
         title="Home",
         current_user=user,
-        posts=posts,
-        len=len(posts),
+        latest_posts=latest_posts,
         profile_pic=profile_pic,
     )
 
 
+def render_latest_posts() -> str:
+    """Renders the list of the latest posts displayed in the home page."""
+    db = get_db()
+    posts = db.execute(
+        "SELECT users.username, posts.id, posts.title, posts.content, posts.path_to_file, posts.posted FROM posts JOIN users ON (users.id = posts.author_id) ORDER BY posts.posted DESC, posts.id DESC LIMIT 7"
+    ).fetchall()
+    return render_template("includes/latest_posts.html", posts=posts, len=len(posts))
+
+
 @bp.route("/blog")
 def blog():
-    """Blog route"""
-    db = get_db()
+    """Blog route, posts are paginated through the opaque cursor `c`."""
     user = g.get("user", None)
     profile_pic = None
     if user is not None:
         profile_pic = get_profile_pic(user["profile_pic"])
 
-    more_posts = False
-
-    # variable used to manage the functionality
-    # of displaying older posts
-    o = request.args.get("o", None)
-    o, offset = get_offset(o)
+    cursor = request.args.get("c", None)
 
-    # max amount of post that you can have per page
-    max_per_page = MAX_PER_PAGE
-    # amount of pages that will be displayed into the imagination
-    page_span = PAGE_SPAN
-
-    # maximum page index, for inpagination
-    max_page = None
     try:
-        count = (
-            int(db.execute("SELECT COUNT(id) FROM posts;").fetchone()["COUNT(id)"])
-            - offset
-        )
-        if count > 99:
-            count = 99
-            more_posts = True
-        max_page = count // max_per_page
-    except TypeError:
-        if offset > 0:
-            flash("There aren't any more posts.", category="alert-danger")
-            return redirect(url_for("main.blog"))
+        posts, next_cursor, prev_cursor = get_posts(MAX_PER_PAGE, cursor=cursor)
+        total_posts = get_posts_count()
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
     except Exception as e:
+        # Unexpected behaviour
         logging.exception(e)
         abort(500)
 
-    if max_page is None:
-        return render_template(
-            "main/blog.html",
-            title="Home",
-            current_user=user,
-            posts=None,
-            prev_pages=0,
-            next_pages=0,
-            current_page=0,
-            pages=0,
-            o=o,
-            more_posts=more_posts,
-            profile_pic=profile_pic,
-        )
-
-    index, prev_pages, next_pages = get_indexes(page_span, max_page)
-
-    posts = get_posts(index, max_per_page, offset=offset)
-
     return render_template(
         "main/blog.html",
         title="Home",
         current_user=user,
         posts=posts,
-        prev_pages=prev_pages,
-        next_pages=next_pages,
-        current_page=index,
-        pages=max_page,
-        o=o,
-        more_posts=more_posts,
+        cursor=cursor,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+        total_posts=total_posts,
         profile_pic=profile_pic,
     )
 
-@bp.route("/uploads/<string:pic_name>")
+
+@bp.route("/search")
+def search_posts():
+    """Search route, looks for the words of `q` inside the posts or, if `s`
+    is "comments", inside the comments, results are paginated through
+    the opaque cursor `c`.
+    """
+    user = g.get("user", None)
+    profile_pic = None
+    if user is not None:
+        profile_pic = get_profile_pic(user["profile_pic"])
+
+    query = request.args.get("q", "").strip()[:SEARCH_MAX_LENGTH]
+    scope = request.args.get("s", "posts")
+    if scope not in ("posts", "comments"):
+        scope = "posts"
+    cursor = request.args.get("c", None)
+
+    results = []
+    next_cursor = None
+    if query:
+        try:
+            results, next_cursor = search(
+                query, scope, SEARCH_PER_PAGE, cursor=cursor
+            )
+        except sqlite3.Error as e:
+            logging.exception(e)
+            abort(500)
+        except Exception as e:
+            # Unexpected behaviour
+            logging.exception(e)
+            abort(500)
+
+    return render_template(
+        "main/search.html",
+        title="Search",
+        current_user=user,
+        query=query,
+        scope=scope,
+        results=results,
+        cursor=cursor,
+        next_cursor=next_cursor,
+        profile_pic=profile_pic,
+    )
+
+
+# Feeds served, with their template, their mimetype and how they format a date
+FEEDS = {
+    "atom": (
+        "feeds/atom.xml",
+        "application/atom+xml",
+        lambda date: date.isoformat().replace("+00:00", "Z"),
+    ),
+    "rss": ("feeds/rss.xml", "application/rss+xml", format_datetime),
+}
+
+
+@bp.route("/feed.atom")
+@skip_user_load
+def feed_atom():
+    """Atom feed of the latest posts."""
+    return serve_feed("atom")
+
+
+@bp.route("/feed.rss")
+@skip_user_load
+def feed_rss():
+    """RSS feed of the latest posts."""
+    return serve_feed("rss")
+
+
+def serve_feed(kind: str):
+    """Serves the feed `kind` of the latest `FEED_SIZE` posts.
+    Feeds are polled over and over by feed readers, so the generated bytes
+    are kept in the fragment cache until a post changes, and a reader that
+    sends back the `ETag`(the hash of the feed) or the `Last-Modified` date
+    it received is answered with a 304 if nothing changed.
+    The cache is invalidated for every worker(the generations are kept in
+    the database) within `FRAGMENT_CACHE_GENERATION_TTL` seconds, after that
+    all the workers serve the same bytes and the same `ETag`.
+    """
+    try:
+        # the feed contains absolute URLs, so the key includes the host
+        # the feed was requested through
+        data = cached(
+            f"feed.{kind}:{request.host}", POSTS, lambda: render_feed(kind)
+        )
+        updated = cached("feed.updated", POSTS, get_last_update)
+    except sqlite3.Error as e:
+        logging.exception(e)
+        abort(500)
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        abort(500)
+
+    response = current_app.response_class(data, mimetype=FEEDS[kind][1])
+    response.set_etag(hashlib.sha256(data).hexdigest()[:32])
+    if updated:
+        response.last_modified = datetime.fromisoformat(updated)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["FEED_MAX_AGE"]
+    return response.make_conditional(request)
+
+
+def get_last_update() -> str:
+    """Returns when the latest post was published(ISO 8601, UTC),
+    an empty string if there are no posts.
+    """
+    row = get_db().execute("SELECT MAX(posted) AS posted FROM posts").fetchone()
+    if row["posted"] is None:
+        return ""
+    # an aggregate isn't converted by the declared type of the column
+    posted = datetime.fromisoformat(row["posted"])
+    return posted.replace(tzinfo=timezone.utc).isoformat()
+
+
+def render_feed(kind: str) -> bytes:
+    """Renders the feed `kind` from the same query that paginates the blog."""
+    template, _, format_date = FEEDS[kind]
+    posts, _, _ = get_posts(current_app.config["FEED_SIZE"])
+    updated = get_last_update()
+    entries = [
+        {
+            "title": post["title"],
+            "content": post["content"],
+            "username": post["username"],
+            "posted": format_date(post["posted"].replace(tzinfo=timezone.utc)),
+            "url": url_for("user.visit_post", index=post["id"], _external=True),
+        }
+        for post in posts
+    ]
+    if updated:
+        updated = format_date(datetime.fromisoformat(updated))
+    else:
+        updated = format_date(datetime.now(timezone.utc))
+    return render_template(template, posts=entries, updated=updated).encode("utf-8")
+
+
+@bp.route("/uploads/<path:pic_name>")
+@skip_user_load
 def profile_pictures(pic_name: str):
-    """View that serves a profile picture using `send_from_directory` function from `UPLOAD_DIR`."""
-    return send_from_directory(current_app.config["UPLOAD_DIR"], pic_name)
+    """View that serves a profile picture from `UPLOAD_DIR`.
+    Uploaded files are named after their content and never change, so they
+    can be cached by the browser for `UPLOADS_MAX_AGE` seconds without being
+    revalidated, the name is used as a strong ETag, so a conditional request
+    is answered with 304 on every host that serves the same files.
+    If `UPLOADS_ACCEL_REDIRECT` is set the transfer of the file is left
+    to nginx through `X-Accel-Redirect`, if `USE_X_SENDFILE` is set it is left
+    to the server through `X-Sendfile`.
+    """
+    max_age = current_app.config["UPLOADS_MAX_AGE"]
+    accel_redirect = current_app.config["UPLOADS_ACCEL_REDIRECT"]
+    if accel_redirect:
+        if safe_join(current_app.config["UPLOAD_DIR"], pic_name) is None:
+            abort(404)
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(pic_name)[0] or "application/octet-stream"
+        )
+        response.set_etag(pic_name)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.make_conditional(request)
+        if response.status_code == 200:
+            response.headers["X-Accel-Redirect"] = (
+                accel_redirect.rstrip("/") + "/" + quote(pic_name)
+            )
+    else:
+        response = send_from_directory(
+            current_app.config["UPLOAD_DIR"], pic_name, etag=pic_name, max_age=max_age
+        )
+    response.cache_control.immutable = True
+    return response
@@ -1,9 +1,522 @@
+import copy
+import json
+import os
 import sqlite3
-from flask import flash
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+from urllib.parse import urlencode, urlparse
+from flask import current_app, flash, g
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 
-from hjblog.db import get_db
+from hjblog.db import apply_pragmas, get_db
+from hjblog.instrumentation import UPSTREAM, timed
+from hjblog.metrics import LATENCY_BUCKETS, inc, observe
+
+
+GEOCODING_URL = "https://geocoding-api.open-meteo.com/v1/search"
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+HTTP_SESSION_EXTENSION = "hjblog.weather_http_session"
+FORECAST_CACHE_EXTENSION = "hjblog.forecast_cache"
+SINGLE_FLIGHT_EXTENSION = "hjblog.single_flight"
+BREAKERS_EXTENSION = "hjblog.upstream_breakers"
+_http_session_lock = threading.Lock()
+_forecast_cache_lock = threading.Lock()
+_single_flight_lock = threading.Lock()
+_breakers_lock = threading.Lock()
+# Gateway errors worth another attempt
+RETRY_STATUSES = (502, 503, 504)
+# Seconds before the first retry, doubled at every attempt
+RETRY_BACKOFF = 0.1
+
+
+def get_http_session() -> requests.Session:
+    """Returns the HTTP session shared by the whole weather subsystem,
+    connections to the backend are kept alive and reused between requests.
+    Failed calls are retried by `_request_json`, within the latency budget.
+    """
+    http_session = current_app.extensions.get(HTTP_SESSION_EXTENSION, None)
+    if http_session is None:
+        with _http_session_lock:
+            http_session = current_app.extensions.get(HTTP_SESSION_EXTENSION, None)
+            if http_session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=2,
+                    pool_maxsize=current_app.config["WEATHER_HTTP_POOL_SIZE"],
+                    # NOTE: urllib3 would give every retry the full timeout
+                    max_retries=0,
+                )
+                http_session = requests.Session()
+                http_session.mount("https://", adapter)
+                http_session.mount("http://", adapter)
+                current_app.extensions[HTTP_SESSION_EXTENSION] = http_session
+    return http_session
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls made inside the process: the first
+    caller of a key(the leader) executes the call, the callers that arrive
+    while it is in flight wait for it and receive the same result.
+    `executed` counts the calls executed, `coalesced` the calls
+    that shared the result of another one, `shared_coalesced` the calls
+    that shared the result of a call made by another process.
+    The counters of `upstream_flight_stats` are kept in `pending` until
+    they are flushed, see `flush_flight_stats`.
+    """
+
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self.shared_coalesced = 0
+        self.pending: dict[str, int] = {}
+        self.flushed = time.monotonic()
+        self._calls: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def do(
+        self, key: str, call: Callable[[], object], timeout: float | None = None
+    ) -> tuple[object, bool]:
+        """Returns the result of `call` and `True` if the result was shared
+        with a call already in flight, exceptions are shared too.
+        A caller that waits for a call in flight for more than `timeout`
+        seconds gets a `TimeoutError`.
+        """
+        with self._lock:
+            flight = self._calls.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = flight
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight["done"].wait(timeout):
+                raise TimeoutError(f"Call {key} still in flight after {timeout}s")
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["result"], True
+
+        try:
+            flight["result"] = call()
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            flight["done"].set()
+        return flight["result"], False
+
+    def record(self, name: str):
+        with self._lock:
+            self.pending[name] = self.pending.get(name, 0) + 1
+
+    def take_pending(self) -> dict[str, int]:
+        """Returns the counters recorded since the last call and resets them."""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            self.flushed = time.monotonic()
+        return pending
+
+    def restore_pending(self, pending: dict[str, int]):
+        """Gives back counters that couldn't be flushed."""
+        with self._lock:
+            for name, value in pending.items():
+                self.pending[name] = self.pending.get(name, 0) + value
+
+
+def get_single_flight() -> SingleFlight:
+    """Returns the single-flight layer of the application."""
+    single_flight = current_app.extensions.get(SINGLE_FLIGHT_EXTENSION, None)
+    if single_flight is None:
+        with _single_flight_lock:
+            single_flight = current_app.extensions.get(SINGLE_FLIGHT_EXTENSION, None)
+            if single_flight is None:
+                single_flight = SingleFlight()
+                current_app.extensions[SINGLE_FLIGHT_EXTENSION] = single_flight
+    return single_flight
+
+
+class CircuitBreaker:
+    """Guards the calls made to a backend. While `closed` every call goes
+    through, after `max_failures` consecutive failures the breaker opens
+    and for `recovery` seconds calls fail fast without touching the network.
+    After that the breaker is `half-open`: a single trial call goes through,
+    if it succeeds the breaker is closed again, otherwise it is opened
+    for another `recovery` seconds.
+    `on_change` is called with the breaker every time the state changes,
+    `rejected` counts the calls that failed fast.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        name: str,
+        max_failures: int,
+        recovery: float,
+        on_change: Callable[["CircuitBreaker"], None] | None = None,
+    ):
+        self.name = name
+        self.max_failures = max_failures
+        self.recovery = recovery
+        self.on_change = on_change
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Returns `True` if a call can be made, `False` if it has to fail fast."""
+        changed = False
+        with self._lock:
+            if self.state == CircuitBreaker.OPEN:
+                if time.monotonic() - self._opened < self.recovery:
+                    self.rejected += 1
+                    return False
+                self.state = CircuitBreaker.HALF_OPEN
+                self._trial = False
+                changed = True
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if self._trial:
+                    # a trial call is already in flight
+                    self.rejected += 1
+                    return False
+                self._trial = True
+        if changed:
+            self._notify()
+        return True
+
+    def record_success(self):
+        changed = False
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            if self.state != CircuitBreaker.CLOSED:
+                self.state = CircuitBreaker.CLOSED
+                changed = True
+        if changed:
+            self._notify()
+
+    def record_failure(self):
+        changed = False
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == CircuitBreaker.HALF_OPEN or (
+                self.state == CircuitBreaker.CLOSED
+                and self.failures >= self.max_failures
+            ):
+                self.state = CircuitBreaker.OPEN
+                self._opened = time.monotonic()
+                changed = True
+        if changed:
+            self._notify()
+
+    def _notify(self):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(self)
+        except Exception as e:
+            # Unexpected behaviour
+            logging.exception(e)
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    """Returns the circuit breaker of the backend reachable at `url`,
+    every backend has its own breaker inside every process.
+    """
+    breakers = current_app.extensions.get(BREAKERS_EXTENSION, None)
+    if breakers is None:
+        with _breakers_lock:
+            breakers = current_app.extensions.setdefault(BREAKERS_EXTENSION, {})
+    breaker = breakers.get(url, None)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = breakers.get(url, None)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    url,
+                    current_app.config["UPSTREAM_BREAKER_FAILURES"],
+                    current_app.config["UPSTREAM_BREAKER_RECOVERY"],
+                    _record_breaker_state,
+                )
+                breakers[url] = breaker
+    return breaker
+
+
+def _record_breaker_state(breaker: CircuitBreaker):
+    """Stores the state of `breaker` in `upstream_breakers`,
+    so that the state of every process can be inspected.
+    """
+    logging.warning(f"Circuit breaker of {breaker.name} is now {breaker.state}")
+    try:
+        db = get_db()
+        db.execute(
+            "INSERT INTO upstream_breakers (name, pid, state, failures, changed) VALUES (?, ?, ?, ?, ?) ON CONFLICT (name, pid) DO UPDATE SET state = excluded.state, failures = excluded.failures, changed = excluded.changed",
+            (breaker.name, os.getpid(), breaker.state, breaker.failures, time.time()),
+        )
+        db.commit()
+    except sqlite3.Error as e:
+        logging.exception(e)
+
+
+def remaining_budget() -> float:
+    """Returns the seconds the current request can still spend waiting
+    for the weather backend, the budget of `WEATHER_LATENCY_BUDGET` seconds
+    starts with the first call to the backend.
+    """
+    deadline = g.get("upstream_deadline", None)
+    if deadline is None:
+        deadline = time.monotonic() + current_app.config["WEATHER_LATENCY_BUDGET"]
+        g.upstream_deadline = deadline
+    return deadline - time.monotonic()
+
+
+def fetch_json(url: str, params: dict) -> tuple[int, dict | None]:
+    """# `fetch_json`
+
+    Returns the status code and the json content of a GET request to the
+    backend, `None` if the response wasn't json.
+    Identical requests issued at the same time share a single upstream call:
+    inside the process through `SingleFlight`, across processes through a lock
+    row in `upstream_flights` if `UPSTREAM_SHARED_SINGLE_FLIGHT` is enabled.
+    """
+    key = url + "?" + urlencode(sorted(params.items()), doseq=True)
+
+    def call() -> tuple[int, dict | None]:
+        if current_app.config["UPSTREAM_SHARED_SINGLE_FLIGHT"]:
+            return _shared_flight(key, url, params)
+        return _request_json(url, params)
+
+    try:
+        # waiting for a call in flight is bounded by the latency budget too
+        res, coalesced = get_single_flight().do(
+            key, call, timeout=max(0.0, remaining_budget())
+        )
+    except TimeoutError as e:
+        logging.error(f"Latency budget exhausted waiting for the backend: {e}")
+        return 503, None
+    if coalesced:
+        _record_flight_stat("coalesced")
+    return res
+
+
+def _shared_flight(key: str, url: str, params: dict) -> tuple[int, dict | None]:
+    """# `_shared_flight`, `fetch_json`'s helper
+
+    Coalesces the call with the processes that share the database:
+    the process that manages to insert the lock row for `key` calls the
+    backend and stores the result in the row, where it stays for
+    `UPSTREAM_FLIGHT_RESULT_TTL` seconds, the others poll the row until
+    the result is there. If the leader doesn't complete in
+    `UPSTREAM_FLIGHT_LEASE` seconds the lock expires and the call is
+    made directly.
+    """
+    db = get_db()
+    owner = f"{os.getpid()}-{threading.get_ident()}"
+    lease = current_app.config["UPSTREAM_FLIGHT_LEASE"]
+    poll_interval = current_app.config["UPSTREAM_FLIGHT_POLL_INTERVAL"]
+
+    try:
+        now = time.time()
+        db.execute("DELETE FROM upstream_flights WHERE (expires < ?)", (now,))
+        leader = (
+            db.execute(
+                "INSERT OR IGNORE INTO upstream_flights (key, owner, expires) VALUES (?, ?, ?)",
+                (key, owner, now + lease),
+            ).rowcount
+            == 1
+        )
+        db.commit()
+    except sqlite3.Error as e:
+        # NOTE: coalescing is an optimization, we can still serve the user
+        logging.exception(e)
+        return _request_json(url, params)
+
+    if leader:
+        status, json_response = _request_json(url, params)
+        try:
+            db.execute(
+                "UPDATE upstream_flights SET status = ?, result = ?, expires = ? WHERE (key = ? AND owner = ?)",
+                (
+                    status,
+                    json.dumps(json_response),
+                    time.time() + current_app.config["UPSTREAM_FLIGHT_RESULT_TTL"],
+                    key,
+                    owner,
+                ),
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            logging.exception(e)
+        return status, json_response
+
+    # waiting for the leader is bounded by the latency budget too
+    deadline = time.time() + min(lease, remaining_budget())
+    while time.time() < deadline:
+        try:
+            row = db.execute(
+                "SELECT status, result, expires FROM upstream_flights WHERE (key = ?)",
+                (key,),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.exception(e)
+            break
+        if row is None or row["expires"] < time.time():
+            # the leader gave up or the result expired
+            break
+        if row["status"] is not None:
+            get_single_flight().shared_coalesced += 1
+            _record_flight_stat("shared_coalesced")
+            return row["status"], json.loads(row["result"])
+        time.sleep(poll_interval)
+
+    return _request_json(url, params)
+
+
+def _record_flight_stat(name: str):
+    """Increments the counter `name` of `upstream_flight_stats`, counters are
+    kept in memory and flushed every `UPSTREAM_FLIGHT_STATS_FLUSH` seconds,
+    so the calls to the backend don't wait for a write to the database.
+    """
+    single_flight = get_single_flight()
+    single_flight.record(name)
+    if (
+        time.monotonic() - single_flight.flushed
+        >= current_app.config["UPSTREAM_FLIGHT_STATS_FLUSH"]
+    ):
+        flush_flight_stats()
+
+
+def flush_flight_stats():
+    """Adds the counters recorded by the process to `upstream_flight_stats`,
+    where they sum the activity of every process. The write goes through a
+    dedicated connection, the one of the request may have pending changes
+    that aren't ours to commit.
+    """
+    single_flight = get_single_flight()
+    pending = single_flight.take_pending()
+    if not pending:
+        return
+    try:
+        db = sqlite3.connect(current_app.config["DATABASE"])
+        try:
+            apply_pragmas(db, current_app.config["DATABASE_PRAGMAS"])
+            db.executemany(
+                "INSERT INTO upstream_flight_stats (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                pending.items(),
+            )
+            db.commit()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        logging.exception(e)
+        single_flight.restore_pending(pending)
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        single_flight.restore_pending(pending)
+
+
+def _request_json(url: str, params: dict) -> tuple[int, dict | None]:
+    """# `_request_json`, `fetch_json`'s helper
+
+    Sends a GET request to the backend through the shared session, returns
+    the status code of the response and the json it contains, `None` if
+    the response wasn't json.
+    Failed connections and gateway errors are retried up to
+    `WEATHER_HTTP_RETRIES` times, if the backend couldn't be reached
+    500 is returned.
+    If the latency budget of the request is exhausted or the circuit breaker
+    of the backend is open the call isn't made and 503 is returned right away.
+    The budget is checked before every attempt and the timeouts of every
+    attempt are capped by the budget left.
+    """
+    if remaining_budget() <= 0:
+        logging.error(f"Latency budget exhausted, not calling the backend {url}")
+        return 503, None
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        return 503, None
+
+    _record_flight_stat("executed")
+    connect_timeout, read_timeout = current_app.config["WEATHER_HTTP_TIMEOUT"]
+    retries = current_app.config["WEATHER_HTTP_RETRIES"]
+    backend = urlparse(url).netloc
+    started = time.perf_counter()
+    response = None
+    try:
+        with timed(UPSTREAM):
+            for attempt in range(retries + 1):
+                remaining = remaining_budget()
+                if attempt > 0:
+                    # bounded exponential backoff, within the budget
+                    time.sleep(max(0.0, min(RETRY_BACKOFF * 2 ** (attempt - 1), remaining)))
+                    remaining = remaining_budget()
+                    if remaining <= 0:
+                        logging.error(
+                            f"Latency budget exhausted, not retrying the backend {url}"
+                        )
+                        break
+                timeout = (min(connect_timeout, remaining), min(read_timeout, remaining))
+                try:
+                    response = get_http_session().get(
+                        url, params=params, timeout=timeout
+                    )
+                except requests.exceptions.ConnectionError as e:
+                    # NOTE: read timeouts aren't retried, a slow backend
+                    # would only spend the rest of the budget again
+                    logging.error(f"Unable to reach the backend {url}: {e}")
+                    response = None
+                    continue
+                if response.status_code not in RETRY_STATUSES:
+                    break
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Unable to reach the backend {url}: {e}")
+        response = None
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        response = None
+    finally:
+        observe(
+            "hjblog_upstream_duration_seconds",
+            time.perf_counter() - started,
+            LATENCY_BUCKETS,
+            backend=backend,
+        )
+
+    if response is None:
+        breaker.record_failure()
+        inc("hjblog_upstream_failures_total", backend=backend)
+        return 500, None
+    if response.status_code >= 500:
+        breaker.record_failure()
+        inc("hjblog_upstream_failures_total", backend=backend)
+    else:
+        breaker.record_success()
+
+    try:
+        json_response = response.json()
+    except requests.exceptions.JSONDecodeError as e:
+        json_response = None
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        json_response = None
+
+    return response.status_code, json_response
 
 
 class Coordinates:
@@ -166,21 +679,11 @@ class Coordinates:
         populates the fields with error informations.
         """
         params = {"name": city, "count": 1, "language": "en", "format": "json"}
-        response = requests.get(
-            "https://geocoding-api.open-meteo.com/v1/search", params=params
-        )
-        try:
-            json_response = response.json()
-        except requests.exceptions.JSONDecodeError as e:
-            self._error(500)
-            return
-        except Exception as e:
-            # Unexpected behaviour
-            logging.exception(e)
+        status, json_response = fetch_json(GEOCODING_URL, params)
+        if json_response is None:
             self._error(500)
             return
 
-        status = response.status_code
         if status > 399 or status < 200:
             if status == 404:
                 self._error(404)
@@ -219,7 +722,8 @@ class WeatherForecast:
     Object that encloses the forecast for a specific city, contains daily forecasts and hourly forecasts.
     The property `status_code` contains the response of the backend.
     [Backend documentation](https://open-meteo.com/en/docs).
-    NOTE: only one status code, if one of the two failed we consider both failed.
+    NOTE: hourly and daily forecasts are fetched with a single request, so there is
+    only one status code.
     """
 
     def __init__(self, coordinates: Coordinates):
@@ -228,12 +732,13 @@ class WeatherForecast:
         self.coordinates = coordinates
         self.status_code: int = None
 
-        # Hourly
+        # Hourly and daily forecasts are requested together, one round trip
         params = {
             "latitude": coordinates.latitude,
             "longitude": coordinates.longitude,
             "timezone": coordinates.timezone,
             "forecast_hours": 20,
+            "forecast_days": 7,
             "hourly": [
                 "temperature_2m",
                 "relative_humidity_2m",
@@ -243,34 +748,6 @@ class WeatherForecast:
                 "precipitation_probability",
                 "weather_code",
             ],
-        }
-        hourly = requests.get("https://api.open-meteo.com/v1/forecast", params=params)
-        if hourly.status_code < 200 and hourly.status_code > 399:
-            self._error(hourly.status_code)
-            return
-
-        try:
-            hourly_json_response = hourly.json()
-        except requests.exceptions.JSONDecodeError as e:
-            self._error(500)
-            return
-        except Exception as e:
-            # Unexpected behaviour
-            logging.exception(e)
-            self._error(500)
-            return
-
-        success = self._get_hourly_forecasts(hourly_json_response)
-        if success == False:
-            self._error(500)
-            return
-
-        # Daily
-        params = {
-            "latitude": coordinates.latitude,
-            "longitude": coordinates.longitude,
-            "forecast_days": 7,
-            "timezone": coordinates.timezone,
             "daily": [
                 "temperature_2m_max",
                 "temperature_2m_min",
@@ -280,22 +757,20 @@ class WeatherForecast:
                 "sunset",
             ],
         }
-
-        daily = requests.get("https://api.open-meteo.com/v1/forecast", params=params)
-        if daily.status_code < 200 and daily.status_code > 399:
-            self._error(daily.status_code)
+        status, json_response = fetch_json(FORECAST_URL, params)
+        if status < 200 or status > 399:
+            self._error(status)
             return
-
-        try:
-            daily_json_response = daily.json()
-        except requests.exceptions.JSONDecodeError as e:
+        if json_response is None:
             self._error(500)
             return
-        except Exception as e:
+
+        success = self._get_hourly_forecasts(json_response)
+        if success == False:
             self._error(500)
             return
 
-        success = self._get_daily_forecasts(daily_json_response)
+        success = self._get_daily_forecasts(json_response)
         if success == False:
             self._error(500)
             return
@@ -418,6 +893,155 @@ class WeatherForecast:
         return formatted
 
 
+class ForecastCache:
+    """Bounded LRU cache of parsed forecasts, entries are keyed by the
+    coordinates rounded to `precision` decimals and by the timezone, so
+    users of the same city share the same entry.
+    An entry is fresh for `ttl` seconds, after that it is still served while
+    a single background thread fetches the new forecast(stale-while-revalidate),
+    after `max_stale` seconds the entry isn't served anymore and the forecast
+    is fetched again synchronously.
+    """
+
+    def __init__(self, size: int, ttl: float, max_stale: float, precision: int):
+        self.size = size
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[float, WeatherForecast]] = (
+            OrderedDict()
+        )
+        self._refreshing: set[tuple] = set()
+        self._lock = threading.Lock()
+
+    def key(self, coordinates: Coordinates) -> tuple[float, float, str]:
+        return (
+            round(float(coordinates.latitude), self.precision),
+            round(float(coordinates.longitude), self.precision),
+            coordinates.timezone,
+        )
+
+    def get(self, coordinates: Coordinates) -> WeatherForecast:
+        """Returns the forecast for `coordinates`, from the cache if possible."""
+        key = self.key(coordinates)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None or now - entry[0] > self.max_stale:
+            self.misses += 1
+            return self._fetch(key, coordinates)
+
+        self.hits += 1
+        fetched, forecast = entry
+        if now - fetched > self.ttl:
+            self._refresh_in_background(key, coordinates)
+        return self._for(forecast, coordinates)
+
+    def get_stale(self, coordinates: Coordinates) -> WeatherForecast | None:
+        """Returns the cached forecast for `coordinates` no matter how old
+        it is, `None` if there is none.
+        """
+        with self._lock:
+            entry = self._entries.get(self.key(coordinates), None)
+        if entry is None:
+            return None
+        return self._for(entry[1], coordinates)
+
+    def _fetch(self, key: tuple, coordinates: Coordinates) -> WeatherForecast:
+        forecast = WeatherForecast(coordinates)
+        if forecast.status_code == 200:
+            self._store(key, forecast)
+        return forecast
+
+    def _store(self, key: tuple, forecast: WeatherForecast):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), forecast)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _refresh_in_background(self, key: tuple, coordinates: Coordinates):
+        """Starts a thread that refreshes the entry, unless one is already running."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    self._fetch(key, coordinates)
+            except Exception as e:
+                # Unexpected behaviour
+                logging.exception(e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    @staticmethod
+    def _for(forecast: WeatherForecast, coordinates: Coordinates) -> WeatherForecast:
+        """The cached forecast may have been fetched for a city with a different
+        name, the forecasts are shared but the coordinates are the ones requested.
+        """
+        forecast = copy.copy(forecast)
+        forecast.coordinates = coordinates
+        return forecast
+
+
+def get_forecast_cache() -> ForecastCache:
+    """Returns the forecast cache of the application."""
+    cache = current_app.extensions.get(FORECAST_CACHE_EXTENSION, None)
+    if cache is None:
+        with _forecast_cache_lock:
+            cache = current_app.extensions.get(FORECAST_CACHE_EXTENSION, None)
+            if cache is None:
+                cache = ForecastCache(
+                    current_app.config["WEATHER_CACHE_SIZE"],
+                    current_app.config["WEATHER_CACHE_TTL"],
+                    current_app.config["WEATHER_CACHE_MAX_STALE"],
+                    current_app.config["WEATHER_CACHE_PRECISION"],
+                )
+                current_app.extensions[FORECAST_CACHE_EXTENSION] = cache
+    return cache
+
+
+def get_forecast(coordinates: Coordinates) -> WeatherForecast:
+    """Returns the forecast for `coordinates`, the backend is queried
+    only if the cache can't serve it.
+    """
+    return get_forecast_cache().get(coordinates)
+
+
+def get_fallback_forecast(coordinates: Coordinates | None) -> WeatherForecast | None:
+    """Used when the weather backend is unavailable, returns the last forecast
+    cached for `coordinates` no matter how old it is, `None` if there is
+    none, and lets the user know.
+    """
+    forecast = None
+    if coordinates is not None and coordinates.status_code == 200:
+        forecast = get_forecast_cache().get_stale(coordinates)
+    if forecast is None:
+        flash(
+            "The weather service is currently unavailable, please try again later.",
+            category="alert-danger",
+        )
+    else:
+        flash(
+            "The weather service is currently unavailable, the forecast displayed may be outdated.",
+            category="alert-danger",
+        )
+    return forecast
+
+
 class HourlyForecast:
     """Docstring for HourlyPrediction."""
 
@@ -2,6 +2,7 @@ import sqlite3
 from flask import (
     Blueprint,
     abort,
+    current_app,
     flash,
     redirect,
     render_template,
@@ -13,10 +14,12 @@ from flask import (
 from flask_wtf.csrf import logging
 
 from hjblog.auxiliaries import admin_only, login_required
+from hjblog.cache import POSTS, invalidate
 from hjblog.bps.general_auxiliaries.auxiliaries import get_indexes, get_offset
 from hjblog.bps.user_actions.auxiliaries import (
     Coordinates,
-    WeatherForecast,
+    get_fallback_forecast,
+    get_forecast,
 )
 from hjblog.bps.user_actions.forms import CommentPost, NewPost, QueryMeteoAPI
 from hjblog.bps.user_profile.auxiliaries import get_profile_pic
@@ -55,6 +58,7 @@ def new_post():
         except Exception as e:
             logging.exception(e)
             abort(500)
+        invalidate(POSTS)
         flash(f'The post "{title}" has been published.', category="alert-success")
         return redirect(url_for("index"))
 
@@ -150,6 +154,7 @@ def delete_post(index: int):
     except Exception as e:
         logging.exception(e)
         abort(500)
+    invalidate(POSTS)
 
     flash("The post was removed correctly.", category="alert-success")
     return redirect(url_for("index"))
@@ -222,11 +227,12 @@ def all_comments(post_id: int):
     more_comments = False
     msg_no_comments = None
     count = None
+    chunk_size = current_app.config["COMMENTS_CHUNK_SIZE"]
     o = request.args.get("o", None)
-    o, offset = get_offset(o)
+    o, offset = get_offset(o, chunk_size)
 
     post = db.execute(
-        "SELECT id, author_id, content, title, posted FROM posts WHERE (id = ?)",
+        "SELECT id, author_id, content, title, posted, comments_count FROM posts WHERE (id = ?)",
         (post_id,),
     ).fetchone()
     if not post:
@@ -236,17 +242,15 @@ def all_comments(post_id: int):
     page_span = 4
 
     try:
-        count = db.execute(
-            "SELECT COUNT(id) FROM comments WHERE (post_id = ?)",
-            (post["id"],),
-        ).fetchone()["COUNT(id)"]
+        # kept up to date by the triggers on `comments`
+        count = post["comments_count"]
         if count == 0:
             msg_no_comments = (
                 "No comment to display so far, be the first one to leave a comment."
             )
         count = count - offset
-        if count > 100:
-            count = 100
+        if count > chunk_size:
+            count = chunk_size
             more_comments = True
     except TypeError:
         msg_no_comments = "No more comments are avaible."
@@ -268,8 +272,8 @@ def all_comments(post_id: int):
     index, prev_pages, next_pages = get_indexes(page_span, max_page)
 
     batch = db.execute(
-        "SELECT comments.author_id as author_id, users.username, comments.id, comments.content, comments.written FROM comments JOIN users ON (users.id = comments.author_id) WHERE (comments.post_id = ?) ORDER BY (comments.written) LIMIT 100 OFFSET (?)",
-        (post["id"], offset),
+        "SELECT comments.author_id as author_id, users.username, comments.id, comments.content, comments.written FROM comments JOIN users ON (users.id = comments.author_id) WHERE (comments.post_id = ?) ORDER BY (comments.written) LIMIT (?) OFFSET (?)",
+        (post["id"], chunk_size, offset),
     )
 
     for _ in range(0, index + 1):
@@ -351,6 +355,7 @@ def weather():
     city_id = user["city_id"]
     city_name = None
     forecasts = None
+    unavailable = False
 
     form = QueryMeteoAPI()
     if form.validate_on_submit():
@@ -360,12 +365,19 @@ def weather():
         # TODO: think about input sanitation, we have a regex in the form
         # TODO: test the API
         coordinates: Coordinates = Coordinates(city, latitude, longitude)
-        if coordinates.status_code > 399 or coordinates.status_code < 200:
+        # The backend is unavailable, we don't keep the worker waiting
+        if coordinates.status_code > 499:
+            forecasts = get_fallback_forecast(None)
+            unavailable = True
+        elif coordinates.status_code > 399 or coordinates.status_code < 200:
             abort(coordinates.status_code)
-
-        forecasts = WeatherForecast(coordinates)
-        if forecasts.status_code < 200 or forecasts.status_code > 399:
-            abort(forecasts.status_code)
+        else:
+            forecasts = get_forecast(coordinates)
+            if forecasts.status_code > 499:
+                forecasts = get_fallback_forecast(coordinates)
+                unavailable = forecasts is None
+            elif forecasts.status_code < 200 or forecasts.status_code > 399:
+                abort(forecasts.status_code)
         return render_template(
             "/user_actions/weather.html",
             title="Weather",
@@ -373,6 +385,7 @@ def weather():
             form=form,
             current_user=g.user,
             forecasts=forecasts,
+            unavailable=unavailable,
             profile_pic=profile_pic
         )
     else:
@@ -392,7 +405,10 @@ def weather():
             # NOTE: this should not happen since the information should be in the database already
             if coordinates.status_code > 399 or coordinates.status_code < 200:
                 abort(coordinates.status_code)
-            forecasts = WeatherForecast(coordinates)
+            forecasts = get_forecast(coordinates)
+            if forecasts.status_code < 200 or forecasts.status_code > 399:
+                forecasts = get_fallback_forecast(coordinates)
+                unavailable = forecasts is None
         if user is None:
             # this should not happen becouse of `@login_required`
             abort(500)
@@ -408,5 +424,6 @@ def weather():
         form=form,
         current_user=g.user,
         forecasts=forecasts,
+        unavailable=unavailable,
         profile_pic=profile_pic
     )
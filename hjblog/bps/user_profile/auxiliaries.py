@@ -1,14 +1,28 @@
+from concurrent.futures import Future
 from io import BytesIO
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageOps, UnidentifiedImageError
 import logging
 import os
-from flask import current_app, url_for
+import sqlite3
+import time
+from flask import current_app, flash, url_for
 import qrcode
 from base64 import b64encode
 import werkzeug
-import secrets
 
-from werkzeug.utils import secure_filename
+from hjblog.auxiliaries import forget_user
+from hjblog.db import get_db
+from hjblog.jobs import get_job_queue
+from hjblog.metrics import IMAGE_BUCKETS, observe
+from hjblog.uploads import (
+    acquire,
+    content_name,
+    is_content_name,
+    register,
+    release,
+    shard,
+    write_file,
+)
 
 
 def get_b64encoded_qr_image(data: str) -> str:
@@ -33,61 +47,333 @@ def get_b64encoded_qr_image(data: str) -> str:
     return b64encode(buffered.getvalue()).decode("utf-8")
 
 
-def save_picture(
-    current_pic_name: str | None,
-    picture: werkzeug.datastructures.file_storage.FileStorage,
-) -> str | int:
+# Sizes, in CSS pixels, the profile pictures are displayed at:
+# the navbar avatar and the picture in the profile pages
+AVATAR_SIZE = 20
+PROFILE_SIZE = 150
+# Every size is rendered at 1x and 2x, for high density screens
+PICTURE_SCALES = (1, 2)
+PICTURE_FORMATS = {"webp": "WEBP", "png": "PNG"}
+
+
+def get_picture_files(pic_name: str) -> list[str]:
+    """Returns the paths of the files, relative to `UPLOAD_DIR`, that make up
+    the profile picture `pic_name`, see `hjblog.uploads` for the layout.
+    Pictures uploaded before the thumbnail pipeline are a single file
+    whose name has an extension.
     """
-    Saves the picture on the filesystem, returns the name to the picture,
-    if the client uploaded an invalid picture format 400 will be returned,
-    if the procedure wasn't successfull becouse of a server error 500 will
-    be sent returned.
-    The old picture of the user will be deleted.
-    This function expects the name of the  picture to be validated elsewhere,
-    in the relative `FlaskForm` probabily.
+    if "." in pic_name:
+        return [pic_name]
+    directory = shard(pic_name)
+    prefix = directory + "/" if directory else ""
+    return [
+        f"{prefix}{pic_name}_{size * scale}.{ext}"
+        for size in (AVATAR_SIZE, PROFILE_SIZE)
+        for scale in PICTURE_SCALES
+        for ext in PICTURE_FORMATS
+    ]
+
+
+def remove_picture(pic_name: str):
+    """Drops a reference to the profile picture `pic_name`, its files are
+    removed once no user references it anymore.
+    Pictures stored before the content addressed store aren't shared,
+    their files are removed right away.
     """
-    # TODO: we may want to move the logic of validating the pitcure elsewhere
-    new_name = secrets.token_hex(8)
-    # NOTE: redundancy
-    new_name = secure_filename(new_name)
-    pic_name = picture.filename
-    index = pic_name.rfind(".")
-    if index < 0:
-        # this should not happen given the limitations on the form
-        return 500
-    suffix = pic_name[index:]
-    new_name = new_name + suffix
-    pic_path = os.path.join(current_app.config["UPLOAD_DIR"], new_name)
+    files = get_picture_files(pic_name)
+    if is_content_name(pic_name):
+        try:
+            release(pic_name, files)
+        except sqlite3.Error as e:
+            logging.exception(e)
+        except Exception as e:
+            # Unexpected behaviour
+            logging.exception(e)
+        return
+    for file_name in files:
+        try:
+            os.remove(os.path.join(current_app.config["UPLOAD_DIR"], file_name))
+        except FileNotFoundError as e:
+            logging.exception(e)
+        except Exception as e:
+            logging.exception(e)
+
+
+def process_picture(data: bytes, upload_dir: str, pic_name: str, max_pixels: int) -> int:
+    """
+    Stores the picture contained in `data` inside `upload_dir` as `pic_name`,
+    in the directory given by `hjblog.uploads.shard`,
+    returns 200 if the procedure was successfull, 400 if the picture is
+    invalid or has more than `max_pixels` pixels, 500 in case of a server error.
+    The original upload isn't kept: the picture is cropped to a square and
+    stored as fixed size thumbnails(see `get_picture_files`), in WebP and PNG,
+    without metadata.
+    It runs inside the worker processes of `hjblog.jobs.JobQueue`, so
+    it can't access the application.
+    """
+    saved = []
+    directory = shard(pic_name)
+    prefix = directory + "/" if directory else ""
     try:
-        img = Image.open(picture)
+        img = Image.open(BytesIO(data))
+        # Only the header has been read so far, bombs are refused before decoding
+        width, height = img.size
+        if width * height > max_pixels:
+            return 400
         # Validatin the image
         # NOTE: this is if far from being a bullet proof validation technique
         # for uploaded files
         img.verify()
-        img = Image.open(picture)
-        # Save the image
-        img.save(pic_path)
-    except UnidentifiedImageError as e:
+        img = Image.open(BytesIO(data))
+        largest = PROFILE_SIZE * max(PICTURE_SCALES)
+        # JPEG can be decoded directly at a reduced scale
+        img.draft("RGB", (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        for size in (AVATAR_SIZE, PROFILE_SIZE):
+            for scale in PICTURE_SCALES:
+                px = size * scale
+                thumbnail = ImageOps.fit(img, (px, px), Image.Resampling.LANCZOS)
+                # Metadata(EXIF, comments, ICC profiles) is not carried over
+                thumbnail.info = {}
+                for ext, image_format in PICTURE_FORMATS.items():
+                    file = f"{prefix}{pic_name}_{px}.{ext}"
+                    write_file(
+                        upload_dir,
+                        file,
+                        lambda path: thumbnail.save(path, image_format, optimize=True),
+                    )
+                    saved.append(file)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        _remove_files(upload_dir, saved)
         return 400
     except Exception as e:
+        logging.exception(e)
+        _remove_files(upload_dir, saved)
         return 500
+    return 200
 
-    if current_pic_name is not None:
+
+def _remove_files(upload_dir: str, files: list[str]):
+    """`process_picture`'s helper, removes the thumbnails of a failed upload.
+    NOTE: a picture is stored only if no user references its content yet,
+    so nobody else uses these files.
+    """
+    for file in files:
         try:
-            os.remove(os.path.join(current_app.config["UPLOAD_DIR"], current_pic_name))
-        except FileNotFoundError as e:
+            os.remove(os.path.join(upload_dir, file))
+        except Exception as e:
             logging.exception(e)
+
+
+def save_picture(
+    user_id: int,
+    picture: werkzeug.datastructures.file_storage.FileStorage,
+) -> int:
+    """
+    Hands the picture over to the job queue(`hjblog.jobs`), once it has been
+    processed it becomes the profile picture of the user and the old picture
+    of the user is deleted.
+    Pictures are named after their content, if the same picture is already
+    stored it is reused without being processed again and 200 is returned.
+    Returns 202 if the picture is being processed by the worker processes,
+    the outcome is reported later by `flash_picture_jobs`.
+    If the queue is inline the picture is processed right away and 200 is
+    returned on success, 400 if the client uploaded an invalid picture
+    and 500 in case of a server error.
+    If the queue is full 503 is returned.
+    This function expects the name of the  picture to be validated elsewhere,
+    in the relative `FlaskForm` probabily.
+    """
+    try:
+        data = picture.read()
+    except Exception as e:
+        logging.exception(e)
+        return 500
+    new_name = content_name(data)
+
+    try:
+        stored = acquire(new_name, get_picture_files(new_name))
+    except sqlite3.Error as e:
+        logging.exception(e)
+        return 500
+    if stored:
+        return _set_picture(user_id, new_name, 200, notify=False)
+    args = (
+        data,
+        current_app.config["UPLOAD_DIR"],
+        new_name,
+        current_app.config["PICTURE_MAX_PIXELS"],
+    )
+
+    job_queue = get_job_queue()
+    callback = None
+    submitted = time.perf_counter()
+    if not job_queue.inline:
+        app = current_app._get_current_object()
+
+        def callback(future: Future):
+            with app.app_context():
+                status = _store_picture(future, new_name, submitted)
+                _set_picture(user_id, new_name, status, notify=True)
+
+    future = job_queue.submit(process_picture, args, callback)
+    if future is None:
+        return 503
+    if not job_queue.inline:
+        return 202
+    return _set_picture(
+        user_id, new_name, _store_picture(future, new_name, submitted), notify=False
+    )
+
+
+def _store_picture(future: Future, pic_name: str, submitted: float) -> int:
+    """# `_store_picture`, `save_picture`'s helper
+
+    Adds the reference of the user to the picture `pic_name` processed
+    by the job of `future`, returns the outcome of the job.
+    The time since the job was `submitted` is recorded along with
+    the outcome of the job.
+    """
+    try:
+        status = future.result()
+    except Exception as e:
+        logging.exception(e)
+        status = 500
+    observe(
+        "hjblog_image_turnaround_seconds",
+        time.perf_counter() - submitted,
+        IMAGE_BUCKETS,
+        status=status,
+    )
+    if status != 200:
+        return status
+    try:
+        if not register(pic_name, get_picture_files(pic_name)):
+            logging.error(f"Picture {pic_name} was removed while being stored")
+            return 500
+    except sqlite3.Error as e:
+        logging.exception(e)
+        return 500
+    except Exception as e:
+        # Unexpected behaviour
+        logging.exception(e)
+        return 500
+    return 200
+
+
+def _set_picture(user_id: int, pic_name: str, status: int, notify: bool) -> int:
+    """# `_set_picture`, `save_picture`'s helper
+
+    Called when the processing of a picture is over, if it was successfull
+    `pic_name` becomes the profile picture of the user and the old
+    picture is deleted. Returns the outcome of the whole procedure,
+    if `notify` is `True` it is also stored in `picture_jobs`.
+    """
+    if status == 200:
+        db = get_db()
+        try:
+            old_pic_name = db.execute(
+                "SELECT profile_pic FROM users WHERE (id = ?)", (user_id,)
+            ).fetchone()["profile_pic"]
+            db.execute(
+                r"UPDATE users SET profile_pic = ?, version = version + 1 WHERE (id = ?)",
+                (pic_name, user_id),
+            )
+            db.commit()
+            forget_user(user_id)
+            if old_pic_name is not None:
+                remove_picture(old_pic_name)
+        except sqlite3.Error as e:
+            logging.exception(e)
+            remove_picture(pic_name)
+            status = 500
         except Exception as e:
+            # Unexpected behaviour
             logging.exception(e)
-    return new_name
+            remove_picture(pic_name)
+            status = 500
+
+    if notify:
+        try:
+            db = get_db()
+            db.execute(
+                "INSERT INTO picture_jobs (user_id, status) VALUES (?, ?)",
+                (user_id, status),
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            logging.exception(e)
+    return status
+
+
+def flash_picture_jobs(user_id: int):
+    """Lets the user know the outcome of the pictures processed in background
+    since the last time, the outcomes are deleted once reported.
+    """
+    try:
+        db = get_db()
+        statuses = db.execute(
+            "DELETE FROM picture_jobs WHERE (user_id = ?) RETURNING status",
+            (user_id,),
+        ).fetchall()
+        db.commit()
+    except sqlite3.Error as e:
+        logging.exception(e)
+        return
+    for (status,) in statuses:
+        if status == 200:
+            flash(
+                "You have updated your profile picture correctly.",
+                category="alert-success",
+            )
+        elif status == 400:
+            flash(
+                "The picture you uploaded isn't a valid image.",
+                category="alert-danger",
+            )
+        else:
+            flash(
+                "We weren't able to process your picture, please try again later.",
+                category="alert-danger",
+            )
+
+
+class ProfilePicture:
+    """URLs of a profile picture, renders as the URL of the navbar avatar.
+    `variants` is `False` for the default picture and for pictures uploaded
+    before the thumbnail pipeline, that are served as they are.
+    """
+
+    def __init__(self, pic_name: str | None):
+        self.pic_name = pic_name
+        self.variants = pic_name is not None and "." not in pic_name
+
+    def url(self, size: int = AVATAR_SIZE, ext: str = "png", scale: int = 1) -> str:
+        if self.pic_name is None:
+            # TODO: make default picture configurable server side
+            return url_for("static", filename="default_files/anonymous_user.png")
+        if not self.variants:
+            return url_for("index.profile_pictures", pic_name=self.pic_name)
+        directory = shard(self.pic_name)
+        prefix = directory + "/" if directory else ""
+        return url_for(
+            "index.profile_pictures",
+            pic_name=f"{prefix}{self.pic_name}_{size * scale}.{ext}",
+        )
+
+    def srcset(self, size: int = AVATAR_SIZE, ext: str = "png") -> str:
+        return ", ".join(
+            f"{self.url(size, ext, scale)} {scale}x" for scale in PICTURE_SCALES
+        )
+
+    def __str__(self) -> str:
+        return self.url()
 
 
-def get_profile_pic(pic_name: str | None) -> str:
+def get_profile_pic(pic_name: str | None) -> ProfilePicture:
     """
     Obtains the path to the profile picture or the default
     picture if a picture is not available.
     """
-    if pic_name is None:
-        # TODO: make default picture configurable server side
-        return url_for("static", filename="default_files/anonymous_user.png")
-    return url_for("index.profile_pictures", pic_name=pic_name)
+    return ProfilePicture(pic_name)
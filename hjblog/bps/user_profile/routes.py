@@ -13,12 +13,16 @@ from flask import (
 from werkzeug.security import check_password_hash, generate_password_hash
 import pyotp
 
-from hjblog.auxiliaries import login_required, logout_user
+from hjblog.auxiliaries import forget_user, login_required, logout_user
+from hjblog.cache import POSTS, invalidate
+from hjblog.compression import keep_uncompressed
 from hjblog.bps.auth.forms import VerifyForm, VerifyForm2FA
 from hjblog.bps.user_actions.auxiliaries import Coordinates
 from hjblog.bps.user_profile.auxiliaries import (
+    flash_picture_jobs,
     get_b64encoded_qr_image,
     get_profile_pic,
+    remove_picture,
     save_picture,
 )
 from hjblog.bps.user_profile.forms import (
@@ -55,6 +59,7 @@ def manage_profile():
         except Exception as e:
             logging.exception(e)
             abort(500)
+    flash_picture_jobs(user["id"])
     return render_template(
         "user_profile/manage_profile.html",
         current_user=user,
@@ -67,7 +72,6 @@ def manage_profile():
 @login_required
 def change_picture():
     """View used to change user's profile picture."""
-    db = get_db()
     user = g.get("user", None)
     # User should never be `None`
     profile_pic = get_profile_pic(user["profile_pic"])
@@ -76,22 +80,21 @@ def change_picture():
 
     if form.validate_on_submit():
         if form.picture.data:
-            pic_name = save_picture(user["profile_pic"], form.picture.data)
-            if isinstance(pic_name, int):
-                abort(pic_name)
-            try:
-                db.execute(
-                    r"UPDATE users SET profile_pic = ? WHERE (id = ?)",
-                    (pic_name, user["id"]),
+            status = save_picture(user["id"], form.picture.data)
+            if status == 503:
+                flash(
+                    "Too many pictures are being processed, please try again in a few moments.",
+                    category="alert-danger",
                 )
-                db.commit()
-            except sqlite3.Error as e:
-                logging.exception(e)
-                abort(500)
-            except Exception as e:
-                # Unexpected behaviour
-                logging.exception(e)
-                abort(500)
+                return redirect(url_for("profile.change_picture"))
+            if status == 202:
+                flash(
+                    "Your new profile picture is being processed, it will be displayed in a few moments.",
+                    category="alert-success",
+                )
+                return redirect(url_for("profile.manage_profile"))
+            if status != 200:
+                abort(status)
         flash(
             "You have updated your profile picture correctly.", category="alert-success"
         )
@@ -146,9 +149,11 @@ def change_city():
                 abort(500)
         try:
             db.execute(
-                "UPDATE users SET city_id = ? WHERE (id = ?)", (city_id, user["id"])
+                "UPDATE users SET city_id = ?, version = version + 1 WHERE (id = ?)",
+                (city_id, user["id"]),
             )
             db.commit()
+            forget_user(user["id"])
             flash(
                 "Informations about the city updated correctly.",
                 category="alert-success",
@@ -202,9 +207,11 @@ def change_username():
         db = get_db()
         try:
             db.execute(
-                "UPDATE users SET username = ? WHERE (id = ?)", (new_name, user["id"])
+                "UPDATE users SET username = ?, version = version + 1 WHERE (id = ?)",
+                (new_name, user["id"]),
             )
             db.commit()
+            forget_user(user["id"])
         except sqlite3.Error as e:
             logging.exception(e)
             abort(500)
@@ -212,6 +219,8 @@ def change_username():
             # Unexpected behaviour
             logging.exception(e)
             abort(500)
+        # the author of the posts is displayed in cached fragments
+        invalidate(POSTS)
         flash("Username updated correctly.", category="alert-success")
         return redirect(url_for("profile.manage_profile"))
 
@@ -242,9 +251,11 @@ def change_email():
         db = get_db()
         try:
             db.execute(
-                "UPDATE users SET email = ? WHERE (id = ?)", (new_email, user["id"])
+                "UPDATE users SET email = ?, version = version + 1 WHERE (id = ?)",
+                (new_email, user["id"]),
             )
             db.commit()
+            forget_user(user["id"])
         except sqlite3.Error as e:
             logging.exception(e)
             abort(500)
@@ -283,9 +294,11 @@ def change_password():
         db = get_db()
         try:
             db.execute(
-                "UPDATE users SET hash_pass = ? WHERE (id = ?)", (new_hash, user["id"])
+                "UPDATE users SET hash_pass = ?, version = version + 1 WHERE (id = ?)",
+                (new_hash, user["id"]),
             )
             db.commit()
+            forget_user(user["id"])
         except sqlite3.Error as e:
             logging.exception(e)
             abort(500)
@@ -323,6 +336,7 @@ def setup_two_factor_auth():
         return redirect(url_for("index"))
 
     db = get_db()
+    keep_uncompressed()
     secret = pyotp.random_base32()
     uri = pyotp.totp.TOTP(secret).provisioning_uri(
         name=user["username"], issuer_name=current_app.config["APP_NAME"]
@@ -331,10 +345,11 @@ def setup_two_factor_auth():
 
     try:
         db.execute(
-            "UPDATE users SET is_two_factor_authentication_enabled = true, secret_token = ? WHERE (id = ?)",
+            "UPDATE users SET is_two_factor_authentication_enabled = true, secret_token = ?, version = version + 1 WHERE (id = ?)",
             (secret, user["id"]),
         )
         db.commit()
+        forget_user(user["id"])
     except sqlite3.Error as e:
         logging.exception(e)
         abort(500)
@@ -370,10 +385,11 @@ def disable_two_factor_auth():
 
     try:
         db.execute(
-            "UPDATE users SET is_two_factor_authentication_enabled = false, secret_token = NULL WHERE (id = ?)",
+            "UPDATE users SET is_two_factor_authentication_enabled = false, secret_token = NULL, version = version + 1 WHERE (id = ?)",
             (user["id"],),
         )
         db.commit()
+        forget_user(user["id"])
     except sqlite3.Error as e:
         logging.exception(e)
         abort(500)
@@ -412,6 +428,7 @@ def delete_account():
         try:
             db.execute("DELETE FROM users WHERE (id = ?)", (user["id"],))
             db.commit()
+            forget_user(user["id"])
         except sqlite3.Error as e:
             logging.exception(e)
             abort(500)
@@ -419,6 +436,9 @@ def delete_account():
             # Unexpected behaviour
             logging.exception(e)
             abort(500)
+        invalidate(POSTS)
+        if user["profile_pic"] is not None:
+            remove_picture(user["profile_pic"])
 
         flash(
             "Your account has been deleted correctly...\nSee you space cowboy",
@@ -468,6 +488,7 @@ def delete_account_with_2fa():
         try:
             db.execute("DELETE FROM users WHERE (id = ?)", (user["id"],))
             db.commit()
+            forget_user(user["id"])
         except sqlite3.Error as e:
             logging.exception(e)
             abort(500)
@@ -475,6 +496,9 @@ def delete_account_with_2fa():
             # Unexpected behaviour
             logging.exception(e)
             abort(500)
+        invalidate(POSTS)
+        if user["profile_pic"] is not None:
+            remove_picture(user["profile_pic"])
 
         flash(
             "Your account has been deleted correctly...\nSee you space cowboy",
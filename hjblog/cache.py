@@ -0,0 +1,269 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from flask import Flask, current_app
+from markupsafe import Markup
+
+from hjblog.db import get_db
+from hjblog.metrics import inc
+
+
+CACHE_EXTENSION = "hjblog.fragment_cache"
+GENERATIONS_EXTENSION = "hjblog.cache_generations"
+_cache_lock = threading.Lock()
+_generations_lock = threading.Lock()
+
+# Generation counters, every fragment depends on one of them,
+# bumping the counter invalidates all the fragments that depend on it.
+# They are kept in the database(`cache_generations`), so a bump is seen by
+# every process, even when the fragments are cached per process, and every
+# process keeps the values it read for `FRAGMENT_CACHE_GENERATION_TTL` seconds
+POSTS = "posts"
+
+
+class LRUCache:
+    """In-process cache, when more than `size` entries are stored the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, size: int, ttl: float | None = None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float | None, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> object | None:
+        """Returns the value stored under `key`, `None` if there is no such
+        value or if it is expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: object, ttl: float | None = None):
+        """Stores `value` under `key`, `ttl` overrides the default time to live."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache:
+    """Cache stored inside its own SQLite file, it is shared by every
+    process that points to the same file, so a fragment rendered by
+    one worker is served by all the others.
+    Only `str` and `bytes` values are supported. When more than `size` entries
+    are stored the oldest ones are evicted.
+    """
+
+    def __init__(self, path: str, size: int, ttl: float | None = None):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        db = self._connect()
+        db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS fragments (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires REAL,
+                stored REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS fragments_stored_idx ON fragments (stored);
+            """
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread, connections
+        aren't carried across a fork.
+        """
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode = WAL").fetchall()
+            db.execute("PRAGMA synchronous = NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def get(self, key: str) -> str | bytes | None:
+        row = (
+            self._connect()
+            .execute("SELECT value, expires FROM fragments WHERE (key = ?)", (key,))
+            .fetchone()
+        )
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, value: str | bytes, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        db = self._connect()
+        db.execute(
+            "INSERT INTO fragments (key, value, expires, stored) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, stored = excluded.stored",
+            (key, value, expires, now),
+        )
+        db.execute(
+            "DELETE FROM fragments WHERE key IN (SELECT key FROM fragments ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+            (self.size,),
+        )
+
+    def delete(self, key: str):
+        self._connect().execute("DELETE FROM fragments WHERE (key = ?)", (key,))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM fragments")
+
+
+def get_cache() -> LRUCache | SQLiteCache | None:
+    """Returns the fragment cache of the application, the backend is
+    selected through `FRAGMENT_CACHE`("lru" or "sqlite"), `None` is returned
+    if caching is disabled.
+    """
+    backend = current_app.config["FRAGMENT_CACHE"]
+    if not backend:
+        return None
+    cache = current_app.extensions.get(CACHE_EXTENSION, None)
+    if cache is None:
+        with _cache_lock:
+            cache = current_app.extensions.get(CACHE_EXTENSION, None)
+            if cache is None:
+                cache = create_cache(current_app)
+                current_app.extensions[CACHE_EXTENSION] = cache
+    return cache
+
+
+def create_cache(app: Flask) -> LRUCache | SQLiteCache:
+    """Instantiates the backend configured for `app`."""
+    backend = app.config["FRAGMENT_CACHE"]
+    size = app.config["FRAGMENT_CACHE_SIZE"]
+    ttl = app.config["FRAGMENT_CACHE_TTL"]
+    if backend == "lru":
+        return LRUCache(size, ttl)
+    if backend == "sqlite":
+        return SQLiteCache(app.config["FRAGMENT_CACHE_PATH"], size, ttl)
+    raise ValueError(f"Unknown FRAGMENT_CACHE backend: {backend}")
+
+
+def get_generations() -> dict[str, tuple[int, float]]:
+    """Returns the generation counters known to the process,
+    as `name -> (value, expires)`.
+    """
+    generations = current_app.extensions.get(GENERATIONS_EXTENSION, None)
+    if generations is None:
+        with _generations_lock:
+            generations = current_app.extensions.setdefault(GENERATIONS_EXTENSION, {})
+    return generations
+
+
+def _remember_generation(name: str, value: int):
+    generations = get_generations()
+    expires = time.monotonic() + current_app.config["FRAGMENT_CACHE_GENERATION_TTL"]
+    with _generations_lock:
+        known = generations.get(name, None)
+        # generations only grow, a value read before a bump can't replace it
+        if known is not None and known[0] > value:
+            value = known[0]
+        generations[name] = (value, expires)
+
+
+def get_generation(name: str) -> int:
+    """Returns the current value of the generation counter `name`, the value
+    read from the database is trusted for `FRAGMENT_CACHE_GENERATION_TTL`
+    seconds, so a cache hit doesn't query the database.
+    """
+    known = get_generations().get(name, None)
+    if known is not None and known[1] > time.monotonic():
+        return known[0]
+    row = (
+        get_db()
+        .execute("SELECT value FROM cache_generations WHERE (name = ?)", (name,))
+        .fetchone()
+    )
+    value = 0 if row is None else row["value"]
+    _remember_generation(name, value)
+    return value
+
+
+def bump_generation(name: str) -> int:
+    """Increments the generation counter `name` and returns its new value,
+    the process sees the new value right away, the others once the value
+    they know expires.
+    """
+    db = get_db()
+    value = db.execute(
+        "INSERT INTO cache_generations (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1 RETURNING value",
+        (name,),
+    ).fetchone()["value"]
+    db.commit()
+    _remember_generation(name, value)
+    return value
+
+
+def cached(
+    key: str, depends_on: str, build: Callable[[], str | bytes]
+) -> str | bytes:
+    """Returns the value stored under `key`, if it isn't cached
+    `build` is called and its result is stored.
+    The value is valid until the generation `depends_on` is bumped
+    with `invalidate`.
+    """
+    cache = get_cache()
+    if cache is None:
+        return build()
+    full_key = f"{key}@{depends_on}:{get_generation(depends_on)}"
+    value = cache.get(full_key)
+    if value is None:
+        inc("hjblog_cache_requests_total", cache="fragments", result="miss")
+        value = build()
+        cache.set(full_key, value)
+    else:
+        inc("hjblog_cache_requests_total", cache="fragments", result="hit")
+    return value
+
+
+def cached_fragment(key: str, depends_on: str, render: Callable[[], str]) -> Markup:
+    """Returns the rendered fragment stored under `key`, see `cached`."""
+    return Markup(cached(key, depends_on, render))
+
+
+def invalidate(depends_on: str):
+    """Invalidates every fragment that depends on `depends_on`, it has to
+    be called after the data the fragments are built from changed
+    has been committed.
+    """
+    bump_generation(depends_on)
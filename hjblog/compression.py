@@ -0,0 +1,252 @@
+import gzip
+import mimetypes
+import os
+import zlib
+from typing import Iterable, Iterator
+
+import click
+from flask import Flask, Response, current_app, g, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    # optional dependency, without it only gzip is offered
+    brotli = None
+
+
+# Precompressed variants of the static files, by content coding
+VARIANTS = {"br": ".br", "gzip": ".gz"}
+
+
+def get_codings() -> list[str]:
+    """Returns the content codings the application can produce,
+    in order of preference.
+    """
+    if brotli is None:
+        return ["gzip"]
+    return ["br", "gzip"]
+
+
+def accepted_codings() -> list[str]:
+    """Returns the content codings accepted by the client of the current
+    request among the ones the application can produce, in order of preference.
+    """
+    accept = request.accept_encodings
+    return [coding for coding in get_codings() if accept[coding] > 0]
+
+
+def negotiate() -> str | None:
+    """Returns the content coding the response to the current request
+    should use, `None` if the client doesn't accept any of ours.
+    """
+    codings = accepted_codings()
+    if not codings:
+        return None
+    return codings[0]
+
+
+def is_compressible(mimetype: str | None) -> bool:
+    """Already compressed types(images, archives...) aren't listed in
+    `COMPRESS_MIMETYPES`, compressing them again would only waste CPU.
+    """
+    return mimetype in current_app.config["COMPRESS_MIMETYPES"]
+
+
+def keep_uncompressed():
+    """Sends the response to the current request uncompressed, views
+    call it when the page shows a secret(like the seed of the 2fa).
+    """
+    g.keep_uncompressed = True
+
+
+def carries_secret() -> bool:
+    """Returns `True` if the response to the current request holds a secret:
+    a CSRF token has been rendered or the view called `keep_uncompressed`.
+    Compressing a secret along with text reflected from the request lets
+    an attacker guess it from the size of the responses(BREACH).
+    """
+    field_name = current_app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token")
+    return g.get(field_name, None) is not None or g.get("keep_uncompressed", False)
+
+
+def compress(data: bytes, coding: str, level: int) -> bytes:
+    if coding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(
+    chunks: Iterable[bytes], coding: str, level: int
+) -> Iterator[bytes]:
+    """Compresses a streamed response chunk by chunk, each chunk is flushed
+    so the client receives it as soon as it is produced.
+    """
+    if coding == "br":
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def compress_response(response: Response) -> Response:
+    """Compresses the responses produced by the application with the
+    content coding negotiated with the client.
+    Files sent through `send_file` are left alone, static files are served
+    precompressed by `send_static`, responses smaller than `COMPRESS_MIN_SIZE`
+    aren't worth the CPU, responses holding a secret are never compressed,
+    see `carries_secret`. A strong ETag becomes weak, since the compressed
+    bytes aren't the ones it was computed on, conditional requests still
+    match it.
+    """
+    config = current_app.config
+    if (
+        not config["COMPRESS"]
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or not is_compressible(response.mimetype)
+    ):
+        return response
+    if carries_secret():
+        # the same URL could be compressed for another request
+        response.vary.add("Accept-Encoding")
+        return response
+
+    response.vary.add("Accept-Encoding")
+    coding = negotiate()
+    if coding is None:
+        return response
+    if coding == "br":
+        level = config["COMPRESS_BROTLI_QUALITY"]
+    else:
+        level = config["COMPRESS_LEVEL"]
+
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), coding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESS_MIN_SIZE"]:
+            return response
+        response.set_data(compress(data, coding, level))
+
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def send_static(filename: str) -> Response:
+    """Serves a static file, if the client accepts it and the file has been
+    precompressed(see `compress-static`) the compressed variant is sent
+    as it is, so serving it costs no CPU.
+    """
+    app = current_app._get_current_object()
+    mimetype = guess_mimetype(filename)
+    if app.config["COMPRESS"] and is_compressible(mimetype):
+        source = os.path.join(app.static_folder, filename)
+        for coding in accepted_codings():
+            variant = source + VARIANTS[coding]
+            try:
+                fresh = os.path.getmtime(variant) >= os.path.getmtime(source)
+            except OSError:
+                fresh = False
+            if not fresh:
+                continue
+            response = send_from_directory(
+                app.static_folder,
+                filename + VARIANTS[coding],
+                mimetype=mimetype,
+                max_age=app.get_send_file_max_age(filename),
+            )
+            response.headers["Content-Encoding"] = coding
+            response.vary.add("Accept-Encoding")
+            return response
+    response = app.send_static_file(filename)
+    if is_compressible(response.mimetype):
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def guess_mimetype(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def precompress(
+    static_folder: str, min_size: int, compressible: set[str]
+) -> list[str]:
+    """Writes the `.br`(if brotli is installed) and `.gz` variants of the
+    compressible files of `static_folder`, at the highest level, since it
+    is done only once. Variants that wouldn't be smaller than the file are
+    removed. Returns the variants written.
+    """
+    written = []
+    for directory, _, file_names in os.walk(static_folder):
+        for file_name in file_names:
+            if file_name.endswith(tuple(VARIANTS.values())):
+                continue
+            if guess_mimetype(file_name) not in compressible:
+                continue
+            path = os.path.join(directory, file_name)
+            with open(path, "rb") as f:
+                data = f.read()
+            for coding in get_codings():
+                variant = path + VARIANTS[coding]
+                if len(data) < min_size:
+                    compressed = None
+                elif coding == "br":
+                    compressed = brotli.compress(data, quality=11)
+                else:
+                    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+                if compressed is None or len(compressed) >= len(data):
+                    if os.path.exists(variant):
+                        os.remove(variant)
+                    continue
+                with open(variant, "wb") as f:
+                    f.write(compressed)
+                written.append(os.path.relpath(variant, static_folder))
+    return written
+
+
+@click.command("compress-static")
+def compress_static_command():
+    """Precompresses the static files, run it after every change
+    to `static/`(it is part of the build), stale variants are never
+    served since they are older than their file.
+    """
+    config = current_app.config
+    try:
+        written = precompress(
+            current_app.static_folder,
+            config["COMPRESS_MIN_SIZE"],
+            config["COMPRESS_MIMETYPES"],
+        )
+    except (FileNotFoundError, PermissionError) as e:
+        # File related Exceptions
+        click.echo(message=e.__str__(), err=True)
+        return
+    except Exception as e:
+        # Unexpected behaviour
+        click.echo(message=f"Unexpected Exception:\n{e}", err=True)
+        return
+
+    for variant in written:
+        click.echo(f"Written: {variant}")
+    if brotli is None:
+        click.echo("brotli isn't installed, only gzip variants were written.")
+
+
+def init_app(app: Flask):
+    """Compresses the responses of `app` and serves its static files
+    precompressed, adds the `compress-static` command.
+    """
+    app.after_request(compress_response)
+    app.view_functions["static"] = send_static
+    app.cli.add_command(compress_static_command)
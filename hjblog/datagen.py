@@ -0,0 +1,358 @@
+import bisect
+import itertools
+import math
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+
+from werkzeug.security import generate_password_hash
+
+from hjblog.db import get_db, rebuild_fts, recount
+
+
+# Every generated user can log in with this password, hashing millions
+# of different passwords would take hours
+PASSWORD = "password"
+# Generated activity spans this many days, up to the end given to `generate`
+SPAN_DAYS = 5 * 365
+# Mean delay(in seconds) between a post and one of its comments,
+# most comments come within a couple of days
+COMMENT_DELAY = 2 * 24 * 60 * 60
+# Share of the users without a city
+NO_CITY = 0.3
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua ut enim ad minim veniam "
+    "quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo "
+    "consequat duis aute irure in reprehenderit voluptate velit esse cillum "
+    "fugiat nulla pariatur excepteur sint occaecat cupidatat non proident sunt "
+    "culpa qui officia deserunt mollit anim id est laborum weather rain sun "
+    "cloud wind city travel python flask sqlite blog post comment reply"
+).split()
+TIMESTAMP = "%Y-%m-%d %H:%M:%S"
+
+
+class DataReport:
+    """Rows written by `generate` and how long every table took."""
+
+    def __init__(self):
+        # table -> (rows, seconds)
+        self.tables: dict[str, tuple[int, float]] = {}
+        # users promoted to admin, so the posts have an author
+        self.admins = 0
+        # seconds spent recounting the counters and rebuilding the search indexes
+        self.indexing = 0.0
+
+    def add(self, table: str, rows: int, seconds: float):
+        self.tables[table] = (rows, seconds)
+
+    def lines(self) -> list[str]:
+        lines = []
+        for table, (rows, seconds) in self.tables.items():
+            lines.append(
+                f"{table}: {rows} rows in {seconds:.2f}s, {rate(rows, seconds)}"
+            )
+        lines.append(f"Counters and search indexes rebuilt in {self.indexing:.2f}s")
+        rows = sum(rows for rows, _ in self.tables.values())
+        seconds = sum(seconds for _, seconds in self.tables.values()) + self.indexing
+        lines.append(f"Total: {rows} rows in {seconds:.2f}s, {rate(rows, seconds)}")
+        if self.admins:
+            lines.append(f"Generated users promoted to admin: {self.admins}")
+        return lines
+
+
+def rate(rows: int, seconds: float) -> str:
+    if seconds <= 0:
+        return "- rows/s"
+    return f"{rows / seconds:,.0f} rows/s"
+
+
+class Corpus:
+    """Random text to cut the generated titles and contents from, drawing
+    every word of millions of rows would take longer than inserting them.
+    """
+
+    def __init__(self, rng: random.Random, size: int = 1 << 16):
+        self.text = " ".join(rng.choices(WORDS, k=size // 6))
+        # where the words start, so a cut never starts mid-word
+        self.starts = [0] + [i + 1 for i, c in enumerate(self.text) if c == " "]
+
+    def cut(self, rng: random.Random, mean: float, limit: int) -> str:
+        """Returns about `mean` characters of text, lengths are log-normal:
+        mostly short, with a long tail, and never longer than `limit`.
+        """
+        length = min(limit, max(1, int(rng.lognormvariate(math.log(mean), 0.6))))
+        start = self.starts[int(rng.random() * len(self.starts))]
+        if start + length > len(self.text):
+            start = 0
+        return self.text[start : start + length].rstrip() or WORDS[0]
+
+
+def growing_timestamps(
+    rng: random.Random, amount: int, start: float, end: float
+) -> list[float]:
+    """Returns `amount` sorted timestamps between `start` and `end`,
+    denser towards `end`, the way a growing site collects users.
+    """
+    span = end - start
+    return sorted(start + span * math.sqrt(rng.random()) for _ in range(amount))
+
+
+def batches(rows: Iterator[tuple], size: int) -> Iterator[list[tuple]]:
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert(
+    db: sqlite3.Connection, sql: str, rows: Iterator[tuple], batch_size: int
+) -> int:
+    """Inserts `rows` through `executemany`, `batch_size` rows per
+    transaction, committing every row on its own would be orders of
+    magnitude slower. If a transaction is already open the rows are
+    inserted inside it and left to the caller to commit.
+    Returns the rows inserted.
+    """
+    own = not db.in_transaction
+    inserted = 0
+    for batch in batches(rows, batch_size):
+        try:
+            db.executemany(sql, batch)
+            if own:
+                db.commit()
+        except sqlite3.Error:
+            if own:
+                db.rollback()
+            raise
+        inserted += len(batch)
+    return inserted
+
+
+@contextmanager
+def suspended_triggers(
+    db: sqlite3.Connection, tables: tuple[str, ...]
+) -> Iterator[None]:
+    """Drops the triggers of `tables` for the duration of the block and
+    creates them again afterwards.
+    Everything happens inside one exclusive transaction, committed at the
+    end of the block: no other connection can write while the triggers
+    are missing, nor ever sees the database without them, and if the
+    block fails the rollback restores them along with the data.
+    Raises `sqlite3.OperationalError` if another connection holds the
+    database for longer than the busy timeout.
+    """
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN EXCLUSIVE")
+    try:
+        placeholders = ", ".join("?" for _ in tables)
+        triggers = db.execute(
+            f"SELECT name, sql FROM sqlite_master WHERE (type = 'trigger' AND tbl_name IN ({placeholders}))",
+            tables,
+        ).fetchall()
+        for name, _ in triggers:
+            db.execute(f'DROP TRIGGER "{name}"')
+        yield
+        for _, sql in triggers:
+            db.execute(sql)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def next_id(db: sqlite3.Connection, table: str) -> int:
+    return (db.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0] or 0) + 1
+
+
+def next_user_number(db: sqlite3.Connection) -> int:
+    """Returns a number higher than the one of every `user-<n>` username
+    or email already in the database.
+    """
+    highest = 0
+    for column in ("username", "email"):
+        number = db.execute(
+            f"SELECT MAX(CAST(substr({column}, 6) AS INTEGER)) FROM users WHERE ({column} GLOB 'user-[0-9]*')"
+        ).fetchone()[0]
+        highest = max(highest, number or 0)
+    return highest + 1
+
+
+def generate(
+    users: int,
+    posts: int,
+    comments: int,
+    cities: int,
+    seed: int,
+    end: datetime,
+    batch_size: int = 50_000,
+) -> DataReport:
+    """Adds random cities, users, posts and comments to the database,
+    next to the rows already there, with activity spread over the
+    `SPAN_DAYS` days before `end`: the same seed on the same database
+    produces the same rows.
+    Everything is checked before writing anything, so a request that can't
+    be satisfied doesn't leave part of the rows behind.
+    Posts are written by the admins, if there are none the first
+    generated user becomes one. Users are named `user-<n>`, numbered after
+    the highest `n` already in use so their names never collide. Comments are written by every user, a few
+    posts collect most of them and they mostly come soon after their post.
+    The triggers of posts and comments are suspended while loading, firing
+    them row by row would dominate the time, the counters they maintain
+    are recounted and the search indexes rebuilt at the end instead, all
+    inside one exclusive transaction, see `suspended_triggers`.
+    Dates are generated in UTC, like the ones SQLite writes, a naive `end`
+    is taken as UTC.
+    """
+    db = get_db()
+    rng = random.Random(seed)
+    corpus = Corpus(rng)
+    report = DataReport()
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    end_ts = end.timestamp()
+    start_ts = (end - timedelta(days=SPAN_DAYS)).timestamp()
+
+    def timestamp(ts: float) -> str:
+        return datetime.fromtimestamp(ts, timezone.utc).strftime(TIMESTAMP)
+
+    admin_ids = [
+        row[0] for row in db.execute("SELECT id FROM users WHERE (is_admin = TRUE)")
+    ]
+    promote = not admin_ids and users > 0 and posts > 0
+    if posts > 0 and not admin_ids and not promote:
+        raise ValueError(
+            "At least one admin is needed to write the posts, generate some users or use the new-admin command."
+        )
+    if comments > 0 and (
+        (users == 0 and db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None)
+        or (posts == 0 and db.execute("SELECT 1 FROM posts LIMIT 1").fetchone() is None)
+    ):
+        raise ValueError("Comments need at least one user and one post.")
+
+    # cities
+    started = time.perf_counter()
+    first = next_id(db, "cities")
+    rows = (
+        (
+            i,
+            f"city-{i}",
+            round(rng.uniform(-90, 90), 5),
+            round(rng.uniform(-180, 180), 5),
+            "UTC",
+        )
+        for i in range(first, first + cities)
+    )
+    inserted = insert(
+        db,
+        "INSERT INTO cities (id, name, latitude, longitude, timezone) VALUES (?, ?, ?, ?, ?)",
+        rows,
+        batch_size,
+    )
+    report.add("cities", inserted, time.perf_counter() - started)
+
+    # users
+    started = time.perf_counter()
+    city_ids = [row[0] for row in db.execute("SELECT id FROM cities")]
+    first = next_id(db, "users")
+    number = max(first, next_user_number(db))
+    hash_pass = generate_password_hash(PASSWORD)
+    subscribed = growing_timestamps(rng, users, start_ts, end_ts)
+    rows = (
+        (
+            first + i,
+            f"user-{number + i}",
+            f"user-{number + i}@example.com",
+            rng.choice(city_ids) if city_ids and rng.random() >= NO_CITY else None,
+            hash_pass,
+            timestamp(ts),
+            promote and i == 0,
+        )
+        for i, ts in enumerate(subscribed)
+    )
+    inserted = insert(
+        db,
+        "INSERT INTO users (id, username, email, city_id, hash_pass, subscribed, is_admin) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows,
+        batch_size,
+    )
+    report.add("users", inserted, time.perf_counter() - started)
+    if promote:
+        admin_ids = [first]
+        report.admins = 1
+
+    with suspended_triggers(db, ("posts", "comments")):
+        # posts, their ids follow the order they were posted in
+        started = time.perf_counter()
+        first = next_id(db, "posts")
+        posted = sorted(rng.uniform(start_ts, end_ts) for _ in range(posts))
+        rows = (
+            (
+                first + i,
+                corpus.cut(rng, 30, 60),
+                corpus.cut(rng, 800, 2000),
+                timestamp(ts),
+                rng.choice(admin_ids),
+            )
+            for i, ts in enumerate(posted)
+        )
+        inserted = insert(
+            db,
+            "INSERT INTO posts (id, title, content, posted, author_id) VALUES (?, ?, ?, ?, ?)",
+            rows,
+            batch_size,
+        )
+        report.add("posts", inserted, time.perf_counter() - started)
+
+        # comments
+        started = time.perf_counter()
+        if comments > 0:
+            user_ids = [row[0] for row in db.execute("SELECT id FROM users")]
+            post_times = [
+                (row[0], row[1].replace(tzinfo=timezone.utc).timestamp())
+                for row in db.execute("SELECT id, posted FROM posts")
+            ]
+            # Zipf-like popularity: the n-th most popular post gets 1/n of the
+            # comments of the first one, popularity doesn't depend on the age
+            rng.shuffle(post_times)
+            cum_weights = list(
+                itertools.accumulate(1 / n for n in range(1, len(post_times) + 1))
+            )
+            total = cum_weights[-1]
+
+            def comment_rows() -> Iterator[tuple]:
+                for _ in range(comments):
+                    index = bisect.bisect(cum_weights, rng.random() * total)
+                    post_id, posted_ts = post_times[min(index, len(post_times) - 1)]
+                    delay = rng.expovariate(1 / COMMENT_DELAY)
+                    written = min(end_ts, posted_ts + delay)
+                    yield (
+                        post_id,
+                        corpus.cut(rng, 120, 400),
+                        rng.choice(user_ids),
+                        timestamp(written),
+                    )
+
+            inserted = insert(
+                db,
+                "INSERT INTO comments (post_id, content, author_id, written) VALUES (?, ?, ?, ?)",
+                comment_rows(),
+                batch_size,
+            )
+        else:
+            inserted = 0
+        report.add("comments", inserted, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        recount()
+        rebuild_fts()
+        report.indexing = time.perf_counter() - started
+
+    db.execute("ANALYZE")
+    db.commit()
+    return report
@@ -1,38 +1,204 @@
+import logging
 import os
+import queue
+import re
+import shutil
 import sqlite3
+import threading
 from datetime import datetime
 
 from flask import g, current_app, Flask
 import click
 
+from hjblog.instrumentation import TracedConnection
+
+
+POOL_EXTENSION = "hjblog.db_pool"
+_pool_lock = threading.Lock()
+PRAGMA_NAME = re.compile(r"^[a-z_]+$")
+PRAGMA_VALUE = re.compile(r"^(-?\d+|[A-Za-z]+)$")
+
+
+class ConnectionPool:
+    """Pool of connections to the database owned by a single process.
+    Connections are checked out by a request and returned on teardown,
+    they stay open between requests so the schema and the page cache
+    are already warm, PRAGMAs are applied only once, when the connection
+    is created.
+    At most `size` idle connections are kept, if more connections are
+    required at the same time they are created on demand and closed
+    when they are returned.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        size: int,
+        pragmas: dict[str, str | int],
+        health_check: bool,
+    ):
+        self.database = database
+        self.size = size
+        self.pragmas = pragmas
+        self.health_check = health_check
+        self._pid = os.getpid()
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(size)
+
+    def connect(self) -> sqlite3.Connection:
+        """Opens a new connection with the PRAGMAs applied."""
+        db = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # statements are timed for the instrumentation of the requests
+            factory=TracedConnection,
+            # a connection is used by one thread at a time, but not always the same one
+            check_same_thread=False,
+        )
+        db.row_factory = sqlite3.Row
+        apply_pragmas(db, self.pragmas)
+        return db
+
+    def checkout(self) -> sqlite3.Connection:
+        """Returns an idle connection, if the health check is enabled
+        broken connections are discarded, if no connection
+        is available a new one is opened.
+        """
+        if os.getpid() != self._pid:
+            # We are in a forked child, connections can't be shared with the
+            # parent and closing them here could release the parent's locks
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue(self.size)
+
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if not self.health_check:
+                return db
+            try:
+                db.execute("SELECT 1").fetchone()
+                return db
+            except sqlite3.Error as e:
+                logging.warning(f"Discarding a broken database connection: {e}")
+                self._discard(db)
+
+    def checkin(self, db: sqlite3.Connection):
+        """Gives a connection back to the pool, an eventual transaction
+        left open is rolled back.
+        """
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error as e:
+            logging.warning(f"Discarding a broken database connection: {e}")
+            self._discard(db)
+            return
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        """Closes every idle connection."""
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(db)
+
+    def _discard(self, db: sqlite3.Connection):
+        try:
+            db.close()
+        except sqlite3.Error as e:
+            logging.exception(e)
+
+
+def apply_pragmas(db: sqlite3.Connection, pragmas: dict[str, str | int]):
+    """Applies `pragmas` to the connection, names and values are validated
+    since PRAGMAs can't be passed as parameters.
+    """
+    for name, value in pragmas.items():
+        value = str(value)
+        if not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(value):
+            raise ValueError(f"Invalid PRAGMA: {name} = {value}")
+        db.execute(f"PRAGMA {name} = {value}").fetchall()
+
+
+def get_pool() -> ConnectionPool | None:
+    """Returns the connection pool of the application, it is created the first
+    time it is needed, `None` is returned if `DATABASE_POOL_SIZE` is 0.
+    """
+    if current_app.config["DATABASE_POOL_SIZE"] <= 0:
+        return None
+    pool = current_app.extensions.get(POOL_EXTENSION, None)
+    if pool is None:
+        with _pool_lock:
+            pool = current_app.extensions.get(POOL_EXTENSION, None)
+            if pool is None:
+                pool = ConnectionPool(
+                    current_app.config["DATABASE"],
+                    current_app.config["DATABASE_POOL_SIZE"],
+                    current_app.config["DATABASE_PRAGMAS"],
+                    current_app.config["DATABASE_POOL_HEALTH_CHECK"],
+                )
+                current_app.extensions[POOL_EXTENSION] = pool
+    return pool
+
+
+def close_pool(app: Flask):
+    """Closes the idle connections of the pool of `app`, if any."""
+    pool = app.extensions.pop(POOL_EXTENSION, None)
+    if pool is not None:
+        pool.close()
+
 
 def get_db() -> sqlite3.Connection:
     """Checks if `g` object contains a connection to
     the database, if it does it will be returned, otherwise
-    a new connection will be enstablished and then returned.
+    a connection will be checked out from the pool(or enstablished,
+    if pooling is disabled) and then returned.
     """
     if "db" not in g:
-        g.db = sqlite3.connect(
-            current_app.config["DATABASE"], detect_types=sqlite3.PARSE_DECLTYPES
-        )
-
-        g.db.row_factory = sqlite3.Row
+        pool = get_pool()
+        if pool is None:
+            g.db = sqlite3.connect(
+                current_app.config["DATABASE"],
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                factory=TracedConnection,
+            )
+            g.db.row_factory = sqlite3.Row
+            apply_pragmas(g.db, current_app.config["DATABASE_PRAGMAS"])
+        else:
+            g.db = pool.checkout()
 
     return g.db
 
 
 def close_db(__e__=None):
     """If a connection to the database is present
-    in `g`, it will be popped and then closed.
+    in `g`, it will be popped and then given back to the pool,
+    or closed if pooling is disabled.
     NOTE: `e` is necessary.
     """
     db: sqlite3.Connection = g.pop("db", None)
     if db is not None:
-        db.close()
+        pool = get_pool()
+        if pool is None:
+            db.close()
+        else:
+            pool.checkin(db)
+
+
+MIGRATIONS_DIR = "migrations"
+MIGRATION_NAME = re.compile(r"^(\d{4})_([a-z0-9_]+)\.sql$")
 
 
 def init_db() -> None | Exception:
-    """Initializes the database."""
+    """Initializes the database, the schema is created from scratch
+    and then every migration is applied on top of it.
+    """
     db = get_db()
 
     try:
@@ -48,6 +214,147 @@ def init_db() -> None | Exception:
         # Unexpected behaviour
         return e
 
+    res = migrate_db()
+    if isinstance(res, Exception):
+        return res
+
+
+def get_migrations() -> list[tuple[int, str]]:
+    """Returns the migrations shipped with the application
+    as `(version, file_name)` ordered by version, files inside
+    the migrations directory that don't follow the `NNNN_name.sql`
+    format are ignored.
+    """
+    migrations = []
+    for file_name in os.listdir(os.path.join(current_app.root_path, MIGRATIONS_DIR)):
+        match = MIGRATION_NAME.match(file_name)
+        if match is None:
+            continue
+        migrations.append((int(match.group(1)), file_name))
+    migrations.sort()
+    return migrations
+
+
+def get_schema_version(db: sqlite3.Connection) -> int:
+    """Returns the version of the latest migration applied to the database."""
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, applied TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP))"
+    )
+    db.commit()
+    version = db.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+    if version is None:
+        return 0
+    return version
+
+
+def migrate_db() -> list[str] | Exception:
+    """Applies the migrations that haven't been applied yet to the database,
+    each migration runs inside its own transaction together with
+    the update of `schema_version`, so a failing migration leaves the
+    database at the previous version.
+    Returns the names of the migrations applied.
+    """
+    db = get_db()
+    applied = []
+
+    try:
+        current = get_schema_version(db)
+        for version, file_name in get_migrations():
+            if version <= current:
+                continue
+            with current_app.open_resource(f"{MIGRATIONS_DIR}/{file_name}") as var:
+                script = var.read().decode("utf-8")
+            try:
+                db.executescript(
+                    f"BEGIN;\n{script}\nINSERT INTO schema_version (version, name) VALUES ({version}, '{file_name}');\nCOMMIT;"
+                )
+            except sqlite3.Error:
+                if db.in_transaction:
+                    db.rollback()
+                raise
+            applied.append(file_name)
+    except (FileNotFoundError, PermissionError) as e:
+        # File related Exceptions
+        return e
+    except sqlite3.Error as e:
+        # sqlite3 related Exceptions
+        return e
+    except Exception as e:
+        # Unexpected behaviour
+        return e
+
+    return applied
+
+
+def recount() -> dict[str, int]:
+    """Recomputes the counters maintained by the triggers(`site_stats`
+    and `posts.comments_count`) from the tables they describe, inside
+    a single transaction, the one already open if any.
+    Returns how many counters were wrong, by counter.
+    """
+    db = get_db()
+    own = not db.in_transaction
+    if own:
+        db.execute("BEGIN IMMEDIATE")
+    try:
+        posts = db.execute(
+            "UPDATE posts SET comments_count = counted.value FROM (SELECT posts.id AS post_id, COUNT(comments.id) AS value FROM posts LEFT JOIN comments ON (comments.post_id = posts.id) GROUP BY posts.id) AS counted WHERE (posts.id = counted.post_id AND posts.comments_count <> counted.value)"
+        ).rowcount
+        stats = db.execute(
+            "SELECT posts_count, comments_count FROM site_stats WHERE (id = 1)"
+        ).fetchone()
+        posts_count = db.execute("SELECT COUNT(id) FROM posts").fetchone()[0]
+        comments_count = db.execute("SELECT COUNT(id) FROM comments").fetchone()[0]
+        db.execute(
+            "INSERT OR REPLACE INTO site_stats (id, posts_count, comments_count) VALUES (1, ?, ?)",
+            (posts_count, comments_count),
+        )
+        if own:
+            db.commit()
+    except Exception:
+        if own:
+            db.rollback()
+        raise
+
+    return {
+        "posts.comments_count": posts,
+        "site_stats.posts_count": int(stats is None or stats[0] != posts_count),
+        "site_stats.comments_count": int(
+            stats is None or stats[1] != comments_count
+        ),
+    }
+
+
+# Full text indexes and the tables they index
+FTS_TABLES = {"posts_fts": "posts", "comments_fts": "comments"}
+
+
+def rebuild_fts() -> dict[str, int]:
+    """Rebuilds the full text indexes from the tables they index and
+    merges their segments, the triggers keep them in sync afterwards.
+    It runs inside the transaction already open if any.
+    Returns the number of rows indexed, by index.
+    """
+    db = get_db()
+    indexed = {}
+    own = not db.in_transaction
+    if own:
+        db.execute("BEGIN IMMEDIATE")
+    try:
+        for index, table in FTS_TABLES.items():
+            db.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+            db.execute(f"INSERT INTO {index} ({index}) VALUES ('optimize')")
+            indexed[index] = db.execute(
+                f"SELECT COUNT(id) FROM {table}"
+            ).fetchone()[0]
+        if own:
+            db.commit()
+    except Exception:
+        if own:
+            db.rollback()
+        raise
+    return indexed
+
 
 def clear_old_files():
     """Clears old files, use it before initializing a new database"""
@@ -55,7 +362,11 @@ def clear_old_files():
     for file_name in os.listdir(profile_pics_dir):
         file = os.path.join(profile_pics_dir, file_name)
         try:
-            os.remove(file)
+            if os.path.isdir(file):
+                # shard of the content addressed store
+                shutil.rmtree(file)
+            else:
+                os.remove(file)
         except (FileNotFoundError, PermissionError) as e:
             click.echo(message=f"Failed to remove: {file}\nBecouse: {e}", err=True)
         except Exception as e:
@@ -79,13 +390,29 @@ def init_db_command():
         click.echo("Database initialized.")
 
 
+@click.command("migrate")
+def migrate_command():
+    """Defines a command that will upgrade the database
+    in place applying the pending migrations, data is preserved,
+    the command will be `flask --app hjblog:create migrate`.
+    """
+    res = migrate_db()
+    if isinstance(res, Exception):
+        click.echo(message=f"Failed to migrate the database:\n{res}", err=True)
+        return
+    for file_name in res:
+        click.echo(f"Applied: {file_name}")
+    click.echo(f"Database is at version {get_schema_version(get_db())}.")
+
+
 def init_app(app: Flask):
     """Takes an instance of flask and append to it
-    the command that we have specified with
-    `init_db_command`.
+    the commands that we have specified with
+    `init_db_command` and `migrate_command`.
     """
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_command)
 
 
 sqlite3.register_converter("timestamp", lambda v: datetime.fromisoformat(v.decode()))
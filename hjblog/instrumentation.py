@@ -0,0 +1,212 @@
+import json
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from flask import (
+    Flask,
+    Response,
+    before_render_template,
+    current_app,
+    g,
+    has_app_context,
+    request,
+    template_rendered,
+)
+
+
+logger = logging.getLogger("hjblog.requests")
+
+# Phases reported through `Server-Timing`, in order
+DB = "db"
+TEMPLATE = "tpl"
+UPSTREAM = "upstream"
+PHASES = (DB, TEMPLATE, UPSTREAM)
+
+
+class RequestTimings:
+    """Time spent by a request in every phase and the statements
+    it executed, with how many times and for how long each one ran.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, list] = {phase: [0, 0.0] for phase in PHASES}
+        self.statements: dict[str, list] = {}
+        self._templates: list[float] = []
+
+    def add(self, phase: str, elapsed: float):
+        counters = self.phases[phase]
+        counters[0] += 1
+        counters[1] += elapsed
+
+    def add_statement(self, statement: str, elapsed: float):
+        self.add(DB, elapsed)
+        counters = self.statements.setdefault(statement, [0, 0.0])
+        counters[0] += 1
+        counters[1] += elapsed
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def repeated(self, threshold: int) -> dict[str, int]:
+        """Returns the statements executed at least `threshold` times,
+        usually a query run once per row of another one(N+1).
+        """
+        return {
+            statement: counters[0]
+            for statement, counters in self.statements.items()
+            if counters[0] >= threshold
+        }
+
+    def server_timing(self) -> str:
+        entries = []
+        for phase in PHASES:
+            count, elapsed = self.phases[phase]
+            if count:
+                entries.append(f'{phase};dur={elapsed * 1000:.2f};desc="{count}"')
+        entries.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(entries)
+
+
+def get_timings() -> RequestTimings | None:
+    """Returns the timings of the current request, `None` outside
+    of a request or if the instrumentation is disabled.
+    """
+    if not has_app_context():
+        return None
+    return g.get("timings", None)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Adds the time spent inside the block to `phase`."""
+    timings = get_timings()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - started)
+
+
+def trace_statement(statement: str, elapsed: float):
+    """Tracing callback of `TracedConnection`, it receives every statement
+    with the time it took and records them in the timings of the request.
+    """
+    timings = get_timings()
+    if timings is not None:
+        timings.add_statement(" ".join(statement.split()), elapsed)
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection that times the statements it executes and passes them
+    to its `tracer`, the time of a query covers its execution up to the
+    first row.
+    """
+
+    tracer = staticmethod(trace_statement)
+
+    def execute(self, sql: str, *args, **kwargs) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args, **kwargs)
+        finally:
+            self.tracer(sql, time.perf_counter() - started)
+
+    def executemany(self, sql: str, *args, **kwargs) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args, **kwargs)
+        finally:
+            self.tracer(sql, time.perf_counter() - started)
+
+    def executescript(self, sql: str, *args, **kwargs) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql, *args, **kwargs)
+        finally:
+            self.tracer(sql, time.perf_counter() - started)
+
+
+def start_timings():
+    if current_app.config["INSTRUMENTATION"]:
+        g.timings = RequestTimings()
+
+
+def start_template(sender, template, context, **extra):
+    timings = get_timings()
+    if timings is not None:
+        timings._templates.append(time.perf_counter())
+
+
+def end_template(sender, template, context, **extra):
+    timings = get_timings()
+    if timings is not None and timings._templates:
+        started = timings._templates.pop()
+        # a template rendered while rendering another one isn't counted twice
+        if not timings._templates:
+            timings.add(TEMPLATE, time.perf_counter() - started)
+
+
+def report_timings(response: Response) -> Response:
+    """Adds the `Server-Timing` header to the response and logs a line
+    describing the request, as JSON. Requests slower than
+    `SLOW_REQUEST_THRESHOLD` seconds are logged as warnings, along with
+    their slowest statements, the statements executed at least
+    `REPEATED_QUERY_THRESHOLD` times are always reported.
+    """
+    timings = get_timings()
+    if timings is None:
+        return response
+    config = current_app.config
+
+    if config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = timings.server_timing()
+
+    elapsed = timings.elapsed()
+    record = {
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "ms": round(elapsed * 1000, 2),
+    }
+    for phase in PHASES:
+        count, phase_elapsed = timings.phases[phase]
+        record[f"{phase}_count"] = count
+        record[f"{phase}_ms"] = round(phase_elapsed * 1000, 2)
+    repeated = timings.repeated(config["REPEATED_QUERY_THRESHOLD"])
+    if repeated:
+        record["repeated"] = repeated
+
+    slow = elapsed >= config["SLOW_REQUEST_THRESHOLD"]
+    if slow:
+        slowest = sorted(
+            timings.statements.items(), key=lambda item: item[1][1], reverse=True
+        )[:5]
+        record["slowest"] = [
+            {"sql": statement, "count": count, "ms": round(total * 1000, 2)}
+            for statement, (count, total) in slowest
+        ]
+    logger.log(
+        logging.WARNING if slow or repeated else logging.INFO,
+        json.dumps(record, default=str),
+    )
+    return response
+
+
+def init_app(app: Flask):
+    """Measures every request of `app`: the statements executed through
+    `get_db`, the templates rendered and the calls to the weather backend.
+    It has to be initialized before the other extensions, the profiler
+    aside, so the timings cover their work too.
+    """
+    app.before_request(start_timings)
+    app.after_request(report_timings)
+    before_render_template.connect(start_template, app)
+    template_rendered.connect(end_template, app)
@@ -0,0 +1,138 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+
+from flask import Flask, current_app
+
+
+JOBS_EXTENSION = "hjblog.job_queue"
+_jobs_lock = threading.Lock()
+
+
+class JobQueue:
+    """Runs CPU bound jobs in a pool of `workers` processes, so they don't
+    hold the GIL of the process that serves the requests.
+    At most `max_queue` jobs can be queued or running at the same time,
+    `submit` refuses the others right away(backpressure) instead of letting
+    the queue grow without bounds.
+    With 0 `workers` jobs are executed right away inside the caller.
+    Jobs and their arguments have to be picklable, so they can't use
+    the application or its context, the callback passed to `submit` runs
+    in the process of the application, on a thread of its own: the thread
+    of the pool that collects the results is never blocked by it, and the
+    slot of a job is released only once its callback is done.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.inline = workers <= 0
+        self.submitted = 0
+        self.rejected = 0
+        self._pid = os.getpid()
+        self._executor: ProcessPoolExecutor | None = None
+        self._callbacks: ThreadPoolExecutor | None = None
+        self._slots = threading.BoundedSemaphore(max(max_queue, 1))
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # workers are spawned, forking a process that runs threads isn't safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                # callbacks write to the database one at a time
+                self._callbacks = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="hjblog-jobs-callback"
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(
+        self,
+        job: Callable,
+        args: tuple,
+        callback: Callable[[Future], None] | None = None,
+    ) -> Future | None:
+        """Queues `job(*args)`, `callback` is called with the `Future` of the
+        job when it is done. Returns the `Future`, or `None` if the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            return None
+        self.submitted += 1
+
+        if self.inline:
+            future = Future()
+            try:
+                future.set_result(job(*args))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            try:
+                future = self._get_executor().submit(job, *args)
+            except Exception:
+                self._slots.release()
+                raise
+
+        def run_callback(future: Future):
+            try:
+                if callback is not None:
+                    callback(future)
+            except Exception as e:
+                # Unexpected behaviour
+                logging.exception(e)
+            finally:
+                self._slots.release()
+
+        def done(future: Future):
+            callbacks = self._callbacks
+            if self.inline or callbacks is None:
+                run_callback(future)
+                return
+            try:
+                callbacks.submit(run_callback, future)
+            except RuntimeError:
+                # shut down meanwhile
+                run_callback(future)
+
+        future.add_done_callback(done)
+        return future
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=wait)
+                if self._callbacks is not None:
+                    self._callbacks.shutdown(wait=wait)
+            self._executor = None
+            self._callbacks = None
+
+
+def get_job_queue() -> JobQueue:
+    """Returns the job queue of the application, the pool of
+    `IMAGE_JOBS_WORKERS` processes is started with the first job.
+    """
+    job_queue = current_app.extensions.get(JOBS_EXTENSION, None)
+    if job_queue is None:
+        with _jobs_lock:
+            job_queue = current_app.extensions.get(JOBS_EXTENSION, None)
+            if job_queue is None:
+                job_queue = JobQueue(
+                    current_app.config["IMAGE_JOBS_WORKERS"],
+                    current_app.config["IMAGE_JOBS_MAX_QUEUE"],
+                )
+                current_app.extensions[JOBS_EXTENSION] = job_queue
+    return job_queue
+
+
+def close_job_queue(app: Flask, wait: bool = True):
+    """Stops the worker processes of `app`, if any."""
+    job_queue = app.extensions.pop(JOBS_EXTENSION, None)
+    if job_queue is not None:
+        job_queue.shutdown(wait=wait)
@@ -0,0 +1,402 @@
+import hmac
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import defaultdict
+
+from flask import Blueprint, Flask, abort, current_app, g, has_app_context, request
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+
+METRICS_EXTENSION = "hjblog.metrics"
+_metrics_lock = threading.Lock()
+
+# Bucket bounds(seconds) of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+IMAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# `HELP` and `TYPE` of every metric family
+FAMILIES = {
+    "hjblog_requests_total": ("counter", "Requests served, by endpoint and status."),
+    "hjblog_request_duration_seconds": (
+        "histogram",
+        "Time spent serving a request, by endpoint.",
+    ),
+    "hjblog_errors_total": ("counter", "Error pages rendered, by status."),
+    "hjblog_db_queries_total": ("counter", "SQLite statements executed, by endpoint."),
+    "hjblog_db_query_seconds_total": (
+        "counter",
+        "Time spent executing SQLite statements, by endpoint.",
+    ),
+    "hjblog_upstream_duration_seconds": (
+        "histogram",
+        "Time spent calling the weather backend, by backend.",
+    ),
+    "hjblog_upstream_failures_total": (
+        "counter",
+        "Calls to the weather backend that failed, by backend.",
+    ),
+    "hjblog_image_turnaround_seconds": (
+        "histogram",
+        "Time from the submission of a picture to its outcome, queue wait included.",
+    ),
+    "hjblog_cache_requests_total": ("counter", "Cache lookups, by cache and result."),
+}
+
+# Layout of a metrics file: the bytes in use, then the entries, an entry is
+# the length of its key, the key(padded to 8 bytes) and its value
+HEADER = struct.Struct("Q")
+KEY_LENGTH = struct.Struct("I")
+VALUE = struct.Struct("d")
+INITIAL_SIZE = 64 * 1024
+METRICS_FILE = re.compile(r"^[0-9]+\.metrics$")
+# Counters of the processes that are gone, kept as json
+AGGREGATE_FILE = "aggregate.json"
+LOCK_FILE = ".lock"
+
+
+def _padded(length: int) -> int:
+    return (length + 7) // 8 * 8
+
+
+class MmapStore:
+    """Counters of a single process, stored in a memory mapped file named
+    after the process inside `directory`. Every process only writes its own
+    file, `/metrics` reads the files of every process and sums them, so the
+    counters of all the workers are aggregated without any locking
+    between processes. The counters of the processes that are gone are
+    moved by `collect` into the aggregate file, so the totals never go down
+    when a worker is recycled.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._pid = os.getpid()
+        self.path = os.path.join(self.directory, f"{self._pid}.metrics")
+        self._file = open(self.path, "a+b")
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            self._file.truncate(INITIAL_SIZE)
+            size = INITIAL_SIZE
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = HEADER.unpack_from(self._map, 0)[0] or HEADER.size
+        self._offsets = {key: offset for key, _, offset in read_entries(self._map)}
+
+    def _grow(self, needed: int):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _offset(self, key: str) -> int:
+        offset = self._offsets.get(key, None)
+        if offset is not None:
+            return offset
+        encoded = key.encode("utf-8")
+        start = self._used
+        offset = start + KEY_LENGTH.size + _padded(len(encoded) + 4) - 4
+        end = offset + VALUE.size
+        if end > len(self._map):
+            self._grow(end)
+        KEY_LENGTH.pack_into(self._map, start, len(encoded))
+        self._map[start + KEY_LENGTH.size : start + KEY_LENGTH.size + len(encoded)] = (
+            encoded
+        )
+        VALUE.pack_into(self._map, offset, 0.0)
+        # the entry is complete before it becomes visible to the readers
+        self._used = end
+        HEADER.pack_into(self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def inc(self, key: str, amount: float = 1.0):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked, the parent keeps writing its own file
+                self._open()
+            offset = self._offset(key)
+            value = VALUE.unpack_from(self._map, offset)[0]
+            VALUE.pack_into(self._map, offset, value + amount)
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            self._file.close()
+
+
+def read_entries(buffer) -> list[tuple[str, float, int]]:
+    """Returns the `(key, value, offset)` entries of a metrics file."""
+    used = HEADER.unpack_from(buffer, 0)[0]
+    entries = []
+    position = HEADER.size
+    while position < used:
+        length = KEY_LENGTH.unpack_from(buffer, position)[0]
+        key_start = position + KEY_LENGTH.size
+        key = bytes(buffer[key_start : key_start + length]).decode("utf-8")
+        offset = position + KEY_LENGTH.size + _padded(length + 4) - 4
+        entries.append((key, VALUE.unpack_from(buffer, offset)[0], offset))
+        position = offset + VALUE.size
+    return entries
+
+
+def is_alive(pid: int) -> bool:
+    """Whether the process `pid` is still running on this machine."""
+    if fcntl is None:
+        # NOTE: on Windows `os.kill` would terminate the process, the files
+        # of the processes that are gone are simply kept
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, as another user
+        return True
+    return True
+
+
+def read_aggregate(directory: str) -> dict[str, float]:
+    try:
+        with open(os.path.join(directory, AGGREGATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def merge_dead(directory: str, names: list[str]):
+    """Adds the counters of the files of the processes that are gone to the
+    aggregate file and deletes them, otherwise they would pile up with every
+    restart of the workers. The directory is locked, so a file is never
+    merged twice by two processes serving `/metrics` at the same time.
+    """
+    with open(os.path.join(directory, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        aggregate = read_aggregate(directory)
+        merged = []
+        for name in names:
+            try:
+                with open(os.path.join(directory, name), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # merged by another process
+                continue
+            if len(data) >= HEADER.size:
+                for key, value, _ in read_entries(data):
+                    aggregate[key] = aggregate.get(key, 0.0) + value
+            merged.append(name)
+        if not merged:
+            return
+        # the aggregate is replaced atomically, before the files are deleted
+        temporary = os.path.join(directory, f"{AGGREGATE_FILE}.{os.getpid()}")
+        with open(temporary, "w") as f:
+            json.dump(aggregate, f)
+        os.replace(temporary, os.path.join(directory, AGGREGATE_FILE))
+        for name in merged:
+            os.remove(os.path.join(directory, name))
+
+
+def collect(directory: str) -> dict[str, float]:
+    """Sums the counters of every process that wrote inside `directory`,
+    the ones of the processes that are gone are read from the aggregate file.
+    """
+    try:
+        names = [name for name in os.listdir(directory) if METRICS_FILE.match(name)]
+    except FileNotFoundError:
+        return defaultdict(float)
+    dead = [name for name in names if not is_alive(int(name.split(".", 1)[0]))]
+    if dead:
+        merge_dead(directory, dead)
+
+    totals: dict[str, float] = defaultdict(float, read_aggregate(directory))
+    for name in names:
+        if name in dead:
+            continue
+        try:
+            with open(os.path.join(directory, name), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        if len(data) < HEADER.size:
+            continue
+        for key, value, _ in read_entries(data):
+            totals[key] += value
+    return totals
+
+
+def get_store() -> MmapStore | None:
+    """Returns the store of the application, `None` if the metrics are
+    disabled or if there is no application.
+    """
+    if not has_app_context() or not current_app.config["METRICS"]:
+        return None
+    store = current_app.extensions.get(METRICS_EXTENSION, None)
+    if store is None:
+        with _metrics_lock:
+            store = current_app.extensions.get(METRICS_EXTENSION, None)
+            if store is None:
+                store = MmapStore(current_app.config["METRICS_DIR"])
+                current_app.extensions[METRICS_EXTENSION] = store
+    return store
+
+
+def close_store(app: Flask):
+    """Closes the store of `app`, if any, its counters are kept."""
+    store = app.extensions.pop(METRICS_EXTENSION, None)
+    if store is not None:
+        store.close()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    encoded = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{encoded}}}"
+
+
+def inc(name: str, amount: float = 1.0, **labels):
+    """Increments the counter `name` with `labels`."""
+    store = get_store()
+    if store is not None:
+        store.inc(_key(name, labels), amount)
+
+
+def observe(name: str, value: float, buckets: tuple[float, ...], **labels):
+    """Records `value` in the histogram `name` with `labels`."""
+    store = get_store()
+    if store is None:
+        return
+    for bound in buckets:
+        if value <= bound:
+            store.inc(_key(f"{name}_bucket", {**labels, "le": bound}))
+    store.inc(_key(f"{name}_bucket", {**labels, "le": "+Inf"}))
+    store.inc(_key(f"{name}_sum", labels), value)
+    store.inc(_key(f"{name}_count", labels))
+
+
+def family_of(key: str) -> str:
+    name = key.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[: -len(suffix)] in FAMILIES:
+            return name[: -len(suffix)]
+    return name
+
+
+def format_value(value: float) -> str:
+    """Formats `value` without losing precision, integral values
+    without the decimal part.
+    """
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer() and abs(value) < 2**53:
+        return str(int(value))
+    return repr(value)
+
+
+def render(totals: dict[str, float]) -> str:
+    """Renders the counters in the Prometheus text format."""
+    families: dict[str, list[str]] = defaultdict(list)
+    for key in sorted(totals):
+        families[family_of(key)].append(key)
+    lines = []
+    for family in sorted(families):
+        kind, description = FAMILIES.get(family, ("untyped", ""))
+        lines.append(f"# HELP {family} {description}")
+        lines.append(f"# TYPE {family} {kind}")
+        for key in families[family]:
+            lines.append(f"{key} {format_value(totals[key])}")
+    return "\n".join(lines) + "\n"
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+
+
+def record_request(response):
+    """Counts the request and records its latency, along with the
+    statements it executed if the instrumentation measured them.
+    """
+    started = g.get("metrics_started", None)
+    if started is None or get_store() is None:
+        return response
+    endpoint = request.endpoint or "none"
+    inc("hjblog_requests_total", endpoint=endpoint, status=response.status_code)
+    observe(
+        "hjblog_request_duration_seconds",
+        time.perf_counter() - started,
+        LATENCY_BUCKETS,
+        endpoint=endpoint,
+    )
+    timings = g.get("timings", None)
+    if timings is not None:
+        count, elapsed = timings.phases["db"]
+        if count:
+            inc("hjblog_db_queries_total", count, endpoint=endpoint)
+            inc("hjblog_db_query_seconds_total", elapsed, endpoint=endpoint)
+    return response
+
+
+bp = Blueprint("metrics", __name__)
+
+
+@bp.route("/metrics")
+def metrics():
+    """Prometheus endpoint, it can be read only with the bearer token
+    `METRICS_TOKEN`, without a token it isn't served at all. If
+    `METRICS_ALLOWED_ADDRESSES` is set only those addresses can read it.
+    Everyone else receives a 404.
+    NOTE: behind a reverse proxy every request comes from the address
+    of the proxy, the token is what keeps `/metrics` private.
+    """
+    config = current_app.config
+    token = config["METRICS_TOKEN"]
+    if not config["METRICS"] or not token:
+        abort(404)
+    allowed = config["METRICS_ALLOWED_ADDRESSES"]
+    if allowed is not None and request.remote_addr not in allowed:
+        abort(404)
+    sent = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()):
+        abort(404)
+    return current_app.response_class(
+        render(collect(config["METRICS_DIR"])),
+        mimetype="text/plain",
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+
+def init_app(app: Flask):
+    """Records the metrics of every request of `app` and serves them
+    from `/metrics`.
+    """
+    # imported here, `hjblog.auxiliaries` records its cache lookups here
+    from hjblog.auxiliaries import skip_user_load
+
+    skip_user_load(metrics)
+    app.before_request(start_request)
+    app.after_request(record_request)
+    app.register_blueprint(bp)
@@ -0,0 +1,6 @@
+-- `ORDER BY posts.posted DESC, posts.id DESC` in `index` and the keyset
+-- seek on `(posts.posted, posts.id)` in `get_posts`.
+CREATE INDEX IF NOT EXISTS posts_posted_idx ON posts (posted, id, author_id);
+
+-- Same ordering restricted to a single author, `WHERE (posts.author_id = ?)`.
+CREATE INDEX IF NOT EXISTS posts_author_posted_idx ON posts (author_id, posted, id);
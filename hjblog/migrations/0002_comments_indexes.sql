@@ -0,0 +1,5 @@
+-- `WHERE (post_id = ?) ORDER BY written` in `visit_post` and `all_comments`,
+-- the `COUNT` of the comments of a post and `DELETE FROM comments WHERE (post_id = ?)`
+-- in `delete_post`, `author_id` is included so the `JOIN` with `users` is served
+-- by the index alone.
+CREATE INDEX IF NOT EXISTS comments_post_written_idx ON comments (post_id, written, author_id);
@@ -0,0 +1,4 @@
+-- `SELECT name, latitude, longitude, timezone FROM cities WHERE (name = ?)` in
+-- `Coordinates` and `SELECT id FROM cities WHERE (name = ?)` in `register`
+-- and `change_city`, covered without touching the table.
+CREATE INDEX IF NOT EXISTS cities_name_idx ON cities (name, latitude, longitude, timezone);
@@ -0,0 +1,15 @@
+-- Lock rows used to coalesce identical calls to the weather backend made
+-- by different processes, the leader stores the result in the row.
+CREATE TABLE IF NOT EXISTS upstream_flights (
+    key TEXT PRIMARY KEY,
+    owner VARCHAR(100) NOT NULL,
+    expires REAL NOT NULL,
+    status INTEGER,
+    result TEXT
+);
+
+-- Counters of the calls executed and coalesced, summed across processes.
+CREATE TABLE IF NOT EXISTS upstream_flight_stats (
+    name VARCHAR(60) PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
@@ -0,0 +1,10 @@
+-- Last known state of the circuit breakers of every process,
+-- a row is written each time a breaker changes state.
+CREATE TABLE IF NOT EXISTS upstream_breakers (
+    name VARCHAR(100) NOT NULL,
+    pid INTEGER NOT NULL,
+    state VARCHAR(20) NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    changed REAL NOT NULL,
+    PRIMARY KEY (name, pid)
+);
@@ -0,0 +1,10 @@
+-- Outcome of the profile pictures processed in background,
+-- rows are deleted once the user has been notified.
+CREATE TABLE IF NOT EXISTS picture_jobs (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    finished TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP)
+);
+
+CREATE INDEX IF NOT EXISTS picture_jobs_user_idx ON picture_jobs (user_id);
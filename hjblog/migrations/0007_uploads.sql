@@ -0,0 +1,7 @@
+-- References to the content addressed uploads, an upload is
+-- removed from the filesystem when its last reference is dropped.
+CREATE TABLE IF NOT EXISTS uploads (
+    name CHAR(64) PRIMARY KEY,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP)
+);
@@ -0,0 +1,7 @@
+-- Leases that let a single process at a time run a maintenance task,
+-- such as the garbage collection of the uploads.
+CREATE TABLE IF NOT EXISTS maintenance_leases (
+    name VARCHAR(60) PRIMARY KEY,
+    owner VARCHAR(100) NOT NULL,
+    expires REAL NOT NULL
+);
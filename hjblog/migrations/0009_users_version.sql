@@ -0,0 +1,3 @@
+-- Bumped by every update of a user, cached copies of the user
+-- with an older version are discarded.
+ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
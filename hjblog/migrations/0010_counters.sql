@@ -0,0 +1,43 @@
+-- Counters kept exact by the triggers below, so the number of posts
+-- and of comments is read without scanning the tables,
+-- `flask recount` recomputes them if they ever drift.
+ALTER TABLE posts ADD COLUMN comments_count INTEGER NOT NULL DEFAULT 0;
+
+-- Single row(`id` is always 1) with the site wide counters.
+CREATE TABLE IF NOT EXISTS site_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    posts_count INTEGER NOT NULL DEFAULT 0,
+    comments_count INTEGER NOT NULL DEFAULT 0
+);
+
+UPDATE posts SET comments_count = (SELECT COUNT(id) FROM comments WHERE (comments.post_id = posts.id));
+INSERT OR REPLACE INTO site_stats (id, posts_count, comments_count) VALUES (1, (SELECT COUNT(id) FROM posts), (SELECT COUNT(id) FROM comments));
+
+CREATE TRIGGER IF NOT EXISTS posts_count_insert AFTER INSERT ON posts
+BEGIN
+    UPDATE site_stats SET posts_count = posts_count + 1 WHERE (id = 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_count_delete AFTER DELETE ON posts
+BEGIN
+    UPDATE site_stats SET posts_count = posts_count - 1 WHERE (id = 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_count_insert AFTER INSERT ON comments
+BEGIN
+    UPDATE posts SET comments_count = comments_count + 1 WHERE (id = NEW.post_id);
+    UPDATE site_stats SET comments_count = comments_count + 1 WHERE (id = 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_count_delete AFTER DELETE ON comments
+BEGIN
+    UPDATE posts SET comments_count = comments_count - 1 WHERE (id = OLD.post_id);
+    UPDATE site_stats SET comments_count = comments_count - 1 WHERE (id = 1);
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_count_move AFTER UPDATE OF post_id ON comments
+WHEN (OLD.post_id <> NEW.post_id)
+BEGIN
+    UPDATE posts SET comments_count = comments_count - 1 WHERE (id = OLD.post_id);
+    UPDATE posts SET comments_count = comments_count + 1 WHERE (id = NEW.post_id);
+END;
@@ -0,0 +1,57 @@
+-- Full text indexes over the posts and the comments, they don't store
+-- a copy of the text(external content tables) and are kept in sync
+-- by the triggers below, `flask fts-rebuild` rebuilds them from scratch.
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    title,
+    content,
+    content = 'posts',
+    content_rowid = 'id',
+    prefix = '3',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(
+    content,
+    content = 'comments',
+    content_rowid = 'id',
+    prefix = '3',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- A match inside the title weighs ten times a match inside the content
+INSERT INTO posts_fts (posts_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)');
+
+INSERT INTO posts_fts (posts_fts) VALUES ('rebuild');
+INSERT INTO comments_fts (comments_fts) VALUES ('rebuild');
+
+CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts
+BEGIN
+    INSERT INTO posts_fts (rowid, title, content) VALUES (NEW.id, NEW.title, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts
+BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', OLD.id, OLD.title, OLD.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, content ON posts
+BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, title, content) VALUES ('delete', OLD.id, OLD.title, OLD.content);
+    INSERT INTO posts_fts (rowid, title, content) VALUES (NEW.id, NEW.title, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_fts_insert AFTER INSERT ON comments
+BEGIN
+    INSERT INTO comments_fts (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_fts_delete AFTER DELETE ON comments
+BEGIN
+    INSERT INTO comments_fts (comments_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_fts_update AFTER UPDATE OF content ON comments
+BEGIN
+    INSERT INTO comments_fts (comments_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+    INSERT INTO comments_fts (rowid, content) VALUES (NEW.id, NEW.content);
+END;
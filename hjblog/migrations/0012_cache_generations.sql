@@ -0,0 +1,7 @@
+-- Generation counters of the fragment cache, kept in the database so an
+-- invalidation done by one worker is seen by every worker, whatever
+-- the backend of the cache.
+CREATE TABLE IF NOT EXISTS cache_generations (
+    name VARCHAR(60) PRIMARY KEY,
+    value INTEGER NOT NULL
+);
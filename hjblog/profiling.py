@@ -0,0 +1,238 @@
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import Flask, Response, current_app, g, request, session
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+
+PROFILER_EXTENSION = "hjblog.profiler"
+# Threads serving a request, the only ones a window samples
+REQUESTS_EXTENSION = "hjblog.profiler_requests"
+# Tokens already used, by expiry
+USED_TOKENS_EXTENSION = "hjblog.profiler_used_tokens"
+# Query argument that carries the signed token enabling the profile of a request
+PROFILE_ARG = "_profile"
+# Names of the profiles written inside `PROFILES_DIR`
+PROFILE_NAME = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9]+-[a-z0-9_-]+\.collapsed$")
+_profiler_lock = threading.Lock()
+
+
+def describe(frame) -> str:
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+    # `;` separates the frames of a collapsed stack
+    return f"{code.co_name} ({file_name}:{code.co_firstlineno})".replace(";", ":")
+
+
+def collapse(frame, root: str) -> str:
+    """Returns the stack of `frame` in the collapsed format, from
+    the outermost frame(`root` first) to `frame`, separated by `;`.
+    """
+    frames = []
+    while frame is not None:
+        frames.append(describe(frame))
+        frame = frame.f_back
+    frames.append(root)
+    frames.reverse()
+    return ";".join(frames)
+
+
+class Sampler:
+    """Statistical profiler: a thread takes a snapshot of the stacks of
+    the other threads every `interval` seconds and counts how many times
+    every stack has been seen, the overhead doesn't depend on how much
+    code runs, only on the interval.
+    If `thread_ids` is given only those threads are sampled, the set can
+    change while sampling.
+    """
+
+    def __init__(self, interval: float, thread_ids: set[int] | None = None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.samples: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="hjblog-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> Counter[str]:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                if self.thread_ids is not None and thread_id not in self.thread_ids:
+                    continue
+                root = names.get(thread_id, str(thread_id)).replace(";", ":")
+                self.samples[collapse(frame, root)] += 1
+
+
+def get_profiles_dir(app: Flask) -> str:
+    return app.config["PROFILES_DIR"]
+
+
+def write_profile(app: Flask, samples: Counter[str], label: str) -> str:
+    """Writes `samples` inside the profiles directory in the collapsed
+    stack format, that `flamegraph.pl`, speedscope and inferno read as
+    they are, only the newest `PROFILES_MAX_FILES` profiles are kept.
+    Returns the name of the file.
+    """
+    label = re.sub(r"[^a-z0-9_-]+", "-", label.lower()).strip("-")[:60] or "root"
+    started = datetime.now().strftime("%Y%m%d-%H%M%S")
+    name = f"{started}-{os.getpid()}-{label}.collapsed"
+    directory = get_profiles_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), "w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    for old in list_profiles(app)[app.config["PROFILES_MAX_FILES"] :]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except FileNotFoundError:
+            pass
+    return name
+
+
+def list_profiles(app: Flask) -> list[str]:
+    """Returns the names of the profiles written so far, newest first."""
+    try:
+        names = os.listdir(get_profiles_dir(app))
+    except FileNotFoundError:
+        return []
+    return sorted((n for n in names if PROFILE_NAME.match(n)), reverse=True)
+
+
+def start_window(app: Flask, seconds: float) -> bool:
+    """Samples the threads of this process that are serving a request for
+    `seconds`, idle server threads and background threads are left out,
+    then writes the profile. Returns `False` if a window is already open
+    in this process.
+    """
+    with _profiler_lock:
+        if app.extensions.get(PROFILER_EXTENSION, None) is not None:
+            return False
+        sampler = Sampler(
+            app.config["PROFILE_WINDOW_INTERVAL"], app.extensions[REQUESTS_EXTENSION]
+        )
+        app.extensions[PROFILER_EXTENSION] = sampler
+    sampler.start()
+
+    def close():
+        time.sleep(seconds)
+        try:
+            write_profile(app, sampler.stop(), f"window-{int(seconds)}s")
+        finally:
+            app.extensions.pop(PROFILER_EXTENSION, None)
+
+    threading.Thread(target=close, name="hjblog-profile-window", daemon=True).start()
+    return True
+
+
+def get_window(app: Flask) -> Sampler | None:
+    return app.extensions.get(PROFILER_EXTENSION, None)
+
+
+def get_serializer() -> URLSafeTimedSerializer:
+    return URLSafeTimedSerializer(
+        current_app.config["SECRET_KEY"], salt="hjblog.profile"
+    )
+
+
+def sign_path(path: str, user_id: int) -> str:
+    """Returns the token that enables the profile of a request to `path`,
+    made by the user `user_id`.
+    """
+    return get_serializer().dumps(
+        {"path": path, "user_id": user_id, "nonce": secrets.token_urlsafe(8)}
+    )
+
+
+def use_token(token: str) -> bool:
+    """Returns `True` if `token` is valid for the current request: signed
+    less than `PROFILE_LINK_MAX_AGE` seconds ago for its path, sent by the
+    user it was signed for and never used before in this process, so a
+    leaked link can't be replayed.
+    """
+    max_age = current_app.config["PROFILE_LINK_MAX_AGE"]
+    try:
+        data = get_serializer().loads(token, max_age=max_age)
+    except BadSignature:
+        return False
+    if (
+        not isinstance(data, dict)
+        or data.get("path", None) != request.path
+        or data.get("user_id", None) is None
+        or data["user_id"] != session.get("user_id", None)
+    ):
+        return False
+
+    used: dict[str, float] = current_app.extensions[USED_TOKENS_EXTENSION]
+    now = time.monotonic()
+    with _profiler_lock:
+        for expired in [t for t, expires in used.items() if expires < now]:
+            del used[expired]
+        if token in used:
+            return False
+        used[token] = now + max_age
+    return True
+
+
+def start_request_profile():
+    """Profiles the current request if it carries a valid token, see
+    `use_token`. The request is made visible to the sampling windows too.
+    """
+    current_app.extensions[REQUESTS_EXTENSION].add(threading.get_ident())
+    token = request.args.get(PROFILE_ARG, None)
+    if token is None or not use_token(token):
+        return
+    g.profiler = Sampler(
+        current_app.config["PROFILE_REQUEST_INTERVAL"], {threading.get_ident()}
+    )
+    g.profiler.start()
+
+
+def stop_request_profile(response: Response) -> Response:
+    """Writes the profile of the current request, its name is sent
+    back through the `X-Profile` header.
+    """
+    sampler: Sampler | None = g.pop("profiler", None)
+    if sampler is None:
+        return response
+    app = current_app._get_current_object()
+    response.headers["X-Profile"] = write_profile(
+        app, sampler.stop(), f"{request.method}-{request.path}"
+    )
+    return response
+
+
+def end_request(__e__=None):
+    current_app.extensions[REQUESTS_EXTENSION].discard(threading.get_ident())
+
+
+def init_app(app: Flask):
+    """A request is profiled when `_profile` carries a token signed for
+    its path, see the admin routes. It has to be initialized before
+    the other extensions, so the profile covers their work too.
+    """
+    app.extensions[REQUESTS_EXTENSION] = set()
+    app.extensions[USED_TOKENS_EXTENSION] = {}
+    app.before_request(start_request_profile)
+    app.after_request(stop_request_profile)
+    app.teardown_request(end_request)
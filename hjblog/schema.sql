@@ -2,6 +2,17 @@ DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS posts;
 DROP TABLE IF EXISTS comments;
 DROP TABLE IF EXISTS cities;
+DROP TABLE IF EXISTS schema_version;
+DROP TABLE IF EXISTS upstream_flights;
+DROP TABLE IF EXISTS upstream_flight_stats;
+DROP TABLE IF EXISTS upstream_breakers;
+DROP TABLE IF EXISTS picture_jobs;
+DROP TABLE IF EXISTS uploads;
+DROP TABLE IF EXISTS maintenance_leases;
+DROP TABLE IF EXISTS site_stats;
+DROP TABLE IF EXISTS posts_fts;
+DROP TABLE IF EXISTS comments_fts;
+DROP TABLE IF EXISTS cache_generations;
 
 CREATE TABLE users (
     id INTEGER PRIMARY KEY,
@@ -0,0 +1,375 @@
+import hashlib
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Iterator
+
+from flask import Flask, current_app
+
+from hjblog.db import get_db
+
+
+# Uploads are named after the SHA-256 of their content
+CONTENT_NAME = re.compile(r"^[0-9a-f]{64}$")
+# Files that belong to an upload are named `<name>_<variant>`
+VARIANT_NAME = re.compile(r"^([0-9a-f]+)_[^/]+$")
+GC_EXTENSION = "hjblog.uploads_gc"
+GC_LEASE = "uploads_gc"
+_gc_lock = threading.Lock()
+
+
+def content_name(data: bytes) -> str:
+    """Returns the name of the upload whose content is `data`."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_content_name(name: str) -> bool:
+    return CONTENT_NAME.match(name) is not None
+
+
+def shard(name: str) -> str:
+    """Returns the directory, relative to `UPLOAD_DIR`, that contains the files
+    of the upload `name`: two levels named after the first four characters
+    of the name, so no directory grows past a few hundred entries.
+    Uploads stored before the content addressed store live in `UPLOAD_DIR`
+    itself, an empty string is returned for them.
+    """
+    if not is_content_name(name):
+        return ""
+    return f"{name[:2]}/{name[2:4]}"
+
+
+def acquire(name: str, files: list[str]) -> bool:
+    """Adds a reference to the upload `name` if it is already stored,
+    in which case `True` is returned and the content doesn't need to be
+    stored again.
+    The modification time of its `files`(relative to `UPLOAD_DIR`) is
+    updated first, so `collect_garbage` doesn't take them for old orphans.
+    """
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    try:
+        for file in files:
+            os.utime(os.path.join(upload_dir, file))
+    except FileNotFoundError:
+        return False
+    db = get_db()
+    acquired = (
+        db.execute(
+            "UPDATE uploads SET refcount = refcount + 1 WHERE (name = ? AND refcount > 0)",
+            (name,),
+        ).rowcount
+        == 1
+    )
+    db.commit()
+    return acquired
+
+
+def register(name: str, files: list[str]) -> bool:
+    """Adds a reference to the upload `name`, whose `files`(relative to
+    `UPLOAD_DIR`) have just been written. `False` is returned if the files
+    have been removed in the meantime by `release`, in that case no
+    reference is added.
+    """
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    db = get_db()
+    # `release` removes the files while holding the write lock too
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if not all(os.path.exists(os.path.join(upload_dir, f)) for f in files):
+            db.rollback()
+            return False
+        db.execute(
+            "INSERT INTO uploads (name, refcount) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET refcount = refcount + 1",
+            (name,),
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
+
+
+def release(name: str, files: list[str]):
+    """Removes a reference to the upload `name`, when the last one is gone
+    its `files`(relative to `UPLOAD_DIR`) are removed.
+    """
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute(
+            "UPDATE uploads SET refcount = refcount - 1 WHERE (name = ?)", (name,)
+        )
+        unreferenced = (
+            db.execute(
+                "DELETE FROM uploads WHERE (name = ? AND refcount <= 0) RETURNING name",
+                (name,),
+            ).fetchone()
+            is not None
+        )
+        if unreferenced:
+            for file in files:
+                try:
+                    os.remove(os.path.join(upload_dir, file))
+                except FileNotFoundError as e:
+                    logging.exception(e)
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    except Exception:
+        # Unexpected behaviour
+        db.rollback()
+        raise
+
+
+def write_file(upload_dir: str, file: str, save):
+    """Writes the file `file`, relative to `upload_dir`, through `save`,
+    that receives the path to write to. The file is written aside and then
+    moved in place, so a file is never seen half written, even if
+    the same content is being stored by someone else at the same time.
+    """
+    path = os.path.join(upload_dir, file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+    try:
+        save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class GCReport:
+    """What `collect_garbage` found, and removed unless it was a dry run."""
+
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        # files examined
+        self.scanned = 0
+        # files used by a user
+        self.referenced = 0
+        # unused files kept since they could belong to an upload in progress
+        self.recent = 0
+        # unused files removed(or that would have been removed)
+        self.removed = 0
+        self.removed_bytes = 0
+        # users whose picture is missing from the filesystem
+        self.dangling = 0
+
+    def lines(self) -> list[str]:
+        verb = "Would remove" if self.dry_run else "Removed"
+        return [
+            f"Files scanned: {self.scanned}",
+            f"Files in use: {self.referenced}",
+            f"Unused files kept since too recent: {self.recent}",
+            f"{verb}: {self.removed} files, {self.removed_bytes} bytes",
+            f"Users whose picture is missing: {self.dangling}",
+        ]
+
+
+def upload_of(file: str) -> str:
+    """Returns the name of the upload the file `file` belongs to, as stored
+    in `users.profile_pic`.
+    """
+    file_name = os.path.basename(file)
+    match = VARIANT_NAME.match(file_name)
+    if match is not None:
+        return match.group(1)
+    # single file uploads are named after the file itself
+    return file_name
+
+
+def _scan(upload_dir: str) -> Iterator[str]:
+    """Yields the path, relative to `upload_dir`, of every file inside it,
+    one directory at a time, so even a huge volume is never listed at once.
+    """
+    directories = [""]
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(os.path.join(upload_dir, directory)) as entries:
+                for entry in entries:
+                    path = f"{directory}/{entry.name}" if directory else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield path
+        except FileNotFoundError:
+            # removed in the meantime
+            continue
+
+
+def _batches(items: Iterator, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _throttle(started: float, operations: int, rate: float):
+    """Sleeps long enough to keep the pace under `rate` operations per second."""
+    if rate <= 0:
+        return
+    delay = operations / rate - (time.monotonic() - started)
+    if delay > 0:
+        time.sleep(delay)
+
+
+def collect_garbage(
+    batch_size: int, rate: float, min_age: float, dry_run: bool
+) -> GCReport:
+    """Removes the files of `UPLOAD_DIR` that no user references.
+    The upload directory is walked `batch_size` files at a time: the uploads
+    of a batch are looked up in `users.profile_pic` with a single query,
+    and the unused files are removed while holding the write lock, so
+    a picture can't start being used in the meantime. Files modified
+    in the last `min_age` seconds are kept, they could belong to an upload
+    that is still being processed or has just been reused(see `acquire`).
+    Then the users are paged through, `batch_size` at a time, counting the
+    pictures missing from the filesystem.
+    The I/O is paced to `rate` files per second, so the procedure can run
+    on a live volume; with `dry_run` nothing is removed.
+    """
+    # imported here since the layout of the pictures is defined by the blueprint
+    from hjblog.bps.user_profile.auxiliaries import get_picture_files
+
+    upload_dir = current_app.config["UPLOAD_DIR"]
+    report = GCReport(dry_run)
+    db = get_db()
+
+    for batch in _batches(_scan(upload_dir), batch_size):
+        started = time.monotonic()
+        names = {upload_of(file) for file in batch}
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            referenced = {
+                row[0]
+                for row in db.execute(
+                    f"SELECT DISTINCT profile_pic FROM users WHERE profile_pic IN ({', '.join('?' * len(names))})",
+                    list(names),
+                )
+            }
+            now = time.time()
+            orphans = set()
+            for file in batch:
+                report.scanned += 1
+                temporary = file.endswith(".tmp")
+                if upload_of(file) in referenced and not temporary:
+                    report.referenced += 1
+                    continue
+                path = os.path.join(upload_dir, file)
+                try:
+                    stat = os.stat(path)
+                    if now - stat.st_mtime < min_age:
+                        report.recent += 1
+                        continue
+                    if not dry_run:
+                        os.remove(path)
+                except FileNotFoundError:
+                    continue
+                report.removed += 1
+                report.removed_bytes += stat.st_size
+                if not temporary:
+                    orphans.add(upload_of(file))
+            orphans = [name for name in orphans if is_content_name(name)]
+            if orphans and not dry_run:
+                db.execute(
+                    f"DELETE FROM uploads WHERE name IN ({', '.join('?' * len(orphans))})",
+                    orphans,
+                )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        _throttle(started, len(batch), rate)
+
+    last_id = 0
+    while True:
+        started = time.monotonic()
+        users = db.execute(
+            "SELECT id, profile_pic FROM users WHERE (id > ? AND profile_pic IS NOT NULL) ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        if not users:
+            break
+        last_id = users[-1]["id"]
+        operations = 0
+        for user in users:
+            files = get_picture_files(user["profile_pic"])
+            operations += len(files)
+            if not all(os.path.exists(os.path.join(upload_dir, f)) for f in files):
+                report.dangling += 1
+        _throttle(started, operations, rate)
+
+    return report
+
+
+def take_lease(name: str, duration: float) -> bool:
+    """Returns `True` if the process holds the lease `name`, a lease is held
+    by a single process at a time and expires after `duration` seconds
+    unless it is taken again by the same process.
+    """
+    db = get_db()
+    now = time.time()
+    owner = str(os.getpid())
+    taken = (
+        db.execute(
+            "INSERT INTO maintenance_leases (name, owner, expires) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires WHERE (maintenance_leases.expires < ? OR maintenance_leases.owner = excluded.owner)",
+            (name, owner, now + duration, now),
+        ).rowcount
+        == 1
+    )
+    db.commit()
+    return taken
+
+
+def start_gc():
+    """Starts, once per process, the thread that runs `collect_garbage` every
+    `UPLOADS_GC_INTERVAL` seconds, a lease makes sure that only one process
+    at a time collects the garbage. Nothing is started if the interval is 0.
+    """
+    interval = current_app.config["UPLOADS_GC_INTERVAL"]
+    if interval <= 0 or current_app.extensions.get(GC_EXTENSION, None) == os.getpid():
+        return
+    with _gc_lock:
+        if current_app.extensions.get(GC_EXTENSION, None) == os.getpid():
+            return
+        current_app.extensions[GC_EXTENSION] = os.getpid()
+
+    app = current_app._get_current_object()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    if not take_lease(GC_LEASE, interval):
+                        continue
+                    report = collect_garbage(
+                        app.config["UPLOADS_GC_BATCH_SIZE"],
+                        app.config["UPLOADS_GC_RATE"],
+                        app.config["UPLOADS_GC_MIN_AGE"],
+                        dry_run=False,
+                    )
+                    logging.info("Uploads garbage collection: " + ", ".join(report.lines()))
+            except Exception as e:
+                # Unexpected behaviour
+                logging.exception(e)
+
+    threading.Thread(target=run, name="uploads-gc", daemon=True).start()
+
+
+def init_app(app: Flask):
+    """The garbage collector thread is started by the first request of
+    every process, so it is never started before a server forks its workers.
+    """
+    app.before_request(start_gc)
@@ -8,7 +8,9 @@ import pytest
 from werkzeug.test import TestResponse
 
 from hjblog import create
-from hjblog.db import get_db
+from hjblog.db import close_pool, get_db, init_db
+from hjblog.jobs import close_job_queue
+from hjblog.metrics import close_store
 
 
 with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as var:
@@ -22,6 +24,7 @@ def app():
     """
     db_fd, db_path = tempfile.mkstemp()
     upload_dir = tempfile.TemporaryDirectory()
+    metrics_dir = tempfile.TemporaryDirectory()
 
     app = create(
         test_config={
@@ -29,21 +32,29 @@ def app():
             "SECRET_KEY": "test",
             "DATABASE": db_path,
             "UPLOAD_DIR": upload_dir.name,
+            "METRICS_DIR": metrics_dir.name,
             # This is necessary for unit test, otherwise I wan't be able to
             # send the correct cookie back when testing the forms
             "WTF_CSRF_ENABLED": False,
+            # Pictures are processed inside the request
+            "IMAGE_JOBS_WORKERS": 0,
         }
     )
 
     with app.app_context():
+        assert init_db() is None
         db = get_db()
         db.executescript(data_sql)
 
     yield app
 
+    close_job_queue(app)
+    close_pool(app)
+    close_store(app)
     os.close(db_fd)
     os.unlink(db_path)
     upload_dir.cleanup()
+    metrics_dir.cleanup()
 
 
 @pytest.fixture
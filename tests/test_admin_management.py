@@ -0,0 +1,257 @@
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+import pytest
+from flask.testing import FlaskCliRunner
+
+from hjblog.bps.user_profile.auxiliaries import get_picture_files
+from hjblog.datagen import generate, suspended_triggers
+from hjblog.db import get_db
+from hjblog.uploads import take_lease
+
+
+def test_upstream_stats(runner: FlaskCliRunner):
+    """`upstream-stats` should display the counters of the calls
+    to the weather backend and the ratio of calls saved.
+    """
+    with runner.app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO upstream_flight_stats (name, value) VALUES ('executed', 3), ('coalesced', 5), ('shared_coalesced', 2)"
+        )
+        db.commit()
+
+        result = runner.invoke(args=["upstream-stats"])
+    assert "Upstream calls executed: 3" in result.output
+    assert "Coalesced inside a process: 5" in result.output
+    assert "Coalesced across processes: 2" in result.output
+    assert "Calls saved: 70.0%" in result.output
+
+
+def test_breaker_status(runner: FlaskCliRunner):
+    """`breaker-status` should display the state of the circuit breakers
+    of every process.
+    """
+    with runner.app.app_context():
+        result = runner.invoke(args=["breaker-status"])
+        assert "Every circuit breaker is closed." in result.output
+
+        db = get_db()
+        db.execute(
+            "INSERT INTO upstream_breakers (name, pid, state, failures, changed) VALUES ('https://api.open-meteo.com/v1/forecast', 42, 'open', 5, 0)"
+        )
+        db.commit()
+        result = runner.invoke(args=["breaker-status"])
+    assert (
+        "https://api.open-meteo.com/v1/forecast (pid 42): open, 5 consecutive failures"
+        in result.output
+    )
+
+
+def test_gc_uploads(runner: FlaskCliRunner):
+    """`gc-uploads` should remove the uploaded files nobody references,
+    keeping the recent ones, report what it would do with `--dry-run`
+    and count the users whose picture is missing.
+    """
+    app = runner.app
+    upload_dir = app.config["UPLOAD_DIR"]
+    used = "a" * 64
+    orphan = "b" * 64
+    missing = "c" * 64
+    old = time.time() - 2 * 60 * 60
+
+    def write(file: str, age: float = old):
+        path = os.path.join(upload_dir, file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"1234")
+        os.utime(path, (age, age))
+
+    for file in get_picture_files(used) + get_picture_files(orphan):
+        write(file)
+    write("0123456789abcdef.png")
+    write("fedcba9876543210.png", time.time())
+    write(get_picture_files(used)[0] + ".1a2b.tmp")
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET profile_pic = ? WHERE (username = 'admin')", (used,))
+        db.execute("UPDATE users SET profile_pic = ? WHERE (username = 'prova')", (missing,))
+        db.execute(
+            "INSERT INTO uploads (name, refcount) VALUES (?, 1), (?, 1)", (used, orphan)
+        )
+        db.commit()
+
+    with app.app_context():
+        result = runner.invoke(args=["gc-uploads", "--dry-run", "--batch-size", "3"])
+    assert "Dry run, nothing has been removed." in result.output
+    assert "Files scanned: 19" in result.output
+    assert "Files in use: 8" in result.output
+    assert "Unused files kept since too recent: 1" in result.output
+    assert "Would remove: 10 files, 40 bytes" in result.output
+    assert "Users whose picture is missing: 1" in result.output
+    for file in get_picture_files(orphan):
+        assert os.path.exists(os.path.join(upload_dir, file))
+
+    with app.app_context():
+        result = runner.invoke(args=["gc-uploads", "--batch-size", "3", "--rate", "0"])
+    assert "Removed: 10 files, 40 bytes" in result.output
+    for file in get_picture_files(orphan):
+        assert not os.path.exists(os.path.join(upload_dir, file))
+    for file in get_picture_files(used):
+        assert os.path.exists(os.path.join(upload_dir, file))
+    assert os.path.exists(os.path.join(upload_dir, "fedcba9876543210.png"))
+    assert not os.path.exists(os.path.join(upload_dir, "0123456789abcdef.png"))
+    with app.app_context():
+        names = [
+            row["name"] for row in get_db().execute("SELECT name FROM uploads")
+        ]
+        assert names == [used]
+
+        # a single process at a time runs the background collection
+        assert take_lease("uploads_gc", 60)
+        assert take_lease("uploads_gc", 60)
+        get_db().execute("UPDATE maintenance_leases SET owner = 'other'")
+        get_db().commit()
+        assert not take_lease("uploads_gc", 60)
+
+
+def test_gen_data(runner: FlaskCliRunner):
+    """`gen-data` should add the rows next to the existing ones, without
+    breaking the counters, and report the throughput.
+    """
+    with runner.app.app_context():
+        db = get_db()
+        before = {
+            table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("users", "posts", "comments", "cities")
+        }
+        triggers = db.execute(
+            "SELECT name, sql FROM sqlite_master WHERE (type = 'trigger') ORDER BY name"
+        ).fetchall()
+        args = ["gen-data", "--users", "50", "--posts", "20", "--comments", "500"]
+        args += ["--cities", "5", "--batch-size", "64"]
+        result = runner.invoke(args=args)
+        assert "comments: 500 rows" in result.output
+        assert "Total: 575 rows" in result.output
+        after = {
+            table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in before
+        }
+        assert after == {
+            "users": before["users"] + 50,
+            "posts": before["posts"] + 20,
+            "comments": before["comments"] + 500,
+            "cities": before["cities"] + 5,
+        }
+        stats = db.execute(
+            "SELECT posts_count, comments_count FROM site_stats"
+        ).fetchone()
+        assert (stats["posts_count"], stats["comments_count"]) == (
+            after["posts"],
+            after["comments"],
+        )
+        # every comment belongs to an existing post and user, after its post
+        orphans = db.execute(
+            "SELECT COUNT(*) FROM comments LEFT JOIN posts ON (posts.id = comments.post_id) LEFT JOIN users ON (users.id = comments.author_id) WHERE (posts.id IS NULL OR users.id IS NULL OR comments.written < posts.posted)"
+        ).fetchone()[0]
+        assert orphans == 0
+        # the triggers suspended while loading are back
+        assert (
+            db.execute(
+                "SELECT name, sql FROM sqlite_master WHERE (type = 'trigger') ORDER BY name"
+            ).fetchall()
+            == triggers
+        )
+        assert (
+            db.execute(
+                "SELECT COUNT(*) FROM comments_fts WHERE (comments_fts MATCH 'lorem')"
+            ).fetchone()[0]
+            > 0
+        )
+        # posts are written by the admins of the test data
+        assert (
+            db.execute(
+                "SELECT COUNT(*) FROM posts JOIN users ON (users.id = posts.author_id) WHERE (users.is_admin = FALSE)"
+            ).fetchone()[0]
+            == 0
+        )
+
+        result = runner.invoke(args=["gen-data", "--users", "-1"])
+        assert "Error" in result.output
+
+
+def test_gen_data_conflicts(runner: FlaskCliRunner):
+    """`gen-data` should check the request before writing anything and
+    never reuse the name of an existing user.
+    """
+    with runner.app.app_context():
+        db = get_db()
+        taken = db.execute("SELECT MAX(id) FROM users").fetchone()[0] + 2
+        db.execute(
+            "INSERT INTO users (username, email, hash_pass) VALUES (?, ?, 'x')",
+            (f"user-{taken}", f"user-{taken}@example.com"),
+        )
+        db.commit()
+        args = ["gen-data", "--users", "5", "--posts", "0", "--comments", "0"]
+        result = runner.invoke(args=args + ["--cities", "0"])
+        assert "users: 5 rows" in result.output
+        assert (
+            db.execute(
+                "SELECT COUNT(*) FROM users WHERE (username GLOB 'user-*')"
+            ).fetchone()[0]
+            == 6
+        )
+
+        db.execute("DELETE FROM comments")
+        db.execute("DELETE FROM posts")
+        db.commit()
+        users = db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        cities = db.execute("SELECT COUNT(*) FROM cities").fetchone()[0]
+        args = ["gen-data", "--users", "5", "--posts", "0", "--comments", "10"]
+        result = runner.invoke(args=args + ["--cities", "2"])
+        assert "Comments need at least one user and one post." in result.output
+        assert db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == users
+        assert db.execute("SELECT COUNT(*) FROM cities").fetchone()[0] == cities
+
+
+def test_gen_data_utc(runner: FlaskCliRunner, monkeypatch: pytest.MonkeyPatch):
+    """The generated dates should be in UTC, whatever the local timezone."""
+    monkeypatch.setenv("TZ", "Asia/Tokyo")
+    time.tzset()
+    try:
+        with runner.app.app_context():
+            db = get_db()
+            first = db.execute("SELECT MAX(id) FROM comments").fetchone()[0]
+            generate(5, 5, 200, 0, 0, datetime(2025, 1, 1, tzinfo=timezone.utc))
+            latest = db.execute(
+                "SELECT MAX(written) FROM comments WHERE (id > ?)", (first,)
+            ).fetchone()[0]
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert latest == "2025-01-01 00:00:00"
+
+
+def test_suspended_triggers_locked(runner: FlaskCliRunner):
+    """The triggers shouldn't be dropped while another connection
+    is writing to the database.
+    """
+    with runner.app.app_context():
+        db = get_db()
+        count = "SELECT COUNT(*) FROM sqlite_master WHERE (type = 'trigger')"
+        triggers = db.execute(count).fetchone()[0]
+        db.execute("BEGIN IMMEDIATE")
+        other = sqlite3.connect(runner.app.config["DATABASE"], timeout=0.1)
+        with pytest.raises(sqlite3.OperationalError):
+            with suspended_triggers(other, ("posts", "comments")):
+                pass
+        db.rollback()
+
+        with pytest.raises(RuntimeError):
+            with suspended_triggers(other, ("posts", "comments")):
+                assert other.execute(count).fetchone()[0] < triggers
+                raise RuntimeError()
+        other.close()
+        assert db.execute(count).fetchone()[0] == triggers
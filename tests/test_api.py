@@ -0,0 +1,141 @@
+import json
+import sqlite3
+from flask.testing import FlaskClient
+
+from conftest import AuthActions
+from hjblog.bps.api.helpers import stream_page
+from hjblog.db import get_db
+
+
+def test_posts(client: FlaskClient):
+    """The list of posts should be paginated through its cursor, leave
+    the content out unless it is selected, return only the posts
+    published after `since` and answer with 304 while nothing changed.
+    """
+    with client.application.app_context():
+        db = get_db()
+        for i in range(3, 8):
+            db.execute(
+                "INSERT INTO posts (title, content, author_id, posted) VALUES (?, ?, ?, ?)",
+                (f"test-title-{i}", "Content.", 2, f"2030-01-0{i} 00:00:00"),
+            )
+        db.commit()
+
+    res = client.get("/api/v1/posts?limit=3")
+    assert res.status_code == 200
+    assert res.mimetype == "application/json"
+    assert "Cookie" not in res.headers.get("Vary", "")
+    page = res.get_json()
+    assert [p["title"] for p in page["data"]] == [
+        "test-title-7",
+        "test-title-6",
+        "test-title-5",
+    ]
+    assert "content" not in page["data"][0]
+    assert page["data"][0]["posted"] == "2030-01-07T00:00:00Z"
+
+    titles = [p["title"] for p in page["data"]]
+    while page["next"] is not None:
+        page = client.get(f"/api/v1/posts?limit=3&cursor={page['next']}").get_json()
+        titles += [p["title"] for p in page["data"]]
+    assert titles == [f"test-title-{i}" for i in range(7, -1, -1)]
+
+    page = client.get("/api/v1/posts?fields=id,content&since=2030-01-05").get_json()
+    assert [set(p) for p in page["data"]] == [{"id", "content"}] * 2
+    assert client.get("/api/v1/posts?fields=password").status_code == 400
+    assert client.get("/api/v1/posts?limit=0").status_code == 400
+    assert client.get("/api/v1/posts?since=yesterday").status_code == 400
+
+    etag = res.headers["ETag"]
+    res = client.get("/api/v1/posts?limit=3", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    with client.application.app_context():
+        db = get_db()
+        db.execute("DELETE FROM posts WHERE (id = 4)")
+        db.commit()
+    res = client.get("/api/v1/posts?limit=3", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+
+
+def test_post_comments(client: FlaskClient):
+    """A post should be returned with its first comments, its comments
+    should be paginated oldest first and the ETag should change when a
+    comment is written.
+    """
+    assert client.get("/api/v1/posts/100").status_code == 404
+    assert client.get("/api/v1/posts/100").get_json()["error"]
+
+    res = client.get("/api/v1/posts/1")
+    post = res.get_json()
+    assert post["title"] == "test-title-0"
+    assert post["comments_count"] == 1
+    assert len(post["comments"]) == 1
+    assert post["comments_next"] is None
+    etag = res.headers["ETag"]
+
+    with client.application.app_context():
+        db = get_db()
+        for i in range(5):
+            db.execute(
+                "INSERT INTO comments (post_id, content, author_id, written) VALUES (?, ?, ?, ?)",
+                (1, f"comment-{i}", 1, f"2030-01-0{i + 1} 00:00:00"),
+            )
+        db.commit()
+
+    res = client.get("/api/v1/posts/1", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.get_json()["comments_count"] == 6
+    res = client.get("/api/v1/posts/1/comments", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+    res = client.get("/api/v1/posts/1/comments", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+
+    page = client.get("/api/v1/posts/1?limit=2").get_json()
+    contents = [c["content"] for c in page["comments"]]
+    cursor = page["comments_next"]
+    while cursor is not None:
+        page = client.get(
+            f"/api/v1/posts/1/comments?limit=2&fields=content&cursor={cursor}"
+        ).get_json()
+        contents += [c["content"] for c in page["data"]]
+        cursor = page["next"]
+    assert contents[1:] == [f"comment-{i}" for i in range(5)]
+
+    page = client.get("/api/v1/posts/1/comments?since=2030-01-03T00:00:00Z").get_json()
+    assert [c["content"] for c in page["data"]] == ["comment-3", "comment-4"]
+
+
+def test_etag_username(client: FlaskClient, auth: AuthActions):
+    """The ETags should change when an author changes username."""
+    res = client.get("/api/v1/posts")
+    assert "mario" not in [p["author"] for p in res.get_json()["data"]]
+    etag = res.headers["ETag"]
+    post_etag = client.get("/api/v1/posts/1").headers["ETag"]
+    auth.login(username="admin", password="prova")
+    client.post("/change_username", data={"username": "mario", "submit": "Submit"})
+    res = client.get("/api/v1/posts", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert "mario" in [p["author"] for p in res.get_json()["data"]]
+    res = client.get("/api/v1/posts/1", headers={"If-None-Match": post_etag})
+    assert res.status_code == 200
+
+
+def test_stream_error():
+    """A page that fails after the response started should be closed
+    with an error, still as valid JSON.
+    """
+
+    class FailingRows:
+        closed = False
+
+        def fetchone(self):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        def close(self):
+            self.closed = True
+
+    rows = FailingRows()
+    body = json.loads("".join(stream_page({"id": 1}, rows, ["id"], 10)))  # type: ignore
+    assert body == {"data": [{"id": 1}], "error": "Internal Server Error"}
+    assert rows.closed
@@ -0,0 +1,68 @@
+import json
+import os
+import re
+import shutil
+from flask import Flask, url_for
+from flask.testing import FlaskClient, FlaskCliRunner
+
+
+def test_fingerprinted_assets(app: Flask, client: FlaskClient):
+    """Pages should link the static files through their fingerprinted name,
+    which is served with immutable caching, while the plain name and an
+    outdated fingerprint are still served but revalidated.
+    """
+    res = client.get("/")
+    found = re.search(r'href="(/static/style\.[0-9a-f]{10}\.css)"', res.data.decode())
+    assert found is not None
+
+    res = client.get(found.group(1))
+    assert res.status_code == 200
+    assert res.mimetype == "text/css"
+    assert res.cache_control.immutable
+    assert res.cache_control.max_age == app.config["ASSETS_MAX_AGE"]
+    css = res.data
+    res.close()
+
+    for path in ("/static/style.css", "/static/style.0123456789.css"):
+        res = client.get(path)
+        assert res.status_code == 200
+        assert res.data == css
+        assert not res.cache_control.immutable
+        res.close()
+
+    assert client.get("/static/missing.0123456789.css").status_code == 404
+
+
+def test_build_assets(app: Flask, runner: FlaskCliRunner):
+    """`build-assets` should write the manifest, which is used in place
+    of computing the fingerprints as long as the static files don't change.
+    """
+    static_folder = os.path.join(app.config["UPLOAD_DIR"], "static")
+    shutil.copytree(app.static_folder, static_folder)
+    app.static_folder = static_folder
+
+    with app.app_context():
+        result = runner.invoke(args=["build-assets"])
+    assert re.search(r"style\.css -> style\.[0-9a-f]{10}\.css", result.output)
+    with open(os.path.join(static_folder, "manifest.json")) as f:
+        manifest = json.load(f)
+    manifest["files"]["style.css"] = "style.from-manifest.css"
+    with open(os.path.join(static_folder, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    app.extensions.pop("hjblog.assets", None)
+    with app.test_request_context():
+        assert url_for("static", filename="style.css") == (
+            "/static/style.from-manifest.css"
+        )
+
+    # the stylesheet is edited without running `build-assets` again
+    style = os.path.join(static_folder, "style.css")
+    with open(style, "a") as f:
+        f.write("\n")
+    os.utime(style, (0, manifest["mtimes"]["style.css"] + 10))
+    app.extensions.pop("hjblog.assets", None)
+    with app.test_request_context():
+        assert re.fullmatch(
+            r"/static/style\.[0-9a-f]{10}\.css", url_for("static", filename="style.css")
+        )
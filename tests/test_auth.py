@@ -1,3 +1,4 @@
+import os
 import sqlite3
 from flask import g, session
 from flask.testing import FlaskClient
@@ -155,3 +156,58 @@ def test_logout(client: FlaskClient, auth: AuthActions):
     with client:
         client.get("/")
         assert session.get("user_id", None) is None
+
+
+def test_user_cache(client: FlaskClient, auth: AuthActions):
+    """The logged in user should be loaded from the cache of the process:
+    - without querying the database, as long as the version of the user
+        recorded in the session is current
+    - updates made through the routes are seen right away
+    - updates made elsewhere are seen once the cached copy expires
+    - routes that don't need the user don't load it nor touch the session
+    """
+    app = client.application
+    auth.login(username="admin", password="prova")
+    res = client.get("/change_username")
+    assert b"<p>Old username: admin</p>" in res.data
+    res = client.get("/change_username")
+    assert 'db;' not in res.headers["Server-Timing"]
+    assert "Set-Cookie" not in res.headers
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET username = 'sneaky' WHERE (username = 'admin')")
+        db.commit()
+    res = client.get("/change_username")
+    assert b"<p>Old username: admin</p>" in res.data
+
+    client.post("/change_username", data={"username": "mario", "submit": "Submit"})
+    res = client.get("/change_username")
+    assert b"<p>Old username: mario</p>" in res.data
+    with client:
+        client.get("/change_username")
+        assert session["user_version"] == 1
+        assert g.user["username"] == "mario"
+        with pytest.raises(TypeError):
+            g.user["username"] = "changed"
+
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "UPDATE users SET username = 'luigi', version = version + 1 WHERE (username = 'mario')"
+        )
+        db.commit()
+    res = client.get("/change_username")
+    assert b"<p>Old username: mario</p>" in res.data
+    app.config["USER_CACHE_TTL"] = -1
+    app.extensions.pop("hjblog.user_cache")
+    res = client.get("/change_username")
+    assert b"<p>Old username: luigi</p>" in res.data
+
+    with open(os.path.join(app.config["UPLOAD_DIR"], "pic_20.png"), "wb") as f:
+        f.write(b"picture")
+    with client:
+        res = client.get("/uploads/pic_20.png")
+        assert res.status_code == 200
+        assert g.user is None
+        assert "Cookie" not in res.headers.get("Vary", "")
@@ -0,0 +1,69 @@
+import json
+import sqlite3
+
+from benchmarks.datasets import build_dataset, parse_size
+from benchmarks.run import compare, get_routes, main, make_app
+
+
+def test_dataset(tmp_path):
+    """Datasets should be reproducible and keep the counters right."""
+    assert parse_size("10k") == 10_000
+    assert parse_size("1M") == 1_000_000
+    assert parse_size("500") == 500
+
+    rows = []
+    for directory in ("a", "b"):
+        path = build_dataset(str(tmp_path / directory), "300", 7)
+        db = sqlite3.connect(path)
+        rows.append(
+            db.execute(
+                "SELECT post_id, author_id, content, written FROM comments ORDER BY id"
+            ).fetchall()
+        )
+        assert db.execute("SELECT COUNT(*) FROM comments").fetchone()[0] == 300
+        assert db.execute("SELECT COUNT(*) FROM posts").fetchone()[0] == 30
+        assert db.execute(
+            "SELECT posts_count, comments_count FROM site_stats"
+        ).fetchone() == (30, 300)
+        db.close()
+    assert rows[0] == rows[1]
+    app = make_app(path, str(tmp_path))
+    app.config["COMMENTS_CHUNK_SIZE"] = 7
+    routes = get_routes(app, path)
+    assert routes["all_comments"].startswith("/user/all_comments/")
+    most = sqlite3.connect(path).execute("SELECT MAX(comments_count) FROM posts")
+    assert routes["all_comments_last"].endswith(f"?o={(most.fetchone()[0] - 1) // 7}")
+
+
+def test_compare():
+    stats = {"errors": 0, "p95_ms": 10.0, "rps": 100.0}
+    baseline = {"client": {"10k": {"blog": stats}}}
+    same = {"client": {"10k": {"blog": dict(stats, p95_ms=11.0)}}}
+    assert compare(baseline, same, 0.25, 1.0) == []
+    slower = {"client": {"10k": {"blog": dict(stats, p95_ms=20.0, rps=50.0)}}}
+    assert len(compare(baseline, slower, 0.25, 1.0)) == 2
+    # sub-millisecond differences are noise
+    baseline = {"client": {"10k": {"blog": dict(stats, p95_ms=0.2)}}}
+    noisy = {"client": {"10k": {"blog": dict(stats, p95_ms=0.5)}}}
+    assert compare(baseline, noisy, 0.25, 1.0) == []
+
+
+def test_run(tmp_path):
+    """A run should record a baseline and fail once a route regresses."""
+    args = "--sizes 200 --drivers client --routes blog all_comments".split()
+    args += ["--requests", "5", "--warmup", "1", "--data-dir", str(tmp_path)]
+    args += ["--baseline", str(tmp_path / "baseline.json")]
+    assert main(args) == 2
+    assert main(args + ["--save"]) == 0
+    with open(tmp_path / "baseline.json") as f:
+        baseline = json.load(f)
+    blog = baseline["results"]["client"]["200"]["blog"]
+    assert blog["requests"] == 5
+    assert blog["errors"] == 0
+    assert blog["p50_ms"] <= blog["p95_ms"] <= blog["p99_ms"]
+
+    blog["p95_ms"] = 0
+    blog["rps"] = 10**9
+    with open(tmp_path / "baseline.json", "w") as f:
+        json.dump(baseline, f)
+    assert main(args + ["--min-delta", "0"]) == 1
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import time
+from flask import Flask
+from flask.testing import FlaskClient
+import pytest
+
+from conftest import AuthActions
+from hjblog import create
+from hjblog.cache import POSTS, LRUCache, SQLiteCache, get_generation, invalidate
+from hjblog.db import close_pool, get_db
+
+
+def test_lru_cache():
+    """`LRUCache` should evict the least recently used entry when full
+    and forget expired entries.
+    """
+    cache = LRUCache(2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+    cache.set("d", "4", ttl=-1)
+    assert cache.get("d") is None
+
+
+def test_sqlite_cache():
+    """Two `SQLiteCache` pointing to the same file, as two worker processes
+    would, share entries and respect the size bound.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "fragments.sqlite")
+        first = SQLiteCache(path, 2)
+        second = SQLiteCache(path, 2)
+
+        first.set("a", "<p>a</p>")
+        assert second.get("a") == "<p>a</p>"
+        first.set("b", b"bytes")
+        first.set("c", "c")
+        assert second.get("b") == b"bytes"
+        assert second.get("a") is None
+
+
+@pytest.mark.parametrize("backend", ("lru", "sqlite"))
+def test_index_fragment_cache(
+    app: Flask, client: FlaskClient, auth: AuthActions, backend: str
+):
+    """The list of posts in the home page should be served from the cache,
+    a change made directly in the database isn't displayed, while
+    publishing or deleting a post through the routes invalidates the fragment.
+    """
+    app.config["FRAGMENT_CACHE"] = backend
+    app.config["FRAGMENT_CACHE_PATH"] = os.path.join(
+        app.config["UPLOAD_DIR"], "fragments.sqlite"
+    )
+
+    res = client.get("/")
+    assert b"test-title-2" in res.data
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE posts SET title = 'changed' WHERE (id = 3)")
+        db.commit()
+    res = client.get("/")
+    assert b"test-title-2" in res.data
+    assert b"changed" not in res.data
+
+    auth.login(username="admin", password="prova")
+    client.post(
+        "/user/new_post",
+        data={"title": "cached-title", "content": "content", "submit": "Post"},
+    )
+    res = client.get("/")
+    assert b"cached-title" in res.data
+    assert b"changed" in res.data
+
+    client.get("/user/delete_post/4")
+    res = client.get("/")
+    assert b"cached-title" not in res.data
+
+
+def test_shared_generations(app: Flask, client: FlaskClient):
+    """An invalidation done by another process should be seen by this one,
+    even if the fragments are cached per process, once the generation it
+    knows expires, until then a cache hit doesn't query the database.
+    """
+    assert app.config["FRAGMENT_CACHE"] == "lru"
+    app.config["FRAGMENT_CACHE_GENERATION_TTL"] = 0.2
+    res = client.get("/")
+    assert b"test-title-2" in res.data
+    with app.app_context():
+        get_generation(POSTS)
+    res = client.get("/")
+    assert "db;" not in res.headers["Server-Timing"]
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE posts SET title = 'changed' WHERE (id = 3)")
+        db.commit()
+        generation = get_generation(POSTS)
+
+    # another worker, with its own in-process cache, edits a post
+    other = create(
+        test_config={
+            "TESTING": True,
+            "DATABASE": app.config["DATABASE"],
+            "UPLOAD_DIR": app.config["UPLOAD_DIR"],
+            "METRICS": False,
+        }
+    )
+    with other.app_context():
+        invalidate(POSTS)
+    close_pool(other)
+
+    res = client.get("/")
+    assert b"changed" not in res.data
+    time.sleep(0.2)
+    with app.app_context():
+        assert get_generation(POSTS) == generation + 1
+    res = client.get("/")
+    assert b"changed" in res.data
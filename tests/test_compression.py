@@ -0,0 +1,102 @@
+import gzip
+import os
+import shutil
+from flask import Flask
+from flask.testing import FlaskClient, FlaskCliRunner
+
+from conftest import AuthActions
+from hjblog import compression
+
+
+def test_compress_response(client: FlaskClient):
+    """HTML pages should be compressed only for the clients that accept it,
+    images never, and a compressed response should still answer
+    a conditional request with 304.
+    """
+    res = client.get("/blog")
+    assert "Content-Encoding" not in res.headers
+
+    res = client.get("/blog", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert b"test-title-2" in gzip.decompress(res.data)
+
+    res = client.get("/blog", headers={"Accept-Encoding": "gzip;q=0, identity"})
+    assert "Content-Encoding" not in res.headers
+
+    res = client.get("/feed.atom", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    etag = res.headers["ETag"]
+    assert etag.startswith("W/")
+    res = client.get(
+        "/feed.atom", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert res.status_code == 304
+
+    res = client.get("/api/v1/posts", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert b'"data":[' in gzip.decompress(res.data)
+
+    res = client.get(
+        "/static/default_files/anonymous_user.png",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert "Content-Encoding" not in res.headers
+
+
+def test_secrets_uncompressed(client: FlaskClient, auth: AuthActions):
+    """Pages holding a CSRF token or the seed of the 2fa shouldn't be compressed."""
+    auth.login(username="admin", password="prova")
+    res = client.get("/setup-2fa", headers={"Accept-Encoding": "gzip"})
+    assert b'id="secret"' in res.data
+    assert "Content-Encoding" not in res.headers
+
+    res = client.get("/change_username", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    client.application.config["WTF_CSRF_ENABLED"] = True
+    res = client.get("/change_username", headers={"Accept-Encoding": "gzip"})
+    assert b'name="csrf_token"' in res.data
+    assert "Content-Encoding" not in res.headers
+    assert "Accept-Encoding" in res.headers["Vary"]
+
+
+def test_compress_static(app: Flask, client: FlaskClient, runner: FlaskCliRunner):
+    """`compress-static` should precompress the static files, which are then
+    served as they are to the clients that accept them, a variant older
+    than its file is ignored.
+    """
+    static_folder = os.path.join(app.config["UPLOAD_DIR"], "static")
+    shutil.copytree(app.static_folder, static_folder)
+    app.static_folder = static_folder
+
+    with app.app_context():
+        result = runner.invoke(args=["compress-static"])
+    assert "Written: style.css.gz" in result.output
+    assert not os.path.exists(
+        os.path.join(static_folder, "default_files", "anonymous_user.png.gz")
+    )
+
+    res = client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.mimetype == "text/css"
+    with open(os.path.join(static_folder, "style.css"), "rb") as f:
+        css = f.read()
+    assert gzip.decompress(res.data) == css
+    res.close()
+
+    res = client.get("/static/style.css")
+    assert "Content-Encoding" not in res.headers
+    assert res.data == css
+    res.close()
+
+    stat = os.stat(os.path.join(static_folder, "style.css.gz"))
+    os.utime(
+        os.path.join(static_folder, "style.css"),
+        (stat.st_atime + 10, stat.st_mtime + 10),
+    )
+    res = client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
+    res.close()
+
+    if compression.brotli is not None:
+        assert os.path.exists(os.path.join(static_folder, "style.css.br"))
@@ -9,9 +9,29 @@ def test_get_close_db(client: FlaskClient):
     """We test that in the same `app_context` the same
     connection to the database is returned.
     We make sure that when `app_context` is dropped the connection
+    to the database is given back to the pool: it is still open
+    and the next `app_context` receives it again, with the PRAGMAs applied.
+    """
+    with client.application.test_request_context():
+        db = get_db()
+        assert db is get_db()
+
+    assert db.execute("SELECT 1").fetchone()[0] == 1
+
+    with client.application.test_request_context():
+        assert get_db() is db
+        assert get_db().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert get_db().execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert get_db().execute("PRAGMA temp_store").fetchone()[0] == 2
+
+
+def test_get_close_db_without_pool(client: FlaskClient):
+    """With `DATABASE_POOL_SIZE` set to 0 a connection is opened for
+    every `app_context`, when `app_context` is dropped the connection
     to the database is closed, so trying to interact with it will
     raise `sqlite3.ProgrammingError`, 'closed' will be in `error.value`.
     """
+    client.application.config["DATABASE_POOL_SIZE"] = 0
     with client.application.test_request_context():
         db = get_db()
         assert db is get_db()
@@ -22,6 +42,27 @@ def test_get_close_db(client: FlaskClient):
     assert "closed" in str(e.value)
 
 
+def test_pool_discards_broken_connections(client: FlaskClient):
+    """A connection that stopped working is not handed out again,
+    an open transaction is rolled back when the connection is given back.
+    """
+    with client.application.test_request_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO cities (name, latitude, longitude, timezone) VALUES ('x', 1, 1, 'UTC')"
+        )
+        assert db.in_transaction
+
+    assert not db.in_transaction
+    db.close()
+
+    with client.application.test_request_context():
+        new_db = get_db()
+        assert new_db is not db
+        city = new_db.execute("SELECT id FROM cities WHERE (name = 'x')").fetchone()
+        assert city is None
+
+
 def test_init_db_command(runner: FlaskCliRunner, monkeypatch):
     """Pytest’s monkeypatch fixture replaces the `init_db`
     function with one that records that it’s been called, but
@@ -42,3 +83,89 @@ def test_init_db_command(runner: FlaskCliRunner, monkeypatch):
         result = runner.invoke(args=["init-db"])
     assert "Database initialized." in result.output
     assert Recorder.called
+
+
+def test_migrate_command(runner: FlaskCliRunner):
+    """The database created by the fixture is already at the latest version,
+    so `migrate` shouldn't apply anything.
+    A database created with the bare schema(like an old production
+    database) should be upgraded in place: the indexes get created,
+    every migration is recorded in `schema_version` and the data is kept.
+    """
+    with runner.app.app_context():
+        result = runner.invoke(args=["migrate"])
+        assert "Applied" not in result.output
+        assert "Database is at version" in result.output
+
+        db = get_db()
+        db.executescript(
+            "DROP TABLE schema_version; DROP INDEX posts_posted_idx; DROP INDEX posts_author_posted_idx; DROP INDEX comments_post_written_idx; DROP INDEX cities_name_idx; ALTER TABLE users DROP COLUMN version; DROP TRIGGER posts_count_insert; DROP TRIGGER posts_count_delete; DROP TRIGGER comments_count_insert; DROP TRIGGER comments_count_delete; DROP TRIGGER comments_count_move; DROP TABLE site_stats; ALTER TABLE posts DROP COLUMN comments_count; DROP TABLE posts_fts; DROP TABLE comments_fts; DROP TRIGGER posts_fts_insert; DROP TRIGGER posts_fts_delete; DROP TRIGGER posts_fts_update; DROP TRIGGER comments_fts_insert; DROP TRIGGER comments_fts_delete; DROP TRIGGER comments_fts_update;"
+        )
+        posts = db.execute("SELECT COUNT(id) FROM posts").fetchone()[0]
+
+        result = runner.invoke(args=["migrate"])
+        assert "Applied: 0001_posts_indexes.sql" in result.output
+
+        versions = db.execute(
+            "SELECT version FROM schema_version ORDER BY version"
+        ).fetchall()
+        assert [v["version"] for v in versions] == list(range(1, len(versions) + 1))
+        indexes = [
+            i["name"]
+            for i in db.execute(
+                "SELECT name FROM sqlite_master WHERE (type = 'index')"
+            ).fetchall()
+        ]
+        assert "posts_posted_idx" in indexes
+        assert "comments_post_written_idx" in indexes
+        assert "cities_name_idx" in indexes
+        assert db.execute("SELECT COUNT(id) FROM posts").fetchone()[0] == posts
+
+        plan = db.execute(
+            "EXPLAIN QUERY PLAN SELECT posts.id FROM posts JOIN users ON (users.id = posts.author_id) WHERE ((posts.posted, posts.id) < (?, ?)) ORDER BY posts.posted DESC, posts.id DESC LIMIT 6",
+            ("2100-01-01 00:00:00", 1),
+        ).fetchall()
+        assert "posts_posted_idx" in " ".join(row["detail"] for row in plan)
+
+
+def test_counters(runner: FlaskCliRunner):
+    """The counters of posts and comments are kept exact by the triggers,
+    `recount` puts them back in place if they drift.
+    """
+    with runner.app.app_context():
+        db = get_db()
+
+        def counters():
+            stats = db.execute(
+                "SELECT posts_count, comments_count FROM site_stats"
+            ).fetchone()
+            per_post = dict(db.execute("SELECT id, comments_count FROM posts"))
+            return tuple(stats), per_post
+
+        def expected():
+            stats = (
+                db.execute("SELECT COUNT(id) FROM posts").fetchone()[0],
+                db.execute("SELECT COUNT(id) FROM comments").fetchone()[0],
+            )
+            per_post = dict(
+                db.execute(
+                    "SELECT posts.id, COUNT(comments.id) FROM posts LEFT JOIN comments ON (comments.post_id = posts.id) GROUP BY posts.id"
+                )
+            )
+            return stats, per_post
+
+        assert counters() == expected()
+        db.execute(
+            "INSERT INTO comments (post_id, content, author_id) VALUES (1, 'new', 1)"
+        )
+        db.execute("DELETE FROM comments WHERE (post_id = 2)")
+        db.execute("DELETE FROM posts WHERE (id = 2)")
+        db.commit()
+        assert counters() == expected()
+
+        db.execute("UPDATE site_stats SET posts_count = 100, comments_count = 100")
+        db.execute("UPDATE posts SET comments_count = 100")
+        db.commit()
+        result = runner.invoke(args=["recount"])
+        assert "site_stats.posts_count: 1 corrected" in result.output
+        assert counters() == expected()
@@ -0,0 +1,48 @@
+import json
+import logging
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+
+
+def records(caplog: pytest.LogCaptureFixture) -> list[dict]:
+    return [
+        json.loads(record.getMessage())
+        for record in caplog.records
+        if record.name == "hjblog.requests"
+    ]
+
+
+def test_server_timing(app: Flask, client: FlaskClient, caplog):
+    """Every request should report the time spent on queries and
+    templates through `Server-Timing` and log a JSON line, slow requests
+    and repeated statements should be logged as warnings.
+    """
+    caplog.set_level(logging.INFO, logger="hjblog.requests")
+
+    res = client.get("/blog")
+    timing = res.headers["Server-Timing"]
+    assert "db;dur=" in timing
+    assert "tpl;dur=" in timing
+    assert "total;dur=" in timing
+    record = records(caplog)[-1]
+    assert record["endpoint"] == "index.blog"
+    assert record["status"] == 200
+    assert record["db_count"] >= 2
+    assert record["tpl_count"] == 1
+    assert caplog.records[-1].levelno == logging.INFO
+    assert "slowest" not in record
+
+    app.config["SLOW_REQUEST_THRESHOLD"] = 0
+    app.config["REPEATED_QUERY_THRESHOLD"] = 1
+    client.get("/blog")
+    record = records(caplog)[-1]
+    assert caplog.records[-1].levelno == logging.WARNING
+    assert any("FROM posts" in query["sql"] for query in record["slowest"])
+    assert any("FROM posts" in sql for sql in record["repeated"])
+
+    app.config["INSTRUMENTATION"] = False
+    caplog.clear()
+    res = client.get("/blog")
+    assert "Server-Timing" not in res.headers
+    assert records(caplog) == []
@@ -0,0 +1,115 @@
+from io import BytesIO
+import os
+import threading
+import time
+from flask.testing import FlaskClient
+from PIL import Image
+
+from conftest import AuthActions
+from hjblog.bps.user_profile.auxiliaries import get_picture_files
+from hjblog.db import get_db
+from hjblog.jobs import JobQueue, close_job_queue
+
+
+def test_job_queue():
+    """`JobQueue` should run the jobs in worker processes, call the callback
+    with the result on a thread of its own and refuse jobs when `max_queue`
+    jobs are pending, their callbacks included.
+    With no workers jobs are executed right away.
+    """
+    job_queue = JobQueue(1, 1)
+    results = []
+    threads = []
+    release = threading.Event()
+
+    def callback(future):
+        threads.append(threading.current_thread().name)
+        release.wait(30)
+        results.append(future.result())
+
+    try:
+        future = job_queue.submit(pow, (2, 10), callback)
+        assert future is not None
+        assert job_queue.submit(pow, (2, 3)) is None
+        assert future.result(timeout=30) == 1024
+        for _ in range(100):
+            if threads:
+                break
+            time.sleep(0.01)
+        # the callback still holds the slot
+        assert job_queue.submit(pow, (2, 3)) is None
+        assert job_queue.rejected == 2
+        release.set()
+        for _ in range(100):
+            if results:
+                break
+            time.sleep(0.01)
+        assert results == [1024]
+        assert threads[0].startswith("hjblog-jobs-callback")
+        for _ in range(100):
+            future = job_queue.submit(pow, (2, 3))
+            if future is not None:
+                break
+            time.sleep(0.01)
+        assert future.result(timeout=30) == 8
+    finally:
+        job_queue.shutdown()
+
+    inline = JobQueue(0, 1)
+    future = inline.submit(pow, (2, 10), lambda f: results.append(f.result()))
+    assert future.done()
+    assert results == [1024, 1024]
+    assert inline.submit(pow, (2, 3)).result() == 8
+
+
+def test_background_picture(client: FlaskClient, auth: AuthActions):
+    """With worker processes the upload of a picture should be acknowledged
+    right away, the picture of the user is updated once the job is done and
+    the user is notified the next time the profile is visited.
+    """
+    app = client.application
+    app.config["IMAGE_JOBS_WORKERS"] = 1
+    auth.login(username="admin", password="prova")
+
+    def upload(data: bytes):
+        return client.post(
+            "/change_picture",
+            data={"picture": (BytesIO(data), "photo.png"), "submit": "Submit"},
+        )
+
+    def wait_job():
+        with app.app_context():
+            db = get_db()
+            for _ in range(300):
+                if db.execute("SELECT id FROM picture_jobs").fetchone() is not None:
+                    return
+                time.sleep(0.1)
+
+    buffer = BytesIO()
+    Image.new("RGB", (400, 300), "blue").save(buffer, "PNG")
+    try:
+        res = upload(buffer.getvalue())
+        assert res.status_code == 302
+        assert res.headers["Location"] == "/manage_profile"
+        wait_job()
+        with app.app_context():
+            pic_name = (
+                get_db()
+                .execute("SELECT profile_pic FROM users WHERE username = 'admin'")
+                .fetchone()["profile_pic"]
+            )
+        assert pic_name is not None
+        for file in get_picture_files(pic_name):
+            assert os.path.exists(os.path.join(app.config["UPLOAD_DIR"], file))
+        res = client.get("/manage_profile")
+        assert b"Your new profile picture is being processed" in res.data
+        assert b"You have updated your profile picture correctly" in res.data
+        res = client.get("/manage_profile")
+        assert b"You have updated your profile picture correctly" not in res.data
+
+        upload(b"not a picture")
+        wait_job()
+        res = client.get("/manage_profile")
+        assert b"The picture you uploaded isn&#39;t a valid image." in res.data
+    finally:
+        close_job_queue(app)
@@ -1,8 +1,14 @@
+import os
+import re
+import time
 import pytest
 from flask.testing import FlaskClient
 
 from auxiliaries import check_navbar
 from conftest import AuthActions
+from hjblog import create
+from hjblog.bps.main.helpers import SEARCH_QUERIES
+from hjblog.db import close_pool, get_db
 
 
 def test_index(client: FlaskClient, auth: AuthActions):
@@ -38,6 +44,233 @@ def test_index(client: FlaskClient, auth: AuthActions):
     )
 
 
+def test_blog(client: FlaskClient, auth: AuthActions):
+    """Blog route should:
+    - respond with a 200 OK to a GET req
+    - have a working navbar
+    - display the newest posts first, `MAX_PER_PAGE` per page
+    - walk through older and newer pages using the cursors it provides
+    - ignore a malformed cursor and display the first page
+    - display a message if there are no posts
+    """
+    res = client.get("/blog")
+    assert res.status_code == 200
+
+    check_navbar(client, auth)
+
+    with client.application.app_context():
+        db = get_db()
+        for i in range(3, 11):
+            db.execute(
+                "INSERT INTO posts (title, content, author_id) VALUES (?, ?, ?)",
+                (f"test-title-{i}", "Content.", 2),
+            )
+        db.commit()
+
+    def titles(data: bytes) -> list[str]:
+        return re.findall(
+            r'class="post_card_h3_link" href="[^"]+">([^<]+)</a>', data.decode()
+        )
+
+    def link(data: bytes, label: str) -> str | None:
+        found = re.search(rf'href="([^"]+)">{label}</a>', data.decode())
+        if found is None:
+            return None
+        return found.group(1).replace("&amp;", "&")
+
+    res = client.get("/blog")
+    assert titles(res.data) == [f"test-title-{i}" for i in range(10, 5, -1)]
+    assert link(res.data, "Newer posts") is None
+
+    res = client.get(link(res.data, "Older posts"))
+    assert titles(res.data) == [f"test-title-{i}" for i in range(5, 0, -1)]
+
+    older = client.get(link(res.data, "Older posts"))
+    assert titles(older.data) == ["test-title-0"]
+    assert link(older.data, "Older posts") is None
+
+    res = client.get(link(older.data, "Newer posts"))
+    assert titles(res.data) == [f"test-title-{i}" for i in range(5, 0, -1)]
+    res = client.get(link(res.data, "Newer posts"))
+    assert titles(res.data) == [f"test-title-{i}" for i in range(10, 5, -1)]
+    assert link(res.data, "Newer posts") is None
+
+    res = client.get("/blog?c=not-a-cursor")
+    assert res.status_code == 200
+    assert titles(res.data) == [f"test-title-{i}" for i in range(10, 5, -1)]
+
+    with client.application.app_context():
+        db = get_db()
+        db.execute("DELETE FROM posts")
+        db.commit()
+    res = client.get("/blog")
+    assert (
+        b"Currently there are no posts to be displayed, please try again later."
+        in res.data
+    )
+
+
+def test_search(client: FlaskClient):
+    """Search route should:
+    - find posts by title and content, best matches first
+    - find comments when searching the comments
+    - highlight the matches and escape the content
+    - follow the index when posts are published, edited or deleted
+    - walk through the results using the cursor it provides
+    - never fail on FTS5 syntax typed by the user
+    """
+    res = client.get("/search")
+    assert res.status_code == 200
+
+    with client.application.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO posts (title, content, author_id) VALUES (?, ?, ?)",
+            ("Something else", "A <b>telescope</b> review.", 2),
+        )
+        db.execute(
+            "INSERT INTO posts (title, content, author_id) VALUES (?, ?, ?)",
+            ("Telescope", "Looking at the sky.", 2),
+        )
+        db.commit()
+
+    res = client.get("/search?q=telescope")
+    data = res.data.decode()
+    assert data.index(">Telescope</a>") < data.index(">Something else</a>")
+    assert "&lt;b&gt;<mark>telescope</mark>&lt;/b&gt;" in data
+    assert client.get("/search?q=teles").data.count(b"<mark>") == 2
+
+    res = client.get("/search?q=prova&s=comments")
+    assert b"<mark>prova</mark>" in res.data
+    assert b"test-title-0" in res.data
+    res = client.get("/search?q=prova")
+    assert b"Nothing matches your search." in res.data
+
+    with client.application.app_context():
+        db = get_db()
+        db.execute("UPDATE posts SET title = 'Binoculars' WHERE (title = 'Telescope')")
+        db.execute("DELETE FROM posts WHERE (title = 'Something else')")
+        for i in range(12):
+            db.execute(
+                "INSERT INTO posts (title, content, author_id) VALUES (?, ?, ?)",
+                (f"nebula-{i}", "Nebula.", 2),
+            )
+        db.commit()
+    res = client.get("/search?q=telescope")
+    assert b"Nothing matches your search." in res.data
+    assert b"Binoculars" in client.get("/search?q=binoculars").data
+
+    found = []
+    res = client.get("/search?q=nebula")
+    while True:
+        found += re.findall(r">(nebula-\d+)</a>", res.data.decode())
+        more = re.search(r'href="([^"]+)">More results</a>', res.data.decode())
+        if more is None:
+            break
+        res = client.get(more.group(1).replace("&amp;", "&"))
+    assert sorted(found) == sorted(f"nebula-{i}" for i in range(12))
+
+    for query in ('"', "title:", "a AND", "NEAR(", "*", "-x"):
+        assert client.get("/search", query_string={"q": query}).status_code == 200
+
+
+@pytest.mark.parametrize("scope", ("posts", "comments"))
+def test_search_plan(client: FlaskClient, scope: str):
+    """The page of search results should be selected from the index alone,
+    the joins and the snippets are done only for the rows of the page.
+    """
+    query = SEARCH_QUERIES[scope].format(keyset=" AND ((rank, rowid) > (?, ?))")
+    with client.application.app_context():
+        plan = get_db().execute(
+            "EXPLAIN QUERY PLAN " + query, ('"nebula"', -1.0, 0, 11, '"nebula"')
+        ).fetchall()
+    loops = [
+        row["detail"]
+        for row in plan
+        if row["parent"] == 0 and row["detail"].startswith(("SCAN", "SEARCH"))
+    ]
+    assert loops[0] == "SCAN page"
+
+
+@pytest.mark.parametrize(
+    ("path", "mimetype"),
+    (("/feed.atom", "application/atom+xml"), ("/feed.rss", "application/rss+xml")),
+)
+def test_feeds(client: FlaskClient, auth: AuthActions, path: str, mimetype: str):
+    """Feed routes should list the latest posts, be served from the cache
+    until a post is published or deleted, and answer a conditional
+    request with 304 while nothing changed.
+    """
+    res = client.get(path)
+    assert res.status_code == 200
+    assert res.mimetype == mimetype
+    assert b"test-title-2" in res.data
+    assert "Cookie" not in res.headers.get("Vary", "")
+    etag = res.headers["ETag"]
+    last_modified = res.headers["Last-Modified"]
+
+    res = client.get(path, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    res = client.get(path, headers={"If-Modified-Since": last_modified})
+    assert res.status_code == 304
+
+    with client.application.app_context():
+        db = get_db()
+        db.execute("UPDATE posts SET title = 'changed' WHERE (id = 3)")
+        db.commit()
+    res = client.get(path, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+
+    auth.login(username="admin", password="prova")
+    client.post(
+        "/user/new_post",
+        data={"title": "feed-title", "content": "<content>", "submit": "Post"},
+    )
+    res = client.get(path, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert b"feed-title" in res.data
+    assert b"&lt;content&gt;" in res.data
+    etag = res.headers["ETag"]
+
+    client.get("/user/delete_post/4")
+    res = client.get(path, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert b"feed-title" not in res.data
+
+
+def test_feeds_across_workers(client: FlaskClient, auth: AuthActions):
+    """After a post is published through one worker, every worker should
+    serve the same feed with the same `ETag`, once the generation of the
+    posts they know expires.
+    """
+    app = client.application
+    other = create(
+        test_config={
+            "TESTING": True,
+            "DATABASE": app.config["DATABASE"],
+            "UPLOAD_DIR": app.config["UPLOAD_DIR"],
+            "METRICS": False,
+            "FRAGMENT_CACHE_GENERATION_TTL": 0.1,
+        }
+    )
+    other_client = other.test_client()
+    etag = client.get("/feed.atom").headers["ETag"]
+    assert other_client.get("/feed.atom").headers["ETag"] == etag
+
+    auth.login(username="admin", password="prova")
+    client.post(
+        "/user/new_post",
+        data={"title": "feed-title", "content": "content", "submit": "Post"},
+    )
+    res = client.get("/feed.atom")
+    time.sleep(0.1)
+    other_res = other_client.get("/feed.atom", headers={"If-None-Match": etag})
+    assert other_res.status_code == 200
+    assert b"feed-title" in other_res.data
+    assert other_res.headers["ETag"] == res.headers["ETag"] != etag
+    close_pool(other)
+
+
 @pytest.mark.parametrize(
     "path",
     (
@@ -68,7 +301,11 @@ def test_login_required(path: str, client: FlaskClient):
 
 @pytest.mark.parametrize(
     "path",
-    ("/user/new_post",),
+    (
+        "/user/new_post",
+        "/admin/profiler",
+        "/admin/profiles/20240101-000000-1-window-1s.collapsed",
+    ),
 )
 def test_admin_only(path: str, client: FlaskClient, auth: AuthActions):
     """
@@ -104,3 +341,42 @@ def test_login_forbidden(path: str, client: FlaskClient, auth: AuthActions):
     assert res.headers["Location"] == "/"
     res = client.get("/")
     assert b"Log out before accessing this page" in res.data
+
+
+def test_profile_pictures(client: FlaskClient):
+    """Uploaded pictures should be served with a strong ETag, cached forever
+    by the browser, 304 should be returned to a conditional request and
+    the transfer can be left to nginx.
+    """
+    app = client.application
+    with open(os.path.join(app.config["UPLOAD_DIR"], "abcd_20.png"), "wb") as f:
+        f.write(b"picture")
+
+    res = client.get("/uploads/abcd_20.png")
+    assert res.status_code == 200
+    assert res.data == b"picture"
+    assert res.headers["ETag"] == '"abcd_20.png"'
+    assert res.cache_control.public
+    assert res.cache_control.max_age == 31536000
+    assert res.cache_control.immutable
+
+    res = client.get(
+        "/uploads/abcd_20.png", headers={"If-None-Match": '"abcd_20.png"'}
+    )
+    assert res.status_code == 304
+    assert res.data == b""
+    assert res.cache_control.immutable
+    assert client.get("/uploads/missing.png").status_code == 404
+
+    app.config["UPLOADS_ACCEL_REDIRECT"] = "/protected-uploads/"
+    res = client.get("/uploads/abcd_20.png")
+    assert res.status_code == 200
+    assert res.data == b""
+    assert res.headers["X-Accel-Redirect"] == "/protected-uploads/abcd_20.png"
+    assert res.headers["Content-Type"] == "image/png"
+    assert res.cache_control.immutable
+    res = client.get(
+        "/uploads/abcd_20.png", headers={"If-None-Match": '"abcd_20.png"'}
+    )
+    assert res.status_code == 304
+    assert "X-Accel-Redirect" not in res.headers
@@ -0,0 +1,155 @@
+import os
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+
+from hjblog.metrics import MmapStore, collect, render
+
+
+def parse(text: str) -> dict[str, float]:
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in text.splitlines()
+        if not line.startswith("#")
+    }
+
+
+def test_store(tmp_path):
+    """Counters should survive the growth of the file and be summed
+    across the files of every process.
+    """
+    store = MmapStore(str(tmp_path))
+    store.inc("a", 2)
+    store.inc('b{x="1"}', 0.5)
+    store.inc("a")
+    for i in range(5000):
+        store.inc(f"key_{i:05}")
+    assert os.path.getsize(store.path) > 64 * 1024
+    totals = collect(str(tmp_path))
+    assert totals["a"] == 3
+    assert totals['b{x="1"}'] == 0.5
+    assert totals["key_04999"] == 1
+    store.close()
+
+    # a process that reuses the pid keeps counting from the same file
+    store = MmapStore(str(tmp_path))
+    store.inc("a")
+    assert collect(str(tmp_path))["a"] == 4
+    store.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_store_fork(tmp_path):
+    """A forked process should write its own file, so the counters of the
+    parent and of the child add up, once the child is gone its file is
+    merged into the aggregate and deleted, without the totals going down.
+    """
+    store = MmapStore(str(tmp_path))
+    store.inc("requests")
+    counted, counted_w = os.pipe()
+    stop, stop_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        store.inc("requests", 10)
+        os.write(counted_w, b"x")
+        os.read(stop, 1)
+        os._exit(0)
+    os.read(counted, 1)
+    store.inc("requests")
+    assert len(os.listdir(tmp_path)) == 2
+    assert collect(str(tmp_path))["requests"] == 12
+    os.write(stop_w, b"x")
+    os.waitpid(pid, 0)
+    for fd in (counted, counted_w, stop, stop_w):
+        os.close(fd)
+    assert collect(str(tmp_path))["requests"] == 12
+    # merged once, however many times the totals are collected
+    assert collect(str(tmp_path))["requests"] == 12
+    assert sorted(
+        name for name in os.listdir(tmp_path) if name.endswith(".metrics")
+    ) == [os.path.basename(store.path)]
+    store.inc("requests")
+    assert collect(str(tmp_path))["requests"] == 13
+    store.close()
+
+
+def test_render():
+    text = render(
+        {
+            'hjblog_request_duration_seconds_bucket{endpoint="x",le="+Inf"}': 2,
+            'hjblog_request_duration_seconds_count{endpoint="x"}': 2,
+            "hjblog_errors_total": 1,
+        }
+    )
+    assert "# TYPE hjblog_request_duration_seconds histogram" in text
+    assert "# TYPE hjblog_errors_total counter" in text
+    assert text.count("# TYPE") == 2
+    assert 'hjblog_request_duration_seconds_count{endpoint="x"} 2\n' in text
+
+    # full precision, big counters and small durations alike
+    text = render({"hjblog_db_query_seconds_total": 1234567.125, "a": 12345678})
+    assert "hjblog_db_query_seconds_total 1234567.125\n" in text
+    assert "a 12345678\n" in text
+
+
+def test_metrics(app: Flask, client: FlaskClient):
+    """`/metrics` should report the requests served, the statements they
+    executed, the error pages and the cache lookups.
+    """
+    client.get("/blog")
+    client.get("/blog")
+    client.get("/not-a-page")
+    client.get("/")
+    client.get("/")
+    app.config["METRICS_TOKEN"] = "secret"
+    res = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert res.status_code == 200
+    assert res.mimetype == "text/plain"
+    metrics = parse(res.get_data(as_text=True))
+    assert metrics['hjblog_requests_total{endpoint="index.blog",status="200"}'] == 2
+    assert metrics['hjblog_requests_total{endpoint="none",status="404"}'] == 1
+    assert metrics['hjblog_errors_total{status="404"}'] == 1
+    assert (
+        metrics['hjblog_request_duration_seconds_count{endpoint="index.blog"}'] == 2
+    )
+    assert (
+        metrics[
+            'hjblog_request_duration_seconds_bucket{endpoint="index.blog",le="+Inf"}'
+        ]
+        == 2
+    )
+    assert metrics['hjblog_db_queries_total{endpoint="index.blog"}'] >= 2
+    assert metrics['hjblog_db_query_seconds_total{endpoint="index.blog"}'] > 0
+    assert metrics['hjblog_cache_requests_total{cache="fragments",result="miss"}'] >= 1
+    assert metrics['hjblog_cache_requests_total{cache="fragments",result="hit"}'] >= 1
+
+
+def test_metrics_access(app: Flask, client: FlaskClient):
+    """`/metrics` should be served only with the token, not at all without
+    one, and only to the allowed addresses if they are set.
+    """
+    # localhost, as every request behind a reverse proxy
+    res = client.get("/metrics")
+    assert res.status_code == 404
+
+    app.config["METRICS_TOKEN"] = "secret"
+    res = client.get("/metrics")
+    assert res.status_code == 404
+    res = client.get(
+        "/metrics",
+        environ_base={"REMOTE_ADDR": "10.0.0.1"},
+        headers={"Authorization": "Bearer secret"},
+    )
+    assert res.status_code == 200
+
+    app.config["METRICS_ALLOWED_ADDRESSES"] = ("127.0.0.1",)
+    res = client.get(
+        "/metrics",
+        environ_base={"REMOTE_ADDR": "10.0.0.1"},
+        headers={"Authorization": "Bearer secret"},
+    )
+    assert res.status_code == 404
+
+    app.config["METRICS"] = False
+    res = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert res.status_code == 404
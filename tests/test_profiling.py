@@ -0,0 +1,104 @@
+import os
+import re
+import time
+from flask import Flask
+from flask.testing import FlaskClient
+
+from conftest import AuthActions
+from hjblog.profiling import Sampler, get_profiles_dir, get_window, list_profiles
+
+
+def test_sampler():
+    """The sampler should count the collapsed stacks of the sampled thread."""
+    sampler = Sampler(0.001)
+    sampler.start()
+
+    def busy_function():
+        deadline = time.monotonic() + 0.2
+        while time.monotonic() < deadline:
+            pass
+
+    busy_function()
+    samples = sampler.stop()
+    assert any("busy_function (test_profiling.py" in stack for stack in samples)
+    stack, count = samples.most_common(1)[0]
+    assert count > 0
+    assert stack.split(";")[0] == "MainThread"
+
+
+def test_profiler(app: Flask, client: FlaskClient, auth: AuthActions):
+    """An admin should be able to sign a link that profiles one request,
+    only a valid token for that path, used once by the same admin, enables
+    the profiler, and the profile should be listed and downloadable.
+    """
+    app.config["PROFILES_DIR"] = os.path.join(app.config["UPLOAD_DIR"], "profiles")
+    auth.login(username="admin", password="prova")
+    res = client.post(
+        "/admin/profiler", data={"link-path": "/blog", "link-submit": "Sign link"}
+    )
+    assert res.status_code == 200
+    link = re.search(r'<a href="(/blog\?_profile=[^"]+)"', res.data.decode())
+    assert link is not None
+    link = link.group(1).replace("&amp;", "&")
+
+    assert "X-Profile" not in client.get("/blog?_profile=forged").headers
+    assert "X-Profile" not in client.get(link.replace("/blog", "/index", 1)).headers
+
+    assert "X-Profile" not in app.test_client().get(link).headers
+
+    res = client.get(link)
+    assert res.status_code == 200
+    name = res.headers["X-Profile"]
+    assert os.path.exists(os.path.join(get_profiles_dir(app), name))
+    assert "X-Profile" not in client.get(link).headers
+
+    res = client.get("/admin/profiler")
+    assert name.encode() in res.data
+    res = client.get(f"/admin/profiles/{name}")
+    assert res.status_code == 200
+    assert res.headers["Content-Disposition"].startswith("attachment")
+    for line in res.data.decode().splitlines():
+        assert re.match(r"^.+ \d+$", line)
+    assert client.get("/admin/profiles/..%2Fconfig.py").status_code == 404
+
+    res = client.post(
+        "/admin/profiler",
+        data={"window-seconds": "1", "window-submit": "Start sampling"},
+    )
+    assert b"Sampling the requests of this process for 1 seconds." in res.data
+    res = client.post(
+        "/admin/profiler",
+        data={"window-seconds": "1", "window-submit": "Start sampling"},
+    )
+    assert b"A sampling window is already open." in res.data
+    deadline = time.monotonic() + 5
+    while get_window(app) is not None and time.monotonic() < deadline:
+        client.get("/blog")
+        time.sleep(0.05)
+    window = [profile for profile in list_profiles(app) if "-window-1s." in profile]
+    assert len(window) == 1
+    with open(os.path.join(get_profiles_dir(app), window[0])) as f:
+        stacks = [line.rsplit(" ", 1)[0] for line in f.read().splitlines()]
+    # only the requests are sampled, not the idle time between them
+    assert any("blog (routes.py" in stack for stack in stacks)
+    assert not any(
+        stack.split(";")[-1].startswith("test_profiler (") for stack in stacks
+    )
+
+
+def test_profiles_cap(app: Flask, client: FlaskClient, auth: AuthActions):
+    """Only the newest `PROFILES_MAX_FILES` profiles should be kept."""
+    app.config["PROFILES_DIR"] = os.path.join(app.config["UPLOAD_DIR"], "profiles")
+    app.config["PROFILES_MAX_FILES"] = 2
+    old = [f"2000010{day}-000000-1-get-blog.collapsed" for day in range(1, 4)]
+    os.makedirs(get_profiles_dir(app), exist_ok=True)
+    for name in old:
+        open(os.path.join(get_profiles_dir(app), name), "w").close()
+    auth.login(username="admin", password="prova")
+    res = client.post(
+        "/admin/profiler", data={"link-path": "/blog", "link-submit": "Sign link"}
+    )
+    link = re.search(r'<a href="(/blog\?_profile=[^"]+)"', res.data.decode())
+    assert link is not None
+    res = client.get(link.group(1).replace("&amp;", "&"))
+    assert list_profiles(app) == [res.headers["X-Profile"], old[-1]]
@@ -1,7 +1,20 @@
+import socket
+import threading
+import time
 from flask.testing import FlaskClient
+import requests
 
 from auxiliaries import check_navbar
 from conftest import AuthActions
+from hjblog.bps.user_actions.auxiliaries import (
+    CircuitBreaker,
+    Coordinates,
+    WeatherForecast,
+    fetch_json,
+    flush_flight_stats,
+    get_forecast,
+    get_single_flight,
+)
 from hjblog.db import get_db
 
 
@@ -209,3 +222,331 @@ def test_all_comments(client: FlaskClient, auth: AuthActions):
     client.post("/user/comment/1", data={"content": comment_body, "submit": "Comment"})
     res = client.get("/user/all_comments/1")
     assert b"Delete comment" in res.data
+
+
+class FakeResponse:
+    """Stands for a `requests.Response` of the weather backend."""
+
+    def __init__(self, json: dict, status_code: int = 200):
+        self._json = json
+        self.status_code = status_code
+
+    def json(self) -> dict:
+        return self._json
+
+
+FORECAST_JSON = {
+    "hourly": {
+        "time": ["2024-01-01T00:00", "2024-01-01T01:00"],
+        "temperature_2m": [10.0, 9.5],
+        "relative_humidity_2m": [80, 82],
+        "surface_pressure": [1010.0, 1011.0],
+        "cloud_cover": [20, 40],
+        "wind_speed_10m": [5.0, 6.0],
+        "precipitation_probability": [0, 10],
+        "weather_code": [0, 1],
+    },
+    "daily": {
+        "time": ["2024-01-01"],
+        "temperature_2m_max": [12.0],
+        "temperature_2m_min": [4.0],
+        "precipitation_probability_mean": [5],
+        "weather_code": [3],
+        "sunrise": ["2024-01-01T07:37"],
+        "sunset": ["2024-01-01T16:48"],
+    },
+}
+
+
+def test_weather(client: FlaskClient, auth: AuthActions, monkeypatch):
+    """Weather route should:
+    - display the forecast of the city of the user
+    - fetch hourly and daily forecasts with a single request to the backend,
+        through the shared session and with a timeout
+    - respond 500 if the backend can't be reached
+    """
+    calls = []
+
+    def fake_get(self, url, params=None, timeout=None):
+        calls.append((url, params, timeout))
+        return FakeResponse(FORECAST_JSON)
+
+    monkeypatch.setattr("requests.Session.get", fake_get)
+    client.application.config["UPSTREAM_SHARED_SINGLE_FLIGHT"] = False
+
+    auth.login(username="prova", password="prova")
+    res = client.get("/user/weather")
+    assert res.status_code == 200
+    assert b"<p>temp: 10.0 C\xc2\xb0</p>" in res.data
+    assert b"<p>sunset: 2024-01-01T16:48</p>" in res.data
+    assert len(calls) == 1
+    url, params, timeout = calls[0]
+    assert url == "https://api.open-meteo.com/v1/forecast"
+    assert "hourly" in params and "daily" in params
+    # the timeouts are capped by the latency budget of the request
+    connect_timeout, read_timeout = client.application.config["WEATHER_HTTP_TIMEOUT"]
+    assert 0 < timeout[0] <= connect_timeout
+    assert 0 < timeout[1] <= client.application.config["WEATHER_LATENCY_BUDGET"]
+
+    def unreachable(self, url, params=None, timeout=None):
+        raise requests.exceptions.ConnectTimeout()
+
+    monkeypatch.setattr("requests.Session.get", unreachable)
+    with client.application.test_request_context():
+        coordinates = Coordinates("rome", "", "")
+        assert coordinates.status_code == 200
+        assert WeatherForecast(coordinates).status_code == 500
+
+
+def test_latency_budget(client: FlaskClient):
+    """A backend that accepts the connection and never answers should
+    be given up on within the latency budget, retries included.
+    """
+    app = client.application
+    app.config["WEATHER_LATENCY_BUDGET"] = 1.0
+    app.config["WEATHER_HTTP_TIMEOUT"] = (3.05, 10)
+    app.config["WEATHER_HTTP_RETRIES"] = 2
+    with socket.socket() as hanging:
+        hanging.bind(("127.0.0.1", 0))
+        hanging.listen()
+        url = f"http://127.0.0.1:{hanging.getsockname()[1]}/v1/forecast"
+        with app.test_request_context():
+            started = time.monotonic()
+            res = fetch_json(url, {"latitude": 1})
+            elapsed = time.monotonic() - started
+    assert res == (500, None)
+    assert elapsed < 1.5
+
+
+def test_forecast_cache(client: FlaskClient, auth: AuthActions, monkeypatch):
+    """Forecasts should be cached by rounded coordinates:
+    - users of the same city are served without querying the backend again
+    - a stale forecast is served right away while a single background
+        thread refreshes it
+    - a forecast that is too old is fetched again before responding
+    """
+    calls = []
+    release = threading.Event()
+
+    def fake_get(self, url, params=None, timeout=None):
+        calls.append(params)
+        if threading.current_thread() is not threading.main_thread():
+            # background refresh
+            release.wait(timeout=5)
+        return FakeResponse(FORECAST_JSON)
+
+    monkeypatch.setattr("requests.Session.get", fake_get)
+    client.application.config["UPSTREAM_SHARED_SINGLE_FLIGHT"] = False
+    auth.login(username="prova", password="prova")
+
+    assert client.get("/user/weather").status_code == 200
+    assert client.get("/user/weather").status_code == 200
+    assert len(calls) == 1
+
+    # a slightly different position inside the same grid cell
+    with client.application.test_request_context():
+        coordinates = Coordinates("rome", "", "")
+        coordinates.latitude = coordinates.latitude + 0.001
+        assert get_forecast(coordinates).status_code == 200
+    assert len(calls) == 1
+
+    client.application.config["WEATHER_CACHE_TTL"] = -1
+    client.application.extensions.pop("hjblog.forecast_cache")
+    assert client.get("/user/weather").status_code == 200
+    assert len(calls) == 2
+    # stale: both responses are immediate, only one refresh is started
+    assert client.get("/user/weather").status_code == 200
+    assert client.get("/user/weather").status_code == 200
+    release.set()
+    for _ in range(100):
+        if len(calls) == 3:
+            break
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert len(calls) == 3
+
+    client.application.config["WEATHER_CACHE_MAX_STALE"] = -1
+    client.application.extensions.pop("hjblog.forecast_cache")
+    client.get("/user/weather")
+    client.get("/user/weather")
+    assert len(calls) == 5
+
+
+def test_single_flight(client: FlaskClient, monkeypatch):
+    """Identical calls to the backend should share a single upstream call:
+    - concurrent calls inside the process wait for the one in flight
+    - a call whose lock row is held by another process waits for the result
+        stored in the row
+    - the calls executed and coalesced are counted in memory and flushed
+        to `upstream_flight_stats`
+    - a caller doesn't wait for a call in flight beyond the latency budget
+    """
+    app = client.application
+    calls = []
+    release = threading.Event()
+
+    def fake_get(self, url, params=None, timeout=None):
+        calls.append(params)
+        release.wait(timeout=5)
+        return FakeResponse({"results": [params["name"]]})
+
+    monkeypatch.setattr("requests.Session.get", fake_get)
+
+    results = []
+
+    def lookup():
+        with app.app_context():
+            results.append(fetch_json("https://example.com", {"name": "rome"}))
+
+    threads = [threading.Thread(target=lookup) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    with app.app_context():
+        single_flight = get_single_flight()
+    for _ in range(500):
+        if single_flight.coalesced == 2:
+            break
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [(200, {"results": ["rome"]})] * 3
+
+    # the lock of another call is held by another process
+    with app.app_context():
+        db = get_db()
+        key = "https://example.com?name=milan"
+        db.execute(
+            "INSERT INTO upstream_flights (key, owner, expires) VALUES (?, 'other', ?)",
+            (key, time.time() + 10),
+        )
+        db.commit()
+
+    def other_process():
+        time.sleep(0.1)
+        with app.app_context():
+            db = get_db()
+            db.execute(
+                "UPDATE upstream_flights SET status = 200, result = ? WHERE (key = ?)",
+                ('{"results": ["from another process"]}', key),
+            )
+            db.commit()
+
+    thread = threading.Thread(target=other_process)
+    thread.start()
+    with app.app_context():
+        res = fetch_json("https://example.com", {"name": "milan"})
+    thread.join()
+    assert res == (200, {"results": ["from another process"]})
+    assert len(calls) == 1
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute("SELECT * FROM upstream_flight_stats").fetchall() == []
+        flush_flight_stats()
+        stats = dict(
+            db.execute("SELECT name, value FROM upstream_flight_stats").fetchall()
+        )
+    assert stats == {"executed": 1, "coalesced": 2, "shared_coalesced": 1}
+
+    # the leader is stuck, the other caller gives up when the budget runs out
+    release.clear()
+    app.config["UPSTREAM_SHARED_SINGLE_FLIGHT"] = False
+    app.config["WEATHER_LATENCY_BUDGET"] = 0.2
+    leader = threading.Thread(target=lookup)
+    leader.start()
+    for _ in range(500):
+        if len(calls) == 2:
+            break
+        time.sleep(0.01)
+    with app.app_context():
+        started = time.monotonic()
+        res = fetch_json("https://example.com", {"name": "rome"})
+        assert time.monotonic() - started < 1
+    release.set()
+    leader.join()
+    assert res == (503, None)
+    assert len(calls) == 2
+
+
+def test_circuit_breaker(client: FlaskClient, auth: AuthActions, monkeypatch):
+    """The weather backend should be guarded by a circuit breaker:
+    - after enough consecutive failures the breaker opens and calls fail fast
+    - after the recovery time a single trial call decides whether it closes
+    - while the backend is unavailable the weather page is rendered with
+        the last cached forecast, or without one, instead of failing
+    - state changes are stored in `upstream_breakers`
+    """
+    changes = []
+    breaker = CircuitBreaker("backend", 2, 0.05, lambda b: changes.append(b.state))
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # only one trial call at a time
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert changes == ["open", "half-open", "open", "half-open", "closed"]
+    assert breaker.rejected == 2
+
+    app = client.application
+    app.config["UPSTREAM_SHARED_SINGLE_FLIGHT"] = False
+    app.config["UPSTREAM_BREAKER_FAILURES"] = 1
+    calls = []
+
+    def fake_get(self, url, params=None, timeout=None):
+        calls.append(params)
+        return FakeResponse(FORECAST_JSON)
+
+    def unreachable(self, url, params=None, timeout=None):
+        calls.append(params)
+        raise requests.exceptions.ReadTimeout()
+
+    monkeypatch.setattr("requests.Session.get", unreachable)
+    auth.login(username="prova", password="prova")
+    res = client.get("/user/weather")
+    assert res.status_code == 200
+    assert b"Weather predictions are not available right now" in res.data
+    assert len(calls) == 1
+    # the breaker is open, the backend isn't called
+    res = client.get("/user/weather")
+    assert res.status_code == 200
+    assert b"The weather service is currently unavailable" in res.data
+    assert len(calls) == 1
+
+    with app.app_context():
+        row = (
+            get_db()
+            .execute("SELECT state, failures FROM upstream_breakers")
+            .fetchone()
+        )
+    assert tuple(row) == ("open", 1)
+
+    # the backend recovers, then the forecast gets too old and the backend fails again
+    app.config["UPSTREAM_BREAKER_RECOVERY"] = 0
+    app.extensions.pop("hjblog.upstream_breakers")
+    monkeypatch.setattr("requests.Session.get", fake_get)
+    assert b"<p>temp: 10.0 C\xc2\xb0</p>" in client.get("/user/weather").data
+    app.extensions["hjblog.forecast_cache"].max_stale = -1
+    monkeypatch.setattr("requests.Session.get", unreachable)
+    res = client.get("/user/weather")
+    assert b"the forecast displayed may be outdated" in res.data
+    assert b"<p>temp: 10.0 C\xc2\xb0</p>" in res.data
+
+    # the latency budget of the request is exhausted, nothing is called
+    app.config["WEATHER_LATENCY_BUDGET"] = 0
+    calls.clear()
+    res = client.get("/user/weather")
+    assert res.status_code == 200
+    assert calls == []
@@ -1,8 +1,12 @@
+from io import BytesIO
+import os
 from flask import url_for
 from flask.testing import FlaskClient
+from PIL import Image
 
 from auxiliaries import check_navbar
 from conftest import AuthActions
+from hjblog.bps.user_profile.auxiliaries import get_picture_files, get_profile_pic
 from hjblog.db import get_db
 
 
@@ -294,10 +298,8 @@ def test_change_picture(client: FlaskClient, auth: AuthActions):
             "SELECT profile_pic FROM users WHERE username = ?", ("admin",)
         ).fetchone()["profile_pic"]
         assert profile_pic_name is None
-    assert (
-        b'<img src="/static/default_files/anonymous_user.png" alt="profile picture"/>'
-        in res.data
-    )
+        url = url_for("static", filename="default_files/anonymous_user.png")
+    assert f'<img src="{url}" alt="profile picture"/>'.encode("utf-8") in res.data
 
     res = client.post(
         "/change_picture",
@@ -322,11 +324,103 @@ def test_change_picture(client: FlaskClient, auth: AuthActions):
         assert b"You have updated your profile picture correctly" in res.data
         # New picture is being displayed
         assert (
-            url_for("index.profile_pictures", pic_name=pic_name).encode("utf-8")
+            str(get_profile_pic(pic_name)).encode("utf-8")
             in res.data
         )
 
 
+def test_picture_thumbnails(client: FlaskClient, auth: AuthActions):
+    """Uploaded pictures should:
+    - be stored as square WebP and PNG thumbnails at 1x and 2x, without metadata
+    - be named after their content, inside sharded directories
+    - be displayed through the thumbnail that fits the page
+    - replace the files of the previous picture
+    - be stored once if more users upload the same picture, the files are
+        removed when the last user stops using them
+    - be refused if they have too many pixels
+    """
+    upload_dir = client.application.config["UPLOAD_DIR"]
+
+    def stored_files() -> list[str]:
+        return sorted(
+            os.path.relpath(os.path.join(root, name), upload_dir)
+            for root, _, names in os.walk(upload_dir)
+            for name in names
+        )
+
+    def get_pic_name(username: str) -> str:
+        with client.application.app_context():
+            return (
+                get_db()
+                .execute("SELECT profile_pic FROM users WHERE username = ?", (username,))
+                .fetchone()["profile_pic"]
+            )
+
+    def upload(size: tuple[int, int], color: str = "red") -> int:
+        img = Image.new("RGB", size, color)
+        exif = Image.Exif()
+        exif[0x010F] = "camera maker"
+        buffer = BytesIO()
+        img.save(buffer, "JPEG", exif=exif)
+        buffer.seek(0)
+        res = client.post(
+            "/change_picture",
+            data={"picture": (buffer, "photo.jpg"), "submit": "Submit"},
+        )
+        return res.status_code
+
+    auth.login(username="admin", password="prova")
+    assert upload((1200, 800)) == 302
+    pic_name = get_pic_name("admin")
+    assert len(pic_name) == 64
+    files = get_picture_files(pic_name)
+    assert len(files) == 8
+    for file_name in files:
+        assert file_name.startswith(f"{pic_name[:2]}/{pic_name[2:4]}/{pic_name}_")
+        with Image.open(os.path.join(upload_dir, file_name)) as img:
+            px = int(file_name.split("_")[1].split(".")[0])
+            assert img.size == (px, px)
+            assert "exif" not in img.info
+            assert len(img.getexif()) == 0
+    assert stored_files() == sorted(files)
+
+    res = client.get("/manage_profile")
+    assert f"/uploads/{files[0]}".encode() in res.data
+    assert f"/uploads/{files[-1]} 2x".encode() in res.data
+    assert client.get(f"/uploads/{files[1]}").status_code == 200
+
+    # the same picture uploaded by another user is stored once
+    client.get("/auth/logout")
+    auth.login(username="prova", password="prova")
+    assert upload((1200, 800)) == 302
+    assert get_pic_name("prova") == pic_name
+    assert stored_files() == sorted(files)
+    with client.application.app_context():
+        refcount = (
+            get_db()
+            .execute("SELECT refcount FROM uploads WHERE (name = ?)", (pic_name,))
+            .fetchone()["refcount"]
+        )
+    assert refcount == 2
+
+    # still used by admin
+    assert upload((64, 64), "blue") == 302
+    assert stored_files() != sorted(files)
+    assert set(files) <= set(stored_files())
+    assert len(stored_files()) == 16
+    client.get("/auth/logout")
+
+    # the files of the old picture are removed
+    auth.login(username="admin", password="prova")
+    assert upload((64, 64)) == 302
+    assert not os.path.exists(os.path.join(upload_dir, files[0]))
+    assert len(stored_files()) == 16
+
+    client.application.config["PICTURE_MAX_PIXELS"] = 100 * 100
+    assert upload((101, 100)) == 400
+    assert len(stored_files()) == 16
+
+
 def test_2fa(client: FlaskClient, auth: AuthActions):
     """Functionality for 2FA should:
     - refuse the connection if not logged in. 302 redirect to login